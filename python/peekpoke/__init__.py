@@ -11,47 +11,113 @@
 # todo: revise if break callbacks added to Crow host
 
 
-from crow.host import Host
-from crow.host_serial import HostSerialSettings
+import bisect
+import struct
+import sys
+import time
 from crow.errors import ClientError
+from crow.errors import CrowError
+from crow.errors import DeviceLowResourcesError
+from crow.errors import DeviceUnavailableError
 from crow.errors import InvalidCommandError
+from crow.errors import NoResponseError
 from crow.errors import ServiceError
+from crow.errors import ServiceLowResourcesError
+from peekpoke.metrics import CommandMetrics
+from peekpoke.shadow import HubShadow
 
 
 __version__ = '0.6.3'
 VERSION = __version__
 
 
+# Struct format codes (unsigned) for the supported integer lengths.
+_INT_CODES = {1:'B', 2:'H', 4:'I', 8:'Q'}
+
+
+# The readHub, writeHub, and readHubStr commands start with the same eight byte
+#  header: the PeekPoke identifier, the command code, the hub address, and a count.
+_HUB_COMMAND = struct.Struct('<4sHH')
+_READ_HUB_PREFIX = b'\x70\x70\x00\x01'
+_WRITE_HUB_PREFIX = b'\x70\x70\x00\x02'
+_READ_HUB_STR_PREFIX = b'\x70\x70\x00\x03'
+
+
+# crow.host (which imports pyserial) is imported when a serial port is first
+#  opened, and the port is opened when the first command is sent (or by
+#  warm_up). Before then baudrate settings are held by the PeekPoke object.
+#  This is crow's default baudrate for a serial port.
+_DEFAULT_BAUDRATE = 115200
+
+
+# The baudrates tried by negotiate_baudrate, and the results of negotiation,
+#  keyed by (serial port name, address, identifier).
+_CANDIDATE_BAUDRATES = [115200, 230400, 460800, 921600, 1000000, 1500000, 2000000, 3000000]
+_negotiated_baudrates = {}
+
+
 class PeekPoke():
 
-    def __init__(self, serial_port_name, address=1, port=112):
+    def __init__(self, serial_port_name, address=1, port=112, *, cache=None, warm_up=False):
+        # cache enables the persistent device cache (see DeviceCache). It may be
+        #  True (for the default location), a path, or a DeviceCache object.
+        # The serial port is not opened until it is needed. If warm_up is True it
+        #  is opened in the background (see the warm_up method).
         if address < 1 or address > 31:
             raise ValueError("The address must be 1 to 31.")
         if port < 0 or port > 255:
             raise ValueError("The port must be 0 to 255.")
         self._address = address
         self._port = port
-        self._host = Host(serial_port_name)
-        self._host.custom_service_error_callback = self._custom_error_callback
-        self._select_propcr_order()
+        self._serial_port_name = serial_port_name
+        self._host = None
+        self._serial = None
+        self._pending_baudrate = None
+        self._warm_up_state = None
         self._last_good_baudrate = None
         self._info = None
         self._break_duration = 400
+        self._pipeline_window = 1
+        self._pipeline_token = 0
+        self._shadow = None
+        self._prefetcher = None
+        self._combiner = None
+        self._metrics = None
+        if cache is None or cache is False:
+            self._cache = None
+        else:
+            from peekpoke.cache import DeviceCache
+            if cache is True:
+                self._cache = DeviceCache()
+            elif isinstance(cache, DeviceCache):
+                self._cache = cache
+            else:
+                self._cache = DeviceCache(cache)
+        self._cache_entry = None
+        self._cached_timings = None
+        self._load_cache_entry()
+        if warm_up:
+            self.warm_up()
 
     @property
     def serial_port_name(self):
-        return self._host.serial_port.name
+        return self._serial_port_name
 
     @serial_port_name.setter
     def serial_port_name(self, serial_port_name):
+        # The new serial port is opened when it is needed.
+        self._finish_warm_up(raise_error=False)
         self._revert_propcr_order()
-        try:
-            self._host = Host(serial_port_name)
-            # Reset the following only on success.
-            self._last_good_baudrate = None
-            self._info = None
-        finally:
-            self._select_propcr_order()
+        self._host = None
+        self._serial = None
+        self._serial_port_name = serial_port_name
+        self._pending_baudrate = None
+        self._last_good_baudrate = None
+        self._info = None
+        self._reset_shadow()
+        self._reset_prefetch()
+        self._reset_write_combining()
+        self._load_cache_entry()
 
     @property
     def address(self):
@@ -61,11 +127,17 @@ class PeekPoke():
     def address(self, address):
         if address < 1 or address > 31:
             raise ValueError("The address must be 1 to 31.")
+        self._finish_warm_up(raise_error=False)
         self._revert_propcr_order()
         self._address = address
+        self._pending_baudrate = None
         self._select_propcr_order()
         self._last_good_baudrate = None
         self._info = None
+        self._reset_shadow()
+        self._reset_prefetch()
+        self._reset_write_combining()
+        self._load_cache_entry()
 
     @property
     def port(self):
@@ -75,42 +147,221 @@ class PeekPoke():
     def port(self, port):
         if port < 0 or port > 255:
             raise ValueError("The port must be 0 to 255.")
+        self._finish_warm_up(raise_error=False)
         self._port = port
         self._info = None
+        self._reset_shadow()
+        self._reset_prefetch()
+        self._reset_write_combining()
+        self._load_cache_entry()
 
     @property
     def baudrate(self):
+        if self._host is None:
+            return self._unopened_baudrate()
         return self._host.serial_port.get_baudrate(self._address)
 
     @baudrate.setter
     def baudrate(self, baudrate):
-        self._host.serial_port.set_baudrate(self._address, baudrate)
+        if self._host is None:
+            self._pending_baudrate = baudrate
+        else:
+            self._host.serial_port.set_baudrate(self._address, baudrate)
+
+    @property
+    def pipeline_window(self):
+        """The number of hub memory commands that bulk operations may keep in flight at once."""
+        return self._pipeline_window
+
+    @pipeline_window.setter
+    def pipeline_window(self, pipeline_window):
+        # PeekPoke.spin has a single command buffer, so it can only use a window
+        #  of 1 (stop-and-wait). Larger windows are for implementations that can
+        #  buffer commands while busy.
+        if pipeline_window < 1 or pipeline_window > 128:
+            raise ValueError("The pipeline window must be 1 to 128.")
+        self._pipeline_window = pipeline_window
 
 
     # Hub Memory: Binary Data Methods
 
     def get_bytes(self, hub_address, count, *, atomic=False):
         self._verify_hub_args(hub_address, count, True, atomic)
+        return self._read_bytes(hub_address, count, atomic)
+
+    def get_bytes_into(self, hub_address, buffer, *, atomic=False):
+        """Reads len(buffer) bytes into buffer, which may be any writable, contiguous buffer object. Returns the number of bytes read."""
+        # The response payloads are copied directly into the buffer, so no
+        #  intermediate objects are allocated for the data. Buffers with items
+        #  larger than a byte (e.g. numpy arrays) are filled by byte count.
+        view = PeekPoke._byte_view(buffer)
+        count = len(view)
+        self._verify_hub_args(hub_address, count, True, atomic)
+        self._read_bytes_into(hub_address, view, atomic)
+        return count
+
+    def read_many(self, ranges, *, max_gap=None):
+        """Reads a list of (hub_address, count) ranges, returning a list of bytearrays in the same order."""
+        # Ranges are sorted and merged so that they can be read with as few
+        #  readHub commands as possible. Two ranges are merged if the merged span
+        #  fits in a single command and the bytes between them (the gap) would
+        #  cost less to read than another command. If max_gap is None it is
+        #  estimated from the baudrate (see _default_max_gap). Only ranges within
+        #  the allowed read range are merged, so an AccessError identifies the
+        #  offending range.
+        ranges = list(ranges)
+        for hub_address, count in ranges:
+            self._verify_hub_args(hub_address, count, True, False)
+        if max_gap is None:
+            max_gap = PeekPoke._default_max_gap(self.baudrate)
+        elif max_gap < 0:
+            raise ValueError("max_gap must not be negative.")
         info = self.get_info()
-        result = bytearray()
-        while count > 0:
-            atomic_count = min(count, info.max_atomic_read)
-            count -= atomic_count
-            result += self._read_hub(hub_address, atomic_count)
-            hub_address = (hub_address + atomic_count)%65536
-        return result
+        # groups holds [start, end, indices, mergeable] lists for the spans to read.
+        groups = []
+        order = sorted((i for i in range(len(ranges)) if ranges[i][1] > 0), key=lambda i: ranges[i][0])
+        for i in order:
+            start, count = ranges[i]
+            end = start + count
+            mergeable = start >= info.min_read_address and end <= info.max_read_address + 1
+            if len(groups) > 0 and mergeable and groups[-1][3]:
+                group = groups[-1]
+                new_end = max(end, group[1])
+                if start - group[1] <= max_gap and new_end - group[0] <= info.max_atomic_read:
+                    group[1] = new_end
+                    group[2].append(i)
+                    continue
+            groups.append([start, end, [i], mergeable])
+        results = [bytearray() for _r in ranges]
+        buffer = bytearray(sum(group[1] - group[0] for group in groups))
+        view = memoryview(buffer)
+        offsets = []
+        offset = 0
+        for group in groups:
+            offsets.append(offset)
+            offset += group[1] - group[0]
+        if self._shadow is None:
+            # All of the commands are sent together so that they may be pipelined.
+            chunks = []
+            for group, offset in zip(groups, offsets):
+                for address, n in PeekPoke._split_hub_range(group[0], group[1] - group[0], info.max_atomic_read):
+                    index = offset + address - group[0]
+                    chunks.append((address, view[index:index+n]))
+            self._read_hub_chunks(chunks)
+        else:
+            for group, offset in zip(groups, offsets):
+                self._read_bytes_into(group[0], view[offset:offset+group[1]-group[0]], False)
+        for group, offset in zip(groups, offsets):
+            for i in group[2]:
+                start, count = ranges[i]
+                index = offset + start - group[0]
+                results[i] = bytearray(view[index:index+count])
+        return results
 
     def set_bytes(self, hub_address, data, *, atomic=False):
         count = len(data)
         self._verify_hub_args(hub_address, count, False, atomic)
+        self._write_bytes(hub_address, data, atomic)
+
+    def write_many(self, writes, *, atomic=False):
+        """Writes a list of (hub_address, data) tuples. Returns a list of the (hub_address, count) ranges written by each command."""
+        # Writes that overlap or are adjacent are merged into spans. Where writes
+        #  overlap the later one in the list wins. The spans are written in address
+        #  order (not list order), immediately, even if a write-back shadow is used.
+        # Atomicity: each tuple returned corresponds to one writeHub command, and
+        #  so is written atomically in the same sense as set_bytes(atomic=True).
+        #  A span longer than max_atomic_write is split into several commands, but
+        #  where possible it is split between writes, so any write no longer than
+        #  max_atomic_write is not divided between commands. With atomic=True every
+        #  span must fit in one command or ValueError is raised. When pipelining,
+        #  commands after a failed one may still have been performed.
+        writes = list(writes)
+        for hub_address, data in writes:
+            self._verify_hub_args(hub_address, len(data), False, False)
         info = self.get_info()
-        index = 0
-        while count > 0:
-            atomic_count = min(count, info.max_atomic_write)
-            count -= atomic_count
-            self._write_hub(hub_address, data[index:index+atomic_count])
-            hub_address = (hub_address + atomic_count)%65536
-            index += atomic_count
+        # spans holds [start, end, entries] lists, where entries is a list of the
+        #  (start, end) bounds of the writes in the span.
+        spans = []
+        for hub_address, data in sorted(writes, key=lambda w: w[0]):
+            end = hub_address + len(data)
+            if end == hub_address:
+                continue
+            if len(spans) > 0 and hub_address <= spans[-1][1]:
+                span = spans[-1]
+                span[1] = max(span[1], end)
+                span[2].append((hub_address, end))
+            else:
+                spans.append([hub_address, end, [(hub_address, end)]])
+        if atomic:
+            for start, end, _entries in spans:
+                if end - start > info.max_atomic_write:
+                    raise ValueError("The writes at " + str(start) + " merge into a span of " + str(end - start) + " bytes, which exceeds the atomic write limit of " + str(info.max_atomic_write) + " bytes.")
+        # Build each span's data, applying the writes in list order.
+        starts = [span[0] for span in spans]
+        images = [bytearray(span[1] - span[0]) for span in spans]
+        for hub_address, data in writes:
+            if len(data) == 0:
+                continue
+            index = bisect.bisect_right(starts, hub_address) - 1
+            offset = hub_address - starts[index]
+            images[index][offset:offset+len(data)] = data
+        chunks = []
+        ranges = []
+        for span, image in zip(spans, images):
+            view = memoryview(image)
+            for address, n in PeekPoke._split_span(span[0], span[1], span[2], info.max_atomic_write):
+                index = address - span[0]
+                chunks.append((address, view[index:index+n]))
+                ranges.append((address, n))
+        try:
+            self._write_hub_chunks(chunks)
+        except BaseException:
+            for span in spans:
+                self.invalidate_shadow(span[0], span[1] - span[0])
+            raise
+        if self._shadow is not None:
+            for span, image in zip(spans, images):
+                self._shadow.update(span[0], image)
+        return ranges
+
+    def sync_bytes(self, hub_address, data, *, baseline=None, gap_threshold=32):
+        """Writes only the parts of data that differ from the baseline. Returns a list of the (hub_address, count) ranges written."""
+        # If baseline is None it is taken from the shadow, if that range is valid
+        #  there, or from a fresh read (which will fill the shadow, if enabled).
+        # Changed runs separated by gap_threshold or fewer unchanged bytes are
+        #  merged, since resending a few bytes is cheaper than the overhead of
+        #  another command (about 30 bytes of headers, checksums, and response,
+        #  plus the turnaround).
+        count = len(data)
+        self._verify_hub_args(hub_address, count, False, False)
+        if gap_threshold < 0:
+            raise ValueError("The gap threshold must not be negative.")
+        if baseline is None:
+            # Buffered writes must reach the device before comparing.
+            self._flush_shadow_range(hub_address, count)
+            baseline = self._read_bytes(hub_address, count, False)
+        elif len(baseline) != count:
+            raise ValueError("The baseline must be the same size as the data.")
+        view = memoryview(data)
+        ranges = [(hub_address + start, n) for start, n in PeekPoke._diff_ranges(baseline, view, gap_threshold)]
+        if len(ranges) == 0:
+            return ranges
+        info = self.get_info()
+        chunks = []
+        for address, n in ranges:
+            for chunk_address, chunk_count in PeekPoke._split_hub_range(address, n, info.max_atomic_write):
+                index = chunk_address - hub_address
+                chunks.append((chunk_address, view[index:index+chunk_count]))
+        try:
+            self._write_hub_chunks(chunks)
+        except BaseException:
+            self.invalidate_shadow(hub_address, count)
+            raise
+        if self._shadow is not None:
+            for address, n in ranges:
+                index = address - hub_address
+                self._shadow.update(address, view[index:index+n])
+        return ranges
 
     def fill_bytes(self, hub_address, num_bytes, pattern, *, atomic=False):
         data = bytearray(num_bytes)
@@ -133,7 +384,17 @@ class PeekPoke():
         self._verify_hub_args(hub_address, max_bytes, True, atomic)
         info = self.get_info()
         result = bytearray()
-        if nul_terminated:
+        if nul_terminated and self._shadow_applies(hub_address, max_bytes, True, atomic):
+            # Read through the shadow in readHubStr-sized pieces, stopping at the NUL.
+            for address, atomic_max_bytes in PeekPoke._split_hub_range(hub_address, max_bytes, info.max_atomic_read):
+                data = self._read_bytes(address, atomic_max_bytes, False)
+                nul_index = data.find(0)
+                if nul_index != -1:
+                    result += data[0:nul_index+1]
+                    break
+                result += data
+        elif nul_terminated:
+            self._flush_shadow_range(hub_address, max_bytes)
             while max_bytes > 0:
                 atomic_max_bytes = min(max_bytes, info.max_atomic_read)
                 max_bytes -= atomic_max_bytes
@@ -142,36 +403,11 @@ class PeekPoke():
                 if result[-1] == 0:
                     break
         else:
-            while max_bytes > 0:
-                atomic_count = min(max_bytes, info.max_atomic_read)
-                max_bytes -= atomic_count
-                result += self._read_hub(hub_address, atomic_count)
-                hub_address = (hub_address + atomic_count)%65536
-        if len(result) == 0:
-            return ''
-        if nul_terminated and result[-1] == 0:
-            return result[:-1].decode(encoding=encoding, errors=errors)
-        else:
-            return result.decode(encoding=encoding, errors=errors)
+            result = self._read_bytes(hub_address, max_bytes, atomic)
+        return PeekPoke._decode_str(result, encoding, errors, nul_terminated)
 
     def set_str(self, hub_address, max_bytes, string, *, encoding='latin_1', errors='replace', nul_terminated=True, truncate=False, atomic=False):
-        if max_bytes <= 0:
-            raise ValueError("max_bytes must be greater than zero.")
-        data = string.encode(encoding=encoding, errors=errors)
-        if nul_terminated:
-            if len(data) >= max_bytes:
-                if truncate:
-                    data = bytearray(data[0:max_bytes-1]) + b'\x00'
-                else:
-                    raise ValueError("The encoded string size (" + str(len(data)) + ") plus the terminating NUL exceeds the max_bytes limit (" + str(max_bytes) + ").")
-            else:
-                data = bytearray(data) + b'\x00'
-        else:
-            if len(data) > max_bytes:
-                if truncate:
-                    data = data[0:max_bytes]
-                else:
-                    raise ValueError("The encoded string size (" + str(len(data)) + ") exceeds the max_bytes limit (" + str(max_bytes) + ").")
+        data = PeekPoke._encode_str(max_bytes, string, encoding, errors, nul_terminated, truncate)
         # set_bytes will verify hub args.
         self.set_bytes(hub_address, data, atomic=atomic)
 
@@ -182,7 +418,7 @@ class PeekPoke():
         PeekPoke._verify_int_length(length)
         self._verify_hub_args(hub_address, length, True, True)
         PeekPoke._verify_int_alignment(hub_address, length, alignment)
-        data = self._read_hub(hub_address, length)
+        data = self._read_bytes(hub_address, length, False)
         return int.from_bytes(data, byteorder, signed=signed)
 
     def set_int(self, hub_address, length, integer, *, alignment='length', byteorder='little', signed=False):
@@ -190,7 +426,7 @@ class PeekPoke():
         self._verify_hub_args(hub_address, length, False, True)
         PeekPoke._verify_int_alignment(hub_address, length, alignment)
         data = integer.to_bytes(length, byteorder, signed=signed)
-        self._write_hub(hub_address, data)
+        self._write_bytes(hub_address, data, False)
 
     def get_ints(self, hub_address, length, count, *, alignment='length', byteorder='little', signed=False, atomic=False):
         PeekPoke._verify_int_length(length)
@@ -198,23 +434,87 @@ class PeekPoke():
         # get_bytes will verify hub args.
         num_bytes = count*length
         data = self.get_bytes(hub_address, num_bytes, atomic=atomic)
-        integers = []
-        index = 0
-        for _i in range(0, count):
-            integers.append(int.from_bytes(data[index:index+length], byteorder, signed=signed))
-            index += length
-        return integers
+        return PeekPoke._ints_from_bytes(data, length, count, byteorder, signed)
 
     def set_ints(self, hub_address, length, integers, *, alignment='length', byteorder='little', signed=False, atomic=False):
         PeekPoke._verify_int_length(length)
         PeekPoke._verify_int_alignment(hub_address, length, alignment)
         # set_bytes will verify hub args.
-        data = bytearray()
-        for i in integers:
-            data += i.to_bytes(length, byteorder, signed=signed)
+        data = PeekPoke._ints_to_bytes(integers, length, byteorder, signed)
         self.set_bytes(hub_address, data, atomic=atomic)
 
 
+    # Hub Memory: Struct Methods
+
+    # These methods use a StructLayout (see peekpoke.structs). The alignment
+    #  argument works as for get_ints, except that 'layout' (the default) means
+    #  the layout's record alignment.
+
+    def get_struct(self, hub_address, layout, *, alignment='layout', atomic=False):
+        """Reads a record with the given StructLayout, returning a StructRecord."""
+        # A record no larger than max_atomic_read is read with one readHub command.
+        PeekPoke._verify_struct_alignment(hub_address, layout, alignment)
+        # get_bytes will verify hub args.
+        data = self.get_bytes(hub_address, layout.size, atomic=atomic)
+        return layout.record(data, 0, hub_address)
+
+    def get_structs(self, hub_address, layout, count, *, alignment='layout', atomic=False):
+        """Reads an array of count records with the given StructLayout, returning a list of StructRecords."""
+        # The array is read with as few readHub commands as possible. With
+        #  atomic=True no record is split between commands, so each command
+        #  reads a whole number of records (which may take an extra command).
+        PeekPoke._verify_struct_alignment(hub_address, layout, alignment)
+        size = layout.size
+        data = bytearray(size*count)
+        self._verify_hub_args(hub_address, len(data), True, False)
+        view = memoryview(data)
+        if atomic:
+            per_command = self.get_info().max_atomic_read//size
+            if per_command == 0:
+                raise ValueError("The record size exceeds max_atomic_read, so records cannot be read atomically.")
+            step = per_command*size
+            for index in range(0, len(data), step):
+                self._read_bytes_into(hub_address + index, view[index:index+step], True)
+        else:
+            self._read_bytes_into(hub_address, view, False)
+        return [layout.record(data, i*size, hub_address + i*size) for i in range(count)]
+
+    def set_struct(self, hub_address, layout, values, *, alignment='layout', atomic=False):
+        """Writes the fields in the values dict to the record at hub_address. Other fields are not written."""
+        # Adjacent fields are written together, and atomic works as for write_many
+        #  (each run of adjacent fields must fit in one writeHub command).
+        PeekPoke._verify_struct_alignment(hub_address, layout, alignment)
+        self.write_many(layout._field_writes(hub_address, values), atomic=atomic)
+
+
+    # Hub Memory: Array Methods
+
+    # These methods require numpy (pip install peekpoke[numpy]). The dtype must
+    #  be an integer type of 1, 2, 4, or 8 bytes, and it determines the byte order
+    #  used in hub memory (e.g. '<u4' or '>i2'). Alignment works as for get_ints.
+
+    def get_array(self, hub_address, dtype, count, *, alignment='length', atomic=False):
+        """Returns a numpy array of count items of dtype read from hub memory."""
+        numpy = PeekPoke._import_numpy()
+        dtype = PeekPoke._verify_array_dtype(numpy, dtype)
+        PeekPoke._verify_int_alignment(hub_address, dtype.itemsize, alignment)
+        result = numpy.empty(count, dtype)
+        # get_bytes_into will verify hub args.
+        self.get_bytes_into(hub_address, result, atomic=atomic)
+        return result
+
+    def set_array(self, hub_address, array, *, dtype=None, alignment='length', atomic=False):
+        """Writes the items of a numpy array (or array-like object) to hub memory."""
+        # If dtype is given the items are converted to it first, otherwise the
+        #  array's own dtype is used.
+        numpy = PeekPoke._import_numpy()
+        array = numpy.ascontiguousarray(array, dtype)
+        PeekPoke._verify_array_dtype(numpy, array.dtype)
+        PeekPoke._verify_int_alignment(hub_address, array.dtype.itemsize, alignment)
+        # set_bytes will verify hub args.
+        self.set_bytes(hub_address, memoryview(array.reshape(-1)).cast('B'), atomic=atomic)
+
+
     # Baudrate Methods
 
     def switch_baudrate(self, baudrate, *, clkfreq=None, use_hub_clkfreq=False):
@@ -224,27 +524,130 @@ class PeekPoke():
                 clkfreq = int.from_bytes(self._read_hub(0, 4), 'little')
             else:
                 clkfreq = self.estimate_clkfreq()
-        two_bit_period = int((2 * clkfreq) / baudrate)
-        if two_bit_period < 52:
-            raise ValueError("A baudrate of " + str(baudrate) + " bps is too fast given a clkfreq of " + str(clkfreq) + " MHz.")
-        timings = SerialTimings()
-        timings.bit_period_0 = two_bit_period >> 1
-        timings.bit_period_1 = timings.bit_period_0 + (two_bit_period & 1)
-        timings.start_bit_wait = max((timings.bit_period_0 >> 1) - 10, 5)
-        timings.stop_bit_duration = int((10*clkfreq) / baudrate) - 5*timings.bit_period_0 - 4*timings.bit_period_1 + 1
-        timings.interbyte_timeout = max(int(clkfreq/1000), 2*two_bit_period)  # max of 1ms or 4 bit periods
-        timings.recovery_time = two_bit_period << 3
-        # For the break multiple, use 1/2 of self._break_duration for dependable detection.
-        timings.break_multiple = int((self._break_duration * clkfreq/2000) / timings.recovery_time)
+        timings = self._timings_for_baudrate(baudrate, clkfreq)
         self._set_serial_timings(timings)
         self.baudrate = baudrate
+        if self._cache is not None:
+            self._cached_timings = (timings, baudrate)
+            self._store_cache_entry(baudrate)
 
     def revert_baudrate(self):
         """Changes the local baudrate back to the last known good value, and sends a break condition to the Propeller to instruct it to do the same."""
         if self._last_good_baudrate is None:
             raise RuntimeError("Cannot revert the baudrate before there has been a successful PeekPoke transaction using the current serial port and address.")
         self.baudrate = self._last_good_baudrate
-        self._host.serial_port.serial.send_break(self._break_duration)
+        self._get_host().serial_port.serial.send_break(self._break_duration)
+
+    def negotiate_baudrate(self, max=3000000, *, verify_bytes=1024, verify_address=None, soak=2.0, candidates=None, clkfreq=None, use_hub_clkfreq=False, use_cached=True):
+        """Switches to the fastest baudrate, up to max, that passes verification. Returns the baudrate."""
+        # The candidate baudrates are tried in increasing order, starting above the
+        #  current baudrate. Each must pass a verification check: verify_bytes of
+        #  hub memory at verify_address (by default the start of the read range)
+        #  are read and compared to a reference copy read at the current baudrate,
+        #  and a pattern is written to and read back from the token. On the first
+        #  failure the baudrate is reverted (sending a break condition) and the
+        #  ramp stops. The fastest passing rate must then pass repeated checks for
+        #  soak seconds, otherwise the next slower one is soaked, and so on. The
+        #  current baudrate is the fallback. The token is restored afterwards.
+        # The result is cached per serial port, address, and identifier. With
+        #  use_cached=True a cached result is tried first (with a soak), or
+        #  returned at once if it is the current baudrate.
+        max_baudrate = max
+        if candidates is None:
+            candidates = _CANDIDATE_BAUDRATES
+        info = self.get_info()
+        key = (self.serial_port_name, self._address, info.identifier)
+        cached = _negotiated_baudrates.get(key) if use_cached else None
+        if cached is not None and cached == self.baudrate:
+            # The last negotiation found nothing faster than the current baudrate.
+            return cached
+        if clkfreq is None:
+            if use_hub_clkfreq:
+                clkfreq = int.from_bytes(self._read_hub(0, 4), 'little')
+            else:
+                clkfreq = self.estimate_clkfreq()
+        if verify_address is None:
+            verify_address = info.min_read_address
+        if verify_address < info.min_read_address or verify_address > info.max_read_address:
+            raise ValueError("The verify address must be in the allowed read range.")
+        verify_count = min(verify_bytes, info.max_read_address + 1 - verify_address)
+        reference = bytearray(verify_count)
+        self._read_hub_into(verify_address, memoryview(reference))
+        base_baudrate = self.baudrate
+        original_token = self.get_token_bytes()
+        try:
+            if cached is not None and cached <= max_baudrate:
+                if self._try_baudrate(cached, clkfreq, base_baudrate, verify_address, reference, soak):
+                    return cached
+            passing = []
+            for baudrate in sorted(candidates):
+                if baudrate <= base_baudrate or baudrate > max_baudrate:
+                    continue
+                try:
+                    self._timings_for_baudrate(baudrate, clkfreq)
+                except ValueError:
+                    # Too fast for the Propeller's clock.
+                    break
+                if not self._try_baudrate(baudrate, clkfreq, base_baudrate, verify_address, reference, 0):
+                    break
+                passing.append(baudrate)
+            result = base_baudrate
+            for baudrate in reversed(passing):
+                if self._try_baudrate(baudrate, clkfreq, base_baudrate, verify_address, reference, soak):
+                    result = baudrate
+                    break
+            _negotiated_baudrates[key] = result
+            return result
+        finally:
+            self.set_token_bytes(original_token)
+
+
+    def _try_baudrate(self, baudrate, clkfreq, fallback_baudrate, verify_address, reference, soak):
+        # Used by negotiate_baudrate. Switches to baudrate (if necessary) and checks
+        #  the link repeatedly for soak seconds (at least once). Returns True if all
+        #  checks pass. Otherwise the baudrate is reverted to fallback_baudrate and
+        #  False is returned.
+        try:
+            if self.baudrate != baudrate:
+                self.switch_baudrate(baudrate, clkfreq=clkfreq)
+            end_time = time.perf_counter() + soak
+            count = 0
+            while True:
+                if not self._check_link(verify_address, reference, count):
+                    break
+                count += 1
+                if time.perf_counter() >= end_time:
+                    return True
+        except CrowError:
+            pass
+        self._back_off_baudrate(fallback_baudrate, clkfreq)
+        return False
+
+    def _check_link(self, verify_address, reference, count):
+        # Returns True if the reference data and a token pattern survive a round trip.
+        data = bytearray(len(reference))
+        self._read_hub_into(verify_address, memoryview(data))
+        if data != reference:
+            return False
+        # The pattern alternates bits and changes on each check.
+        pattern = bytes([0x55, 0xaa, 0x00, 0xff, 0x55, 0xaa, 0x00])[count%4:count%4+4]
+        self.set_token_bytes(pattern)
+        return self.get_token_bytes() == pattern
+
+    def _back_off_baudrate(self, baudrate, clkfreq):
+        # Returns the link to baudrate after a failure at a faster rate. The break
+        #  condition returns the device to the last baudrate at which it received a
+        #  command. If that was the faster rate a switch is needed as well.
+        for attempt in range(3):
+            try:
+                self.revert_baudrate()
+                if self.baudrate != baudrate:
+                    self.switch_baudrate(baudrate, clkfreq=clkfreq)
+                self.get_token_bytes()
+                return
+            except CrowError:
+                if attempt == 2:
+                    raise
 
 
     # Token Methods
@@ -263,15 +666,7 @@ class PeekPoke():
         return PeekPoke._parse_token_command(transaction)
 
     def set_token_bytes(self, token, *, use_padding=True):
-        if len(token) < 4:
-            if use_padding:
-                new_token = bytearray(4)
-                new_token[0:len(token)] = token[0:]
-                token = new_token
-            else:
-                raise ValueError("The token must be exactly four bytes if padding is not used.")
-        elif len(token) > 4:
-            raise ValueError("Too many bytes provided -- the token is a four-byte value.")
+        token = PeekPoke._pad_token(token, use_padding)
         transaction = self._send_command(7, token)
         return PeekPoke._parse_token_command(transaction)
 
@@ -287,15 +682,197 @@ class PeekPoke():
         return info.identifier
 
     def get_info(self, *, use_cached=True):
+        if self._warm_up_state is not None:
+            self._finish_warm_up()
         if not use_cached or self._info is None:
-            self._info = self._get_info()
+            self._install_fresh_info(self._get_info())
         return self._info
 
     def estimate_clkfreq(self):
+        if self._cached_timings is not None:
+            # With the persistent cache the timings, and the baudrate they were
+            #  for, are remembered, so no command is needed.
+            timings, baudrate = self._cached_timings
+            return ( (timings.bit_period_0 + timings.bit_period_1) * baudrate) / 2.0
         timings = self._get_serial_timings()
+        if self._cache is not None:
+            self._cached_timings = (timings, self.baudrate)
+            self._store_cache_entry(self._last_good_baudrate)
         return ( (timings.bit_period_0 + timings.bit_period_1) * self.baudrate) / 2.0
 
 
+    # Cache Methods
+
+    @property
+    def cache(self):
+        """The DeviceCache, or None if the persistent cache is not used."""
+        return self._cache
+
+    def forget_cached(self):
+        """Removes this device's entry from the persistent cache, and clears the cached info."""
+        if self._cache is not None:
+            self._cache.remove(self.serial_port_name, self._address, self._port)
+        self._cache_entry = None
+        self._cached_timings = None
+        self._info = None
+
+
+    # Shadow Methods
+
+    # The shadow is an opt-in local mirror of hub memory (see HubShadow). When it
+    #  is enabled the hub memory methods are served from it where possible, with
+    #  these exceptions:
+    #   - reads with atomic=True, and reads outside the allowed read range, always
+    #     go to the device,
+    #   - writes with atomic=True, and writes outside the allowed write range, are
+    #     never buffered,
+    #   - volatile regions are never served from or buffered in the mirror.
+    # get_int and set_int are not considered atomic for this purpose.
+
+    @property
+    def shadow(self):
+        """The HubShadow object, or None if the shadow is not enabled."""
+        return self._shadow
+
+    def enable_shadow(self, *, page_size=64, ttl=None, write_back=False):
+        """Enables the hub memory shadow, replacing any existing one. Returns the HubShadow object."""
+        if self._shadow is not None:
+            self.flush_shadow()
+        self._shadow = HubShadow(page_size=page_size, ttl=ttl, write_back=write_back)
+        return self._shadow
+
+    def disable_shadow(self):
+        """Flushes any buffered writes and disables the shadow."""
+        if self._shadow is not None:
+            self.flush_shadow()
+            self._shadow = None
+
+    def invalidate_shadow(self, hub_address=0, count=65536):
+        """Forces the range to be reread from the device on its next use."""
+        if self._shadow is not None:
+            self._shadow.invalidate(hub_address, count)
+
+    def flush_shadow(self):
+        """Writes any buffered (write-back) writes to the device."""
+        self._flush_shadow_range(0, 65536)
+
+
+    # Prefetch Methods
+
+    # Read-ahead (see peekpoke.prefetch) serves reads that continue a sequential
+    #  or strided pattern from a window read earlier, for up to max_age seconds.
+    #  Reads served by the shadow are not affected. Any write sent through this
+    #  object discards the window, but changes made on the Propeller itself are
+    #  not seen until it is discarded or expires.
+
+    @property
+    def prefetcher(self):
+        """The ReadAhead object, or None if read-ahead is disabled."""
+        return self._prefetcher
+
+    def enable_prefetch(self, *, max_age=0.1, min_confidence=2, max_wasted_bytes=8192):
+        """Enables sequential read-ahead, replacing any existing prefetcher. Returns the ReadAhead object."""
+        from peekpoke.prefetch import ReadAhead
+        self._prefetcher = ReadAhead(max_age=max_age, min_confidence=min_confidence, max_wasted_bytes=max_wasted_bytes)
+        return self._prefetcher
+
+    def disable_prefetch(self):
+        self._prefetcher = None
+
+
+    # Write Combining Methods
+
+    # Write combining (see peekpoke.combine) buffers small writes, such as
+    #  set_int, and merges contiguous or overlapping ones so that they are sent
+    #  with one writeHub command (up to max_atomic_write bytes). Buffered writes
+    #  are sent when a span is full, when a read overlaps it, before any write
+    #  that is not buffered, before payload_exec, and by flush. A span older than
+    #  max_age is sent by the next call that reads or writes hub memory. There
+    #  is no timer (this object is not thread safe), so a burst of writes with
+    #  nothing after it stays buffered: callers must call flush at the end of
+    #  each burst (e.g. each control loop iteration) for the Propeller to see it.
+    #  Reads through this object always see earlier writes, but the Propeller
+    #  sees them late, and spans are sent in address order.
+    #  Writes with atomic=True, writes of max_atomic_write bytes or more, and
+    #  writes outside the allowed write range are never buffered. If sending a
+    #  span fails the error is raised by whichever call sent it, and the span is
+    #  discarded. Changing the location discards any buffered writes.
+
+    @property
+    def write_combiner(self):
+        """The WriteCombiner object, or None if write combining is disabled."""
+        return self._combiner
+
+    def enable_write_combining(self, *, max_age=0.01, max_bytes=None):
+        """Enables write combining, replacing any existing combiner. Returns the WriteCombiner object. Call flush after each burst of writes."""
+        # max_age is only checked when hub memory is next read or written, so
+        #  buffered writes are not sent on their own (see above).
+        from peekpoke.combine import WriteCombiner
+        combiner = WriteCombiner(max_age=max_age, max_bytes=max_bytes)
+        self._flush_combined()
+        self._combiner = combiner
+        return combiner
+
+    def disable_write_combining(self):
+        """Sends any buffered writes and disables write combining."""
+        self._flush_combined()
+        self._combiner = None
+
+    def flush(self):
+        """Sends all buffered writes (write combining and write-back shadow) to the device."""
+        self._flush_combined()
+        self.flush_shadow()
+
+
+    # Batch Methods
+
+    def batch(self):
+        """Returns a Batch (see peekpoke.batch). Use it as a context manager: the operations queued in the block are planned and performed together when it exits."""
+        from peekpoke.batch import Batch
+        return Batch(self)
+
+
+    # Hub Memory View
+
+    def hub_memory(self, *, page_size=256, max_pages=64, max_age=None):
+        """Returns a HubMemory object, a paged and cached sequence-like view of hub memory (see peekpoke.hubmemory)."""
+        from peekpoke.hubmemory import HubMemory
+        return HubMemory(self, page_size=page_size, max_pages=max_pages, max_age=max_age)
+
+
+    # Metrics Methods
+
+    @property
+    def metrics(self):
+        """The CommandMetrics collector, or None if metrics are disabled."""
+        return self._metrics
+
+    def enable_metrics(self):
+        """Starts collecting per-command metrics. Returns the CommandMetrics collector."""
+        # If metrics are already enabled the existing collector is kept.
+        if self._metrics is None:
+            self._metrics = CommandMetrics()
+        return self._metrics
+
+    def disable_metrics(self):
+        self._metrics = None
+
+
+    # Dump Methods
+
+    def dump(self, file, ranges=None, *, compression='zlib', level=None, block_size=1024):
+        """Reads hub memory into a dump file (see peekpoke.dump). Returns the DumpHeader."""
+        # ranges is a list of (hub_address, count) tuples, and by default is the
+        #  entire allowed read range. compression may be 'none', 'zlib', or 'lzma'.
+        from peekpoke import dump
+        return dump.dump(self, file, ranges, compression=compression, level=level, block_size=block_size)
+
+    def restore(self, file, *, check_device=True):
+        """Writes a dump file back to hub memory, skipping anything outside the allowed write range. Returns the number of bytes written."""
+        from peekpoke import dump
+        return dump.restore(self, file, check_device=check_device)
+
+
     # Internal Command Methods
 
     def _get_info(self):
@@ -305,23 +882,101 @@ class PeekPoke():
     def _read_hub(self, hub_address, count):
         # It is assumed that hub_address is in [0, 65535] and count is in [0, max_atomic_read],
         #  and there is no wrap around.
-        cmd_data = hub_address.to_bytes(2, 'little') + count.to_bytes(2, 'little')
-        transaction = self._send_command(1, cmd_data)
+        self._flush_combined_range(hub_address, count)
+        transaction = self._send_payload(1, _HUB_COMMAND.pack(_READ_HUB_PREFIX, hub_address, count))
+        transaction.hub_address = hub_address
         transaction.count = count
         return PeekPoke._parse_read_hub(transaction)
 
+    def _read_hub_into(self, hub_address, view):
+        # Reads len(view) bytes starting at hub_address into the writable byte
+        #  memoryview using as many readHub commands as needed. The same assumptions
+        #  as _read_hub apply, except that the count may be up to 65536. Each
+        #  response's data is copied straight from the response into the view.
+        info = self.get_info()
+        count = len(view)
+        if count == 0:
+            return
+        if count <= info.max_atomic_read:
+            self._read_hub_chunks([(hub_address, view)])
+            return
+        chunks = PeekPoke._split_hub_range(hub_address, count, info.max_atomic_read)
+        self._read_hub_chunks([(address, view[address-hub_address:address-hub_address+atomic_count]) for address, atomic_count in chunks])
+
+    def _read_hub_chunks(self, chunks):
+        # Sends a readHub command for each (hub_address, view) tuple in the list
+        #  chunks, copying the data returned into view. Each chunk must satisfy
+        #  the assumptions of _read_hub. Empty chunks are skipped.
+        chunks = [chunk for chunk in chunks if len(chunk[1]) > 0]
+        if len(chunks) == 0:
+            return
+        if self._combiner is not None and self._combiner.pending:
+            start = min(address for address, _view in chunks)
+            self._flush_combined_range(start, max(address + len(view) for address, view in chunks) - start)
+        if len(chunks) == 1:
+            # A single command needs no pipelining machinery.
+            address, view = chunks[0]
+            transaction = self._send_payload(1, _HUB_COMMAND.pack(_READ_HUB_PREFIX, address, len(view)))
+            PeekPoke._copy_read_hub(transaction, address, view)
+            return
+        commands = (_HUB_COMMAND.pack(_READ_HUB_PREFIX, address, len(view)) for address, view in chunks)
+        for chunk, transaction in zip(chunks, self._send_commands(1, commands)):
+            PeekPoke._copy_read_hub(transaction, chunk[0], chunk[1])
+
     def _write_hub(self, hub_address, data):
         # It is assumed that hub_address is in [0, 65535] and len(data) is in [0, max_atomic_write],
-        #  and there is no wrap around.
-        cmd_data = hub_address.to_bytes(2, 'little') + len(data).to_bytes(2, 'little') + data
-        transaction = self._send_command(2, cmd_data)
+        #  and there is no wrap around. Buffered combined writes are sent first.
+        self._flush_combined()
+        if self._prefetcher is not None:
+            self._prefetcher.invalidate()
+        transaction = self._send_payload(2, PeekPoke._write_hub_command(hub_address, data))
+        transaction.hub_address = hub_address
         PeekPoke._verify_essentials(transaction, 4, 4)
 
+    def _write_hub_multiple(self, hub_address, data):
+        # Writes data starting at hub_address using as many writeHub commands as
+        #  needed. The same assumptions as _write_hub apply, except that len(data)
+        #  may be up to 65536. Chunks are taken from a memoryview of data, so the
+        #  only copy made is into the command payload itself. If a command fails
+        #  the exception identifies that chunk's hub address. When pipelining, any
+        #  chunks already in flight after a failed chunk may have been written.
+        info = self.get_info()
+        count = len(data)
+        if count == 0:
+            return
+        if count <= info.max_atomic_write:
+            self._write_hub(hub_address, data)
+            return
+        view = memoryview(data)
+        chunks = PeekPoke._split_hub_range(hub_address, count, info.max_atomic_write)
+        self._write_hub_chunks((address, view[address-hub_address:address-hub_address+atomic_count]) for address, atomic_count in chunks)
+
+    def _write_hub_chunks(self, chunks):
+        # Sends a writeHub command for each (hub_address, data) tuple in the
+        #  iterable chunks, which is consumed lazily. Each data item must satisfy
+        #  the assumptions of _write_hub. Buffered combined writes are sent first.
+        self._flush_combined()
+        self._send_write_chunks(chunks)
+
+    def _send_write_chunks(self, chunks):
+        # The body of _write_hub_chunks, also used to send combined writes.
+        if self._prefetcher is not None:
+            self._prefetcher.invalidate()
+        addresses = []
+        def commands():
+            for address, data in chunks:
+                addresses.append(address)
+                yield PeekPoke._write_hub_command(address, data)
+        for index, transaction in enumerate(self._send_commands(2, commands())):
+            transaction.hub_address = addresses[index]
+            PeekPoke._verify_essentials(transaction, 4, 4)
+
     def _read_hub_str(self, hub_address, max_bytes):
         # It is assumed that hub_address is in [0, 65535] and count is in [0, max_atomic_read],
         #  and there is no wrap around.
-        cmd_data = hub_address.to_bytes(2, 'little') + max_bytes.to_bytes(2, 'little')
-        transaction = self._send_command(3, cmd_data)
+        self._flush_combined_range(hub_address, max_bytes)
+        transaction = self._send_payload(3, _HUB_COMMAND.pack(_READ_HUB_STR_PREFIX, hub_address, max_bytes))
+        transaction.hub_address = hub_address
         transaction.max_bytes = max_bytes
         return PeekPoke._parse_read_hub_str(transaction)
 
@@ -336,17 +991,205 @@ class PeekPoke():
     def _payload_exec(self, block, response_expected=True):
         if len(block) < 8:
             raise ValueError("The block argument to payload_exec must have at least eight bytes.")
+        # Executed code may read or change hub memory.
+        self._flush_combined()
+        if self._prefetcher is not None:
+            self._prefetcher.invalidate()
         return self._send_command(8, block, response_expected)
         
     def _send_command(self, command_code, data=None, response_expected=True):
-        command = bytearray(b'\x70\x70\x00') + command_code.to_bytes(1, 'little')
-        if data is not None:
-            command += data
-        transaction = self._host.send_command(address=self._address, port=self._port, payload=command, response_expected=response_expected, context=command)
+        return self._send_payload(command_code, PeekPoke._compose_command(command_code, data), response_expected)
+
+    def _send_payload(self, command_code, command, response_expected=True):
+        # Sends a complete command payload and returns the transaction.
+        if self._host is None or self._cache_entry is not None:
+            return self._send_first_payload(command_code, command, response_expected)
+        metrics = self._metrics
+        if metrics is None:
+            transaction = self._host.send_command(address=self._address, port=self._port, payload=command, response_expected=response_expected, context=command)
+            transaction.command_code = command_code
+            # The host sets the serial object's baudrate before each command, so it
+            #  is the baudrate just used (and cheaper to get than self.baudrate).
+            self._last_good_baudrate = self._serial.baudrate
+            return transaction
+        start = time.perf_counter()
+        try:
+            transaction = self._host.send_command(address=self._address, port=self._port, payload=command, response_expected=response_expected, context=command)
+        except Exception as e:
+            metrics.record_failure(command_code, len(command), PeekPoke._error_kind(e))
+            raise
+        latency = time.perf_counter() - start
         transaction.command_code = command_code
-        self._last_good_baudrate = self.baudrate
+        transaction.metrics = metrics
+        baudrate = self._serial.baudrate
+        self._last_good_baudrate = baudrate
+        response = transaction.response
+        metrics.record(command_code, len(command), 0 if response is None else len(response), latency, baudrate)
         return transaction
 
+    def _send_first_payload(self, command_code, command, response_expected):
+        # Opens the serial port if necessary, and validates any entry loaded from
+        #  the persistent cache, before sending the command.
+        self._get_host()
+        if self._cache_entry is not None:
+            return self._send_payload_validating(command_code, command, response_expected)
+        return self._send_payload(command_code, command, response_expected)
+
+    def _send_payload_validating(self, command_code, command, response_expected):
+        # Sends the first command after information was loaded from the persistent
+        #  cache. The entry is trusted, so the command is sent without a getInfo
+        #  first. If there is no response, the device was probably reset, so the
+        #  entry is discarded and the command is retried at the original baudrate.
+        #  If the service rejects the command (e.g. with an AccessError) then a
+        #  different program may be running, so the info is fetched again and
+        #  compared with the entry (see _install_fresh_info) before the error is
+        #  raised. If there is any other error the entry is discarded.
+        entry = self._cache_entry
+        self._cache_entry = None
+        try:
+            return self._send_payload(command_code, command, response_expected)
+        except NoResponseError:
+            baudrate = entry['_original_baudrate']
+            self.forget_cached()
+            if baudrate is None:
+                raise
+            self.baudrate = baudrate
+            return self._send_payload(command_code, command, response_expected)
+        except ServiceError:
+            try:
+                self._install_fresh_info(self._get_info())
+            except CrowError:
+                self.forget_cached()
+            raise
+        except CrowError:
+            self.forget_cached()
+            raise
+
+    def _install_fresh_info(self, info):
+        # Installs info just received from the device. If its layout_id or
+        #  identifier differ from the info held (which may have been loaded from
+        #  the persistent cache) then a different device or program is at the
+        #  location, so the entry (including its timings) is discarded. The cache
+        #  is updated either way.
+        cached = self._info
+        if cached is not None and (bytes(cached.layout_id) != bytes(info.layout_id) or cached.identifier != info.identifier):
+            self.forget_cached()
+        self._info = info
+        if self._cache is not None:
+            self._store_cache_entry(self._last_good_baudrate)
+
+    def _send_commands(self, command_code, commands):
+        # Sends each command payload in the iterable commands and yields the
+        #  transactions in order. Payloads are consumed lazily. If the pipeline
+        #  window is greater than 1 then several commands are kept in flight. If a
+        #  response is lost, or the device reports that it is busy or low on
+        #  resources, the commands still lacking responses are resent one at a
+        #  time and the window reverts to 1 (stop-and-wait), since the device
+        #  evidently cannot buffer that many commands.
+        commands = iter(commands)
+        if self._host is None or self._cache_entry is not None:
+            # The first command is sent alone (see _send_first_payload).
+            command = next(commands, None)
+            if command is None:
+                return
+            yield self._send_payload(command_code, command)
+        if self._pipeline_window > 1:
+            try:
+                yield from self._send_pipelined(command_code, commands, self._pipeline_window)
+            except _PipelineStall as stall:
+                self._pipeline_window = 1
+                if self._metrics is not None:
+                    self._metrics.record_retries(command_code, len(stall.unanswered))
+                for command in stall.unanswered:
+                    yield self._send_payload(command_code, command)
+        for command in commands:
+            yield self._send_payload(command_code, command)
+
+    def _send_pipelined(self, command_code, commands, window):
+        # Keeps up to window commands in flight, yielding the transactions in order.
+        #  Raises _PipelineStall if the next expected response does not arrive.
+        # This bypasses Host.send_command (which waits for each response), so it
+        #  builds packets and parses responses with crow's own objects.
+        from crow.parser import Parser
+        from crow.transaction import Transaction
+        info = self.get_info()
+        serial_port = self._host.serial_port
+        ser = serial_port.serial
+        baudrate = serial_port.get_baudrate(self._address)
+        transaction_timeout = serial_port.get_transaction_timeout(self._address)
+        propcr_order = serial_port.get_propcr_order(self._address)
+        seconds_per_byte = 10.0 / baudrate
+        # The allowance for a response is based on the largest possible readHub response.
+        response_allowance = info.max_atomic_read + 16
+        ser.reset_input_buffer()
+        ser.baudrate = baudrate
+        parser = Parser()
+        metrics = self._metrics
+        in_flight = []
+        responses = {}
+        deadline = None
+        pending = next(commands, None)
+        while pending is not None or len(in_flight) > 0:
+            while pending is not None and len(in_flight) < window:
+                transaction = Transaction()
+                transaction.new_command(self._address, self._port, pending, True, self._pipeline_token, propcr_order)
+                transaction.command_code = command_code
+                transaction.context = pending
+                if metrics is not None:
+                    transaction.metrics = metrics
+                    transaction.sent_time = time.perf_counter()
+                self._pipeline_token = (self._pipeline_token + 1)%256
+                ser.write(transaction.cmd_packet_buff[0:transaction.cmd_packet_size])
+                in_flight.append(transaction)
+                pending = next(commands, None)
+                deadline = None
+            now = time.perf_counter()
+            if deadline is None:
+                # The deadline is extended whenever there is progress.
+                in_flight_bytes = sum(t.cmd_packet_size + response_allowance for t in in_flight)
+                deadline = now + transaction_timeout + seconds_per_byte*in_flight_bytes
+            elif now >= deadline:
+                PeekPoke._drain_pipeline(ser, transaction_timeout)
+                raise _PipelineStall(in_flight, pending)
+            ser.timeout = deadline - now
+            for item in parser.parse_data(ser.read(parser.min_bytes_expected)):
+                if item['type'] == 'response' or item['type'] == 'error':
+                    # Stale responses with unknown tokens are ignored.
+                    for transaction in in_flight:
+                        if transaction.token == item['token']:
+                            responses[item['token']] = item
+                            break
+            while len(in_flight) > 0:
+                head = in_flight[0]
+                item = responses.pop(head.token, None)
+                if item is None:
+                    if len(responses) > 0:
+                        # A later command was answered first, so the head was lost.
+                        PeekPoke._drain_pipeline(ser, transaction_timeout)
+                        raise _PipelineStall(in_flight, pending)
+                    break
+                if item['type'] == 'error':
+                    # The response was corrupted.
+                    PeekPoke._drain_pipeline(ser, transaction_timeout)
+                    raise _PipelineStall(in_flight, pending)
+                head.response = item['payload']
+                if item['is_error']:
+                    try:
+                        self._host._raise_error(head, head.context)
+                    except (DeviceUnavailableError, DeviceLowResourcesError, ServiceLowResourcesError):
+                        PeekPoke._drain_pipeline(ser, transaction_timeout)
+                        raise _PipelineStall(in_flight, pending)
+                    except Exception as e:
+                        if metrics is not None:
+                            metrics.record_failure(command_code, len(head.context), PeekPoke._error_kind(e))
+                        raise
+                in_flight.pop(0)
+                deadline = None
+                self._last_good_baudrate = baudrate
+                if metrics is not None:
+                    metrics.record(command_code, len(head.context), len(head.response), time.perf_counter() - head.sent_time, baudrate)
+                yield head
+
     def _custom_error_callback(self, address, port, number, details, context):
         # This method is called if the host receives an error response with
         #  numbers 128 to 255. The host will raise a generic ServiceError if
@@ -378,8 +1221,241 @@ class PeekPoke():
             raise AccessError(self._address, self._port, number, details)
 
 
+    # Internal Hub Memory Methods
+
+    def _read_bytes(self, hub_address, count, atomic):
+        # Reads hub memory into a new bytearray, using the shadow if appropriate.
+        #  Hub args must have already been verified.
+        result = bytearray(count)
+        self._read_bytes_into(hub_address, memoryview(result), atomic)
+        return result
+
+    def _read_bytes_into(self, hub_address, view, atomic):
+        # Reads hub memory into the writable byte memoryview, using the shadow if
+        #  appropriate. Hub args must have already been verified.
+        shadow = self._shadow
+        count = len(view)
+        if not self._shadow_applies(hub_address, count, True, atomic):
+            self._flush_shadow_range(hub_address, count)
+            # Combined writes must be sent before the read-ahead window is consulted.
+            self._flush_combined_range(hub_address, count)
+            if self._prefetcher is None:
+                self._read_hub_into(hub_address, view)
+            else:
+                self._read_hub_into_prefetching(hub_address, view)
+            return
+        missing = shadow.missing_ranges(hub_address, count)
+        if len(missing) == 0:
+            shadow.hits += 1
+        else:
+            shadow.misses += 1
+            # Whole pages are reread, so the dirty bytes anywhere in those pages
+            #  (not just in the requested range) are flushed first so that they
+            #  are not overwritten.
+            for address, n in missing:
+                self._flush_shadow_range(address, n)
+            info = self.get_info()
+            memory = memoryview(shadow.memory)
+            for address, n in missing:
+                # Whole pages are read, but only within the allowed read range.
+                #  The pages are invalid, so they may be read into directly.
+                start = max(address, info.min_read_address)
+                end = min(address + n, info.max_read_address + 1)
+                self._read_hub_into(start, memory[start:end])
+                shadow.mark_valid(start, end - start)
+        view[:] = memoryview(shadow.memory)[hub_address:hub_address+count]
+
+    def _read_hub_into_prefetching(self, hub_address, view):
+        # Reads hub memory into view, using and extending the read-ahead window
+        #  (see ReadAhead).
+        prefetcher = self._prefetcher
+        count = len(view)
+        data = prefetcher.lookup(hub_address, count)
+        if data is not None:
+            view[:] = data
+            prefetcher.observe(hub_address, count)
+            return
+        info = self.get_info()
+        window_size = min(info.max_atomic_read, info.max_read_address + 1 - hub_address, 65536 - hub_address)
+        extend = count < window_size and prefetcher.should_extend(hub_address, count, window_size)
+        prefetcher.observe(hub_address, count)
+        if not extend:
+            self._read_hub_into(hub_address, view)
+            return
+        window = bytearray(window_size)
+        self._read_hub_into(hub_address, memoryview(window))
+        view[:] = memoryview(window)[0:count]
+        prefetcher.store(hub_address, window, count)
+
+    def _write_bytes(self, hub_address, data, atomic):
+        # Writes hub memory, using the shadow and write combining if appropriate.
+        #  Hub args must have already been verified.
+        shadow = self._shadow
+        if shadow is None:
+            if self._combiner is None or not self._combine_write(hub_address, data, atomic):
+                self._write_hub_multiple(hub_address, data)
+            return
+        count = len(data)
+        is_volatile = shadow.is_volatile(hub_address, count)
+        if shadow.write_back and not is_volatile and self._shadow_applies(hub_address, count, False, atomic):
+            shadow.write(hub_address, data)
+            return
+        try:
+            if self._combiner is None or not self._combine_write(hub_address, data, atomic):
+                self._write_hub_multiple(hub_address, data)
+        except BaseException:
+            # Some of the data may have been written.
+            shadow.invalidate(hub_address, count)
+            raise
+        if not is_volatile:
+            shadow.update(hub_address, data)
+
+    def _combine_write(self, hub_address, data, atomic):
+        # Buffers the write in the write combiner, sending any spans that must
+        #  go now. Returns False if the write may not be buffered, in which case
+        #  it must be sent directly.
+        combiner = self._combiner
+        info = self.get_info()
+        count = len(data)
+        limit = combiner.limit(info.max_atomic_write)
+        if atomic or count == 0 or count >= limit or hub_address < info.min_write_address or hub_address + count > info.max_write_address + 1:
+            return False
+        now = time.monotonic()
+        spans = combiner.take(hub_address, 0, now)
+        spans += combiner.add(hub_address, data, limit, now)
+        self._send_combined(spans)
+        return True
+
+    def _flush_combined_range(self, hub_address, count):
+        # Sends any combined writes overlapping the range, and any that are too old.
+        combiner = self._combiner
+        if combiner is not None and combiner.pending:
+            self._send_combined(combiner.take(hub_address, count, time.monotonic()))
+
+    def _flush_combined(self):
+        combiner = self._combiner
+        if combiner is not None and combiner.pending:
+            self._send_combined(combiner.take_all())
+
+    def _send_combined(self, spans):
+        # Sends a list of (hub_address, data) spans taken from the write combiner.
+        if len(spans) == 0:
+            return
+        try:
+            self._send_write_chunks(spans)
+        except BaseException:
+            if self._shadow is not None:
+                for address, data in spans:
+                    self._shadow.invalidate(address, len(data))
+            raise
+
+    def _flush_shadow_range(self, hub_address, count):
+        # Writes any dirty shadow bytes in the range to the device.
+        shadow = self._shadow
+        if shadow is None or not shadow.has_dirty:
+            return
+        for address, n in shadow.dirty_ranges(hub_address, count):
+            self._write_hub_multiple(address, shadow.memory[address:address+n])
+            shadow.clear_dirty(address, n)
+
+    def _shadow_applies(self, hub_address, count, is_read, atomic):
+        # Returns True if the shadow may serve (for reads) or buffer (for writes)
+        #  the given range.
+        shadow = self._shadow
+        if shadow is None or atomic or count == 0:
+            return False
+        info = self.get_info()
+        last_address = hub_address + count - 1
+        if is_read:
+            if hub_address < info.min_read_address or last_address > info.max_read_address:
+                return False
+        else:
+            if hub_address < info.min_write_address or last_address > info.max_write_address:
+                return False
+        return not shadow.is_volatile(hub_address, count)
+
+    def _load_cache_entry(self):
+        # Loads the persistent cache entry (if any) for the current location. The
+        #  entry is not validated until the next command is sent.
+        self._cache_entry = None
+        self._cached_timings = None
+        if self._cache is None:
+            return
+        entry = self._cache.lookup(self.serial_port_name, self._address, self._port)
+        if entry is None:
+            return
+        try:
+            info = PeekPokeInfo(bytes.fromhex(entry['info']))
+            timings = None
+            if entry.get('timings') is not None:
+                timings = (SerialTimings(data=bytes.fromhex(entry['timings'])), entry['timings_baudrate'])
+        except (KeyError, TypeError, ValueError, IndexError):
+            # A damaged entry is ignored.
+            return
+        self._info = info
+        self._cached_timings = timings
+        # A fallback baudrate is remembered in case the device has been reset since
+        #  the entry was stored. It is the current baudrate, or the serial port's
+        #  default if another object has already switched to the cached baudrate.
+        entry['_original_baudrate'] = None
+        baudrate = entry.get('baudrate')
+        if baudrate is not None:
+            fallback = self.baudrate
+            if fallback == baudrate:
+                fallback = _DEFAULT_BAUDRATE if self._host is None else self._host.serial_port.default_baudrate
+            if fallback != baudrate:
+                entry['_original_baudrate'] = fallback
+            self.baudrate = baudrate
+        self._cache_entry = entry
+
+    def _store_cache_entry(self, baudrate):
+        # Records the current info (and timings, if known) in the persistent cache.
+        #  A device with a different layout_id or identifier at the same location
+        #  replaces the old entry.
+        if self._info is None:
+            return
+        timings = None
+        timings_baudrate = None
+        if self._cached_timings is not None:
+            timings, timings_baudrate = self._cached_timings
+        self._cache.store(self.serial_port_name, self._address, self._port, self._info, baudrate=baudrate, timings=timings, timings_baudrate=timings_baudrate)
+
+    def _reset_prefetch(self):
+        if self._prefetcher is not None:
+            self._prefetcher.invalidate()
+
+    def _reset_write_combining(self):
+        # Called when the device changes. Buffered writes are discarded, as for the
+        #  shadow's.
+        if self._combiner is not None:
+            self._combiner.discard()
+
+    def _reset_shadow(self):
+        # Called when the device changes. Buffered writes are discarded since they
+        #  were intended for the previous device.
+        if self._shadow is not None:
+            self._shadow.reset()
+
+
     # Internal Helper Methods
 
+    def _timings_for_baudrate(self, baudrate, clkfreq):
+        # Returns the SerialTimings for the given baudrate. Raises ValueError if the
+        #  baudrate is too fast for clkfreq.
+        two_bit_period = int((2 * clkfreq) / baudrate)
+        if two_bit_period < 52:
+            raise ValueError("A baudrate of " + str(baudrate) + " bps is too fast given a clkfreq of " + str(clkfreq) + " MHz.")
+        timings = SerialTimings()
+        timings.bit_period_0 = two_bit_period >> 1
+        timings.bit_period_1 = timings.bit_period_0 + (two_bit_period & 1)
+        timings.start_bit_wait = max((timings.bit_period_0 >> 1) - 10, 5)
+        timings.stop_bit_duration = int((10*clkfreq) / baudrate) - 5*timings.bit_period_0 - 4*timings.bit_period_1 + 1
+        timings.interbyte_timeout = max(int(clkfreq/1000), 2*two_bit_period)  # max of 1ms or 4 bit periods
+        timings.recovery_time = two_bit_period << 3
+        # For the break multiple, use 1/2 of self._break_duration for dependable detection.
+        timings.break_multiple = int((self._break_duration * clkfreq/2000) / timings.recovery_time)
+        return timings
+
     def _verify_hub_args(self, hub_address, count, is_read, atomic):
         # Used by hub memory methods to verify arguments.
         if hub_address < 0 or hub_address > 65535:
@@ -409,22 +1485,176 @@ class PeekPoke():
         # Call before the host or address will change.
         # Reversion occurs only if there has not been a successful communication
         #  with the host and address.
-        if self._last_good_baudrate is None:
+        if self._host is not None and self._last_good_baudrate is None:
             self._host.serial_port.set_propcr_order(self._address, self._prev_propcr_order)
 
     def _select_propcr_order(self):
         # Call after the host or address has changed.
-        self._prev_propcr_order = self._host.serial_port.get_propcr_order(self._address)
-        self._host.serial_port.set_propcr_order(self._address, True)
+        if self._host is not None:
+            self._prev_propcr_order = self._host.serial_port.get_propcr_order(self._address)
+            self._host.serial_port.set_propcr_order(self._address, True)
+
+
+    # Serial Port Opening Methods
+
+    def warm_up(self, *, get_info=True):
+        """Starts opening the serial port, and fetching the device info, in a background thread."""
+        # The thread works on its own host object, which is only installed when
+        #  the PeekPoke object is next used (any use that needs the port waits for
+        #  the thread to finish). If the port could not be opened the error is
+        #  raised by that use. If getInfo failed the error is logged and the
+        #  command is sent again when the info is needed.
+        # If info was loaded from the persistent cache then the fresh info
+        #  validates (or replaces) it.
+        if self._host is not None or self._warm_up_state is not None:
+            return
+        import threading
+        baudrate = self.baudrate
+        state = {'host': None, 'baudrate': baudrate}
+        args = (state, self._serial_port_name, self._address, self._port, baudrate, get_info)
+        state['thread'] = threading.Thread(target=self._warm_up_run, args=args, name='peekpoke-warm-up', daemon=True)
+        self._warm_up_state = state
+        state['thread'].start()
+
+    def _warm_up_run(self, state, serial_port_name, address, port, baudrate, get_info):
+        # Runs in the warm up thread. The serial port's settings for the address
+        #  are shared with any other hosts using the port, so the ones getInfo
+        #  needs are only set for that command and then restored. _finish_warm_up
+        #  applies them on the calling thread.
+        try:
+            host = self._create_host(serial_port_name)
+        except Exception as e:
+            state['open_error'] = e
+            return
+        state['host'] = host
+        if not get_info:
+            return
+        serial_port = host.serial_port
+        prev_propcr_order = serial_port.get_propcr_order(address)
+        prev_baudrate = serial_port.get_baudrate(address)
+        try:
+            serial_port.set_propcr_order(address, True)
+            serial_port.set_baudrate(address, baudrate)
+            transaction = host.send_command(address=address, port=port, payload=PeekPoke._compose_command(0, None), context=None)
+            transaction.command_code = 0
+            state['info'] = PeekPoke._parse_get_info(transaction)
+        except Exception as e:
+            state['info_error'] = e
+        finally:
+            serial_port.set_propcr_order(address, prev_propcr_order)
+            serial_port.set_baudrate(address, prev_baudrate)
+
+    def _finish_warm_up(self, *, raise_error=True):
+        # Waits for the warm up thread (if any) and installs its host, applying the
+        #  serial port settings. If the thread could not open the port the error is
+        #  raised, unless raise_error is False (the location is being changed).
+        state = self._warm_up_state
+        if state is None:
+            return
+        self._warm_up_state = None
+        state['thread'].join()
+        open_error = state.get('open_error')
+        if open_error is not None:
+            if raise_error:
+                raise open_error
+            return
+        if self._host is not None:
+            return
+        host = state['host']
+        self._host = host
+        self._serial = host.serial_port.serial
+        self._select_propcr_order()
+        baudrate = state['baudrate'] if self._pending_baudrate is None else self._pending_baudrate
+        host.serial_port.set_baudrate(self._address, baudrate)
+        self._pending_baudrate = None
+        info_error = state.get('info_error')
+        if info_error is not None:
+            import logging
+            logging.getLogger(__name__).warning("PeekPoke warm up: getInfo failed (it will be sent again when needed): " + str(info_error))
+        info = state.get('info')
+        if info is not None:
+            self._last_good_baudrate = state['baudrate']
+            self._cache_entry = None
+            self._install_fresh_info(info)
+
+    def _get_host(self):
+        # Returns the host, opening the serial port if necessary.
+        if self._host is None:
+            self._finish_warm_up()
+            if self._host is None:
+                self._host = self._create_host(self._serial_port_name)
+                self._serial = self._host.serial_port.serial
+                self._select_propcr_order()
+                if self._pending_baudrate is not None:
+                    self._host.serial_port.set_baudrate(self._address, self._pending_baudrate)
+                    self._pending_baudrate = None
+        return self._host
+
+    def _create_host(self, serial_port_name):
+        from crow.host import Host
+        host = Host(serial_port_name)
+        host.custom_service_error_callback = self._custom_error_callback
+        return host
+
+    def _unopened_baudrate(self):
+        # The baudrate that will be used once the serial port is opened. If another
+        #  object already has the port open then its settings apply.
+        if self._pending_baudrate is not None:
+            return self._pending_baudrate
+        host_module = sys.modules.get('crow.host')
+        if host_module is not None:
+            for serial_port in list(host_module.Host._serial_ports):
+                if serial_port.name == self._serial_port_name:
+                    return serial_port.get_baudrate(self._address)
+        return _DEFAULT_BAUDRATE
 
 
     # Static Internal Helper Methods
 
+    @staticmethod
+    def _decode_str(result, encoding, errors, nul_terminated):
+        # result ends at the terminating NUL, if there is one.
+        if len(result) == 0:
+            return ''
+        if nul_terminated and result[-1] == 0:
+            return result[:-1].decode(encoding=encoding, errors=errors)
+        else:
+            return result.decode(encoding=encoding, errors=errors)
+
+    @staticmethod
+    def _encode_str(max_bytes, string, encoding, errors, nul_terminated, truncate):
+        if max_bytes <= 0:
+            raise ValueError("max_bytes must be greater than zero.")
+        data = string.encode(encoding=encoding, errors=errors)
+        if nul_terminated:
+            if len(data) >= max_bytes:
+                if truncate:
+                    data = bytearray(data[0:max_bytes-1]) + b'\x00'
+                else:
+                    raise ValueError("The encoded string size (" + str(len(data)) + ") plus the terminating NUL exceeds the max_bytes limit (" + str(max_bytes) + ").")
+            else:
+                data = bytearray(data) + b'\x00'
+        else:
+            if len(data) > max_bytes:
+                if truncate:
+                    data = data[0:max_bytes]
+                else:
+                    raise ValueError("The encoded string size (" + str(len(data)) + ") exceeds the max_bytes limit (" + str(max_bytes) + ").")
+        return data
+
     @staticmethod
     def _verify_int_length(length):
         if length != 1 and length != 2 and length != 4 and length != 8:
             raise ValueError("Valid integer lengths are 1, 2, 4, and 8 bytes.")
 
+    @staticmethod
+    def _verify_struct_alignment(hub_address, layout, alignment):
+        if alignment == 'layout':
+            if hub_address % layout.record_alignment != 0:
+                raise ValueError("The hub address is not aligned to the layout's record alignment (alignment='layout' selected).")
+            return
+        PeekPoke._verify_int_alignment(hub_address, 1, alignment)
+
     @staticmethod
     def _verify_int_alignment(hub_address, length, alignment):
         if alignment == 'length':
@@ -443,11 +1673,194 @@ class PeekPoke():
             return
         raise ValueError("Valid alignment options are 'length', 'byte', 'word', and 'long'.")
 
+    @staticmethod
+    def _ints_struct(length, count, byteorder, signed):
+        # Returns a struct.Struct for count integers, using standard sizes.
+        if byteorder == 'little':
+            prefix = '<'
+        elif byteorder == 'big':
+            prefix = '>'
+        else:
+            raise ValueError("byteorder must be either 'little' or 'big'")
+        code = _INT_CODES[length]
+        if signed:
+            code = code.lower()
+        return struct.Struct(prefix + str(count) + code)
+
+    @staticmethod
+    def _ints_from_bytes(data, length, count, byteorder, signed):
+        # The integers are unpacked in a single call rather than one at a time.
+        return list(PeekPoke._ints_struct(length, count, byteorder, signed).unpack_from(data))
+
+    @staticmethod
+    def _ints_to_bytes(integers, length, byteorder, signed):
+        if not isinstance(integers, (list, tuple)):
+            integers = list(integers)
+        try:
+            return PeekPoke._ints_struct(length, len(integers), byteorder, signed).pack(*integers)
+        except struct.error:
+            # Fall back to per item conversion so that a bad item raises the
+            #  same exception (e.g. OverflowError) as int.to_bytes.
+            data = bytearray()
+            for i in integers:
+                data += i.to_bytes(length, byteorder, signed=signed)
+            return data
+
+    @staticmethod
+    def _import_numpy():
+        # numpy is an optional dependency, so it is imported only when needed.
+        try:
+            import numpy
+        except ImportError:
+            raise ImportError("The array methods require numpy (pip install peekpoke[numpy]).") from None
+        return numpy
+
+    @staticmethod
+    def _verify_array_dtype(numpy, dtype):
+        dtype = numpy.dtype(dtype)
+        if dtype.kind != 'i' and dtype.kind != 'u':
+            raise ValueError("The array dtype must be a signed or unsigned integer type.")
+        PeekPoke._verify_int_length(dtype.itemsize)
+        return dtype
+
+    @staticmethod
+    def _pad_token(token, use_padding):
+        if len(token) < 4:
+            if use_padding:
+                new_token = bytearray(4)
+                new_token[0:len(token)] = token[0:]
+                return new_token
+            else:
+                raise ValueError("The token must be exactly four bytes if padding is not used.")
+        elif len(token) > 4:
+            raise ValueError("Too many bytes provided -- the token is a four-byte value.")
+        return token
+
+    @staticmethod
+    def _byte_view(buffer):
+        # Returns a writable, one dimensional memoryview of unsigned bytes for the
+        #  buffer object.
+        view = memoryview(buffer)
+        if view.readonly:
+            raise ValueError("The buffer must be writable.")
+        if not view.c_contiguous:
+            raise ValueError("The buffer must be contiguous.")
+        if view.format != 'B' or view.ndim != 1:
+            view = view.cast('B')
+        return view
+
+    @staticmethod
+    def _default_max_gap(baudrate):
+        # Estimates how many extra bytes can be read for the cost of one more
+        #  readHub command. Each command adds about 24 bytes of headers and
+        #  checkbytes, plus the host's turnaround time, which is taken to be 1 ms
+        #  (typical for USB serial adapters). There are 10 bits per byte.
+        return 24 + baudrate // 10000
+
+    @staticmethod
+    def _diff_ranges(old, new, gap_threshold):
+        # Returns a list of (index, count) tuples for the runs where the two
+        #  equal-length bytes-like objects differ. Runs separated by gap_threshold
+        #  or fewer equal bytes are merged.
+        old = memoryview(old)
+        new = memoryview(new)
+        size = len(new)
+        ranges = []
+        run_start = None
+        run_end = None
+        block = 64
+        index = 0
+        while index < size:
+            block_end = min(index + block, size)
+            # Equal blocks are skipped quickly using slice comparison.
+            if old[index:block_end] != new[index:block_end]:
+                for i in range(index, block_end):
+                    if old[i] != new[i]:
+                        if run_start is None:
+                            run_start = i
+                        elif i - run_end > gap_threshold:
+                            ranges.append((run_start, run_end - run_start))
+                            run_start = i
+                        run_end = i + 1
+            index = block_end
+        if run_start is not None:
+            ranges.append((run_start, run_end - run_start))
+        return ranges
+
+    @staticmethod
+    def _error_kind(error):
+        # Classifies an exception for CommandMetrics.
+        if isinstance(error, AccessError):
+            return 'access_error'
+        if isinstance(error, PeekPokeError):
+            return 'peekpoke_error'
+        return 'other_error'
+
+    @staticmethod
+    def _drain_pipeline(ser, quiet_time):
+        # Called before falling back to stop-and-wait. Responses to commands still
+        #  in flight would otherwise arrive during the next transaction, so input
+        #  is discarded until the line has been quiet for quiet_time seconds.
+        ser.timeout = quiet_time
+        while len(ser.read(4096)) > 0:
+            pass
+
+    @staticmethod
+    def _split_span(start, end, entries, max_count):
+        # Like _split_hub_range, but each split point is moved back, if possible,
+        #  to avoid dividing an entry (a (start, end) tuple) no longer than
+        #  max_count. Returns a list of (hub_address, count) tuples.
+        chunks = []
+        address = start
+        while address < end:
+            split = min(address + max_count, end)
+            if split < end:
+                for entry_start, entry_end in entries:
+                    if entry_start < split < entry_end and entry_end - entry_start <= max_count and entry_start > address:
+                        split = min(split, entry_start)
+            chunks.append((address, split - address))
+            address = split
+        return chunks
+
+    @staticmethod
+    def _split_hub_range(hub_address, count, max_count):
+        # Returns a list of (hub_address, count) tuples covering the range in
+        #  pieces of at most max_count bytes.
+        chunks = []
+        while count > 0:
+            atomic_count = min(count, max_count)
+            count -= atomic_count
+            chunks.append((hub_address, atomic_count))
+            hub_address = (hub_address + atomic_count)%65536
+        return chunks
+
+    @staticmethod
+    def _write_hub_command(hub_address, data):
+        # Returns the writeHub command payload for data, which may be any bytes-like object.
+        count = len(data)
+        command = bytearray(8 + count)
+        _HUB_COMMAND.pack_into(command, 0, _WRITE_HUB_PREFIX, hub_address, count)
+        command[8:] = data
+        return command
+
+    @staticmethod
+    def _compose_command(command_code, data):
+        # data may be None or a bytes-like object.
+        command = bytearray(b'\x70\x70\x00') + command_code.to_bytes(1, 'little')
+        if data is not None:
+            command += data
+        return command
+
     @staticmethod
     def _verify_essentials(transaction, min_size, max_size):
         # Verifies that the response has a valid initial header, and that its
         #  size is in the expected range (which may be open ended at both limits).
         rsp = transaction.response
+        size = len(rsp)
+        if size >= 4 and rsp[0] == 0x70 and rsp[1] == 0x70 and rsp[2] == 0x00 and rsp[3] == transaction.command_code:
+            if (min_size is None or size >= min_size) and (max_size is None or size <= max_size):
+                return
+        # The checks are repeated in detail to report the problem.
         if len(rsp) == 0:
             raise PeekPokeError(transaction, "The response is empty.")
         if len(rsp) < 4:
@@ -466,6 +1879,15 @@ class PeekPoke():
         PeekPoke._verify_essentials(transaction, 30, None)
         return PeekPokeInfo(transaction.response)
 
+    @staticmethod
+    def _copy_read_hub(transaction, hub_address, view):
+        # Verifies a readHub response for the given chunk and copies its data into view.
+        count = len(view)
+        transaction.hub_address = hub_address
+        transaction.count = count
+        PeekPoke._verify_essentials(transaction, count + 4, count + 4)
+        view[:] = memoryview(transaction.response)[4:]
+
     @staticmethod
     def _parse_read_hub(transaction):
         expected_size = transaction.count + 4
@@ -507,10 +1929,29 @@ class PeekPokeError(ClientError):
     def __init__(self, transaction, message):
         super().__init__(transaction.address, transaction.port, message)
         self.command_code = transaction.command_code
+        self.hub_address = getattr(transaction, 'hub_address', None)
+        # Errors found while parsing a response are counted by the metrics
+        #  collector that recorded the command, if any.
+        metrics = getattr(transaction, 'metrics', None)
+        if metrics is not None:
+            metrics.record_error(self.command_code, 'peekpoke_error')
     def __str__(self):
+        if self.hub_address is not None:
+            return super().extra_str() + " Command code: " + str(self.command_code) + ", hub address: " + str(self.hub_address) + "."
         return super().extra_str() + " Command code: " + str(self.command_code) + "."
 
 
+class _PipelineStall(Exception):
+    # Raised internally when pipelined commands must fall back to stop-and-wait.
+    #  unanswered holds the payloads, in order, of the commands that still
+    #  need to be sent (including the one taken from the iterator but not sent).
+    def __init__(self, in_flight, pending):
+        super().__init__()
+        self.unanswered = [t.context for t in in_flight]
+        if pending is not None:
+            self.unanswered.append(pending)
+
+
 class PeekPokeInfo():
 
     def __init__(self, response=None):
@@ -531,6 +1972,22 @@ class PeekPokeInfo():
         self.serial_timings_format = response[28]
         self.peekpoke_version = response[29]
 
+    def as_bytes(self):
+        # Returns the info in the format of a getInfo response.
+        data = bytearray(b'\x70\x70\x00\x00')
+        data += self.max_atomic_read.to_bytes(2, 'little')
+        data += self.max_atomic_write.to_bytes(2, 'little')
+        data += self.min_read_address.to_bytes(2, 'little')
+        data += self.max_read_address.to_bytes(2, 'little')
+        data += self.min_write_address.to_bytes(2, 'little')
+        data += self.max_write_address.to_bytes(2, 'little')
+        data += self.layout_id
+        data += self.identifier.to_bytes(4, 'little')
+        data += self.par.to_bytes(2, 'little')
+        data += self.available_commands_bitmask.to_bytes(2, 'little')
+        data += bytes([self.serial_timings_format, self.peekpoke_version])
+        return data
+
     def __str__(self):
         return "PeekPoke instance info, max_atomic_read: " + str(self.max_atomic_read) + ", max_atomic_write: " + str(self.max_atomic_write) + ", min_read_address: " + str(self.min_read_address) + ", max_read_address: " + str(self.max_read_address) + ", min_write_address: " + str(self.min_write_address) + ", max_write_address: " +str(self.max_write_address) + ", layout_id: [" + self.layout_id.hex() + "], identifier: " + str(self.identifier) + ", par: " + str(self.par) + ", available_commands_bitmask: {:#4x}".format(self.available_commands_bitmask) + ", serial_timings_format: " + str(self.serial_timings_format) + ", peekpoke_version: " + str(self.peekpoke_version) + "."
 
@@ -0,0 +1,376 @@
+# aio.py
+# Asyncio front-end for PeekPoke
+# source: https://github.com/chris-siedell/PeekPoke
+# python: https://pypi.org/project/peekpoke/
+# homepage: http://siedell.com/projects/PeekPoke/
+
+
+import asyncio
+import functools
+import time
+import weakref
+
+from crow.errors import NoResponseError
+from crow.parser import Parser
+from crow.transaction import Transaction
+
+from peekpoke import PeekPoke
+from peekpoke import _HUB_COMMAND
+from peekpoke import _READ_HUB_PREFIX
+from peekpoke import _READ_HUB_STR_PREFIX
+
+
+# Commands on the same serial port must not overlap, even if they are for
+#  different addresses, so there is one lock per crow HostSerialPort object.
+_port_locks = weakref.WeakKeyDictionary()
+
+
+# If a transaction is cancelled the device may still be sending its response,
+#  and it ignores commands while it does so. _port_quiet_times holds the time
+#  before which the next command on the port should not be sent.
+_port_quiet_times = weakref.WeakKeyDictionary()
+
+
+def _port_lock(serial_port):
+    lock = _port_locks.get(serial_port)
+    if lock is None:
+        lock = asyncio.Lock()
+        _port_locks[serial_port] = lock
+    return lock
+
+
+def _deadline(method):
+    # Adds a timeout keyword argument (in seconds) to a coroutine method. If the
+    #  call does not finish in time it is cancelled and asyncio.TimeoutError is
+    #  raised. If timeout is None the object's default_timeout is used.
+    @functools.wraps(method)
+    async def wrapper(self, *args, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = self.default_timeout
+        if timeout is None:
+            return await method(self, *args, **kwargs)
+        return await asyncio.wait_for(method(self, *args, **kwargs), timeout)
+    return wrapper
+
+
+class AsyncPeekPoke():
+
+    # AsyncPeekPoke provides awaitable versions of the PeekPoke methods. Serial
+    #  input is read without blocking (using the event loop's reader callbacks
+    #  when the port has a file descriptor, and polling otherwise), so a single
+    #  event loop can drive many devices concurrently.
+    # Commands for the same serial port are serialized. Every method accepts a
+    #  timeout keyword argument that sets a deadline for the whole call. A
+    #  cancelled call may leave a multi-command operation partially performed;
+    #  any stray response is discarded by the next command.
+    # The underlying PeekPoke object (the peekpoke property) holds the settings
+    #  and cached info. It may be used directly, but not while a call is running.
+
+    def __init__(self, serial_port_name, address=1, port=112, *, default_timeout=None, poll_interval=0.001):
+        self._peekpoke = PeekPoke(serial_port_name, address, port)
+        self.default_timeout = default_timeout
+        self.poll_interval = poll_interval
+        self._next_token = 0
+        self._use_reader = True
+
+    @property
+    def peekpoke(self):
+        return self._peekpoke
+
+    @property
+    def serial_port_name(self):
+        return self._peekpoke.serial_port_name
+
+    @property
+    def address(self):
+        return self._peekpoke.address
+
+    @property
+    def port(self):
+        return self._peekpoke.port
+
+    @property
+    def baudrate(self):
+        return self._peekpoke.baudrate
+
+    @baudrate.setter
+    def baudrate(self, baudrate):
+        self._peekpoke.baudrate = baudrate
+
+
+    # Hub Memory: Binary Data Methods
+
+    @_deadline
+    async def get_bytes(self, hub_address, count, *, atomic=False):
+        info = await self.get_info()
+        self._peekpoke._verify_hub_args(hub_address, count, True, atomic)
+        result = bytearray()
+        for address, atomic_count in PeekPoke._split_hub_range(hub_address, count, info.max_atomic_read):
+            result += await self._read_hub(address, atomic_count)
+        return result
+
+    @_deadline
+    async def get_bytes_into(self, hub_address, buffer, *, atomic=False):
+        view = PeekPoke._byte_view(buffer)
+        count = len(view)
+        info = await self.get_info()
+        self._peekpoke._verify_hub_args(hub_address, count, True, atomic)
+        for address, atomic_count in PeekPoke._split_hub_range(hub_address, count, info.max_atomic_read):
+            index = address - hub_address
+            view[index:index+atomic_count] = await self._read_hub(address, atomic_count)
+        return count
+
+    @_deadline
+    async def set_bytes(self, hub_address, data, *, atomic=False):
+        info = await self.get_info()
+        self._peekpoke._verify_hub_args(hub_address, len(data), False, atomic)
+        view = memoryview(data)
+        for address, atomic_count in PeekPoke._split_hub_range(hub_address, len(view), info.max_atomic_write):
+            index = address - hub_address
+            await self._write_hub(address, view[index:index+atomic_count])
+
+
+    # Hub Memory: String Methods
+
+    @_deadline
+    async def get_str(self, hub_address, max_bytes, *, encoding='latin_1', errors='replace', nul_terminated=True, atomic=False):
+        info = await self.get_info()
+        self._peekpoke._verify_hub_args(hub_address, max_bytes, True, atomic)
+        result = bytearray()
+        for address, atomic_count in PeekPoke._split_hub_range(hub_address, max_bytes, info.max_atomic_read):
+            if nul_terminated:
+                result += await self._read_hub_str(address, atomic_count)
+                if result[-1] == 0:
+                    break
+            else:
+                result += await self._read_hub(address, atomic_count)
+        return PeekPoke._decode_str(result, encoding, errors, nul_terminated)
+
+
+    # Hub Memory: Integer Methods
+
+    @_deadline
+    async def get_int(self, hub_address, length, *, alignment='length', byteorder='little', signed=False):
+        PeekPoke._verify_int_length(length)
+        await self.get_info()
+        self._peekpoke._verify_hub_args(hub_address, length, True, True)
+        PeekPoke._verify_int_alignment(hub_address, length, alignment)
+        data = await self._read_hub(hub_address, length)
+        return int.from_bytes(data, byteorder, signed=signed)
+
+    @_deadline
+    async def set_int(self, hub_address, length, integer, *, alignment='length', byteorder='little', signed=False):
+        PeekPoke._verify_int_length(length)
+        await self.get_info()
+        self._peekpoke._verify_hub_args(hub_address, length, False, True)
+        PeekPoke._verify_int_alignment(hub_address, length, alignment)
+        await self._write_hub(hub_address, integer.to_bytes(length, byteorder, signed=signed))
+
+    @_deadline
+    async def get_ints(self, hub_address, length, count, *, alignment='length', byteorder='little', signed=False, atomic=False):
+        PeekPoke._verify_int_length(length)
+        PeekPoke._verify_int_alignment(hub_address, length, alignment)
+        data = await self.get_bytes(hub_address, count*length, atomic=atomic)
+        return PeekPoke._ints_from_bytes(data, length, count, byteorder, signed)
+
+    @_deadline
+    async def set_ints(self, hub_address, length, integers, *, alignment='length', byteorder='little', signed=False, atomic=False):
+        PeekPoke._verify_int_length(length)
+        PeekPoke._verify_int_alignment(hub_address, length, alignment)
+        data = PeekPoke._ints_to_bytes(integers, length, byteorder, signed)
+        await self.set_bytes(hub_address, data, atomic=atomic)
+
+
+    # Baudrate Methods
+
+    @_deadline
+    async def switch_baudrate(self, baudrate, *, clkfreq=None, use_hub_clkfreq=False):
+        """Sets both the local and remote baudrates."""
+        if clkfreq is None:
+            if use_hub_clkfreq:
+                clkfreq = int.from_bytes(await self._read_hub(0, 4), 'little')
+            else:
+                clkfreq = await self.estimate_clkfreq()
+        timings = self._peekpoke._timings_for_baudrate(baudrate, clkfreq)
+        transaction = await self._send_command(5, timings.as_bytes())
+        PeekPoke._verify_essentials(transaction, 4, 4)
+        self._peekpoke.baudrate = baudrate
+
+    @_deadline
+    async def revert_baudrate(self):
+        """Changes the local baudrate back to the last known good value, and sends a break condition to the Propeller to instruct it to do the same."""
+        # Sending a break blocks, so it is done in the default executor.
+        async with _port_lock(self._peekpoke._get_host().serial_port):
+            await asyncio.get_running_loop().run_in_executor(None, self._peekpoke.revert_baudrate)
+
+    @_deadline
+    async def estimate_clkfreq(self):
+        transaction = await self._send_command(4)
+        timings = PeekPoke._parse_get_serial_timings(transaction)
+        return ( (timings.bit_period_0 + timings.bit_period_1) * self._peekpoke.baudrate) / 2.0
+
+
+    # Token Methods
+
+    @_deadline
+    async def get_token(self, *, byteorder='little', signed=False):
+        token_bytes = await self.get_token_bytes()
+        return int.from_bytes(token_bytes, byteorder, signed=signed)
+
+    @_deadline
+    async def set_token(self, token, *, byteorder='little', signed=False):
+        token_bytes = token.to_bytes(4, byteorder, signed=signed)
+        prev_token_bytes = await self.set_token_bytes(token_bytes)
+        return int.from_bytes(prev_token_bytes, byteorder, signed=signed)
+
+    @_deadline
+    async def get_token_bytes(self):
+        transaction = await self._send_command(6)
+        return PeekPoke._parse_token_command(transaction)
+
+    @_deadline
+    async def set_token_bytes(self, token, *, use_padding=True):
+        token = PeekPoke._pad_token(token, use_padding)
+        transaction = await self._send_command(7, token)
+        return PeekPoke._parse_token_command(transaction)
+
+
+    # Miscellaneous Methods
+
+    @_deadline
+    async def get_par(self, *, use_cached=True):
+        info = await self.get_info(use_cached=use_cached)
+        return info.par
+
+    @_deadline
+    async def get_identifier(self, *, use_cached=True):
+        info = await self.get_info(use_cached=use_cached)
+        return info.identifier
+
+    @_deadline
+    async def get_info(self, *, use_cached=True):
+        pp = self._peekpoke
+        if not use_cached or pp._info is None:
+            transaction = await self._send_command(0)
+            pp._info = PeekPoke._parse_get_info(transaction)
+        return pp._info
+
+
+    # Internal Command Methods
+
+    async def _read_hub(self, hub_address, count):
+        transaction = await self._send_payload(1, _HUB_COMMAND.pack(_READ_HUB_PREFIX, hub_address, count))
+        transaction.hub_address = hub_address
+        transaction.count = count
+        return PeekPoke._parse_read_hub(transaction)
+
+    async def _write_hub(self, hub_address, data):
+        transaction = await self._send_payload(2, PeekPoke._write_hub_command(hub_address, data))
+        transaction.hub_address = hub_address
+        PeekPoke._verify_essentials(transaction, 4, 4)
+
+    async def _read_hub_str(self, hub_address, max_bytes):
+        transaction = await self._send_payload(3, _HUB_COMMAND.pack(_READ_HUB_STR_PREFIX, hub_address, max_bytes))
+        transaction.hub_address = hub_address
+        transaction.max_bytes = max_bytes
+        return PeekPoke._parse_read_hub_str(transaction)
+
+    async def _send_command(self, command_code, data=None):
+        return await self._send_payload(command_code, PeekPoke._compose_command(command_code, data))
+
+    async def _send_payload(self, command_code, command):
+        pp = self._peekpoke
+        serial_port = pp._get_host().serial_port
+        async with _port_lock(serial_port):
+            transaction = await self._transact(serial_port, command)
+        transaction.command_code = command_code
+        pp._last_good_baudrate = pp.baudrate
+        return transaction
+
+    async def _transact(self, serial_port, command):
+        # This follows Host.send_command, except that waiting for the response
+        #  yields to the event loop.
+        address = self._peekpoke.address
+        port = self._peekpoke.port
+        ser = serial_port.serial
+        baudrate = serial_port.get_baudrate(address)
+        transaction_timeout = serial_port.get_transaction_timeout(address)
+        propcr_order = serial_port.get_propcr_order(address)
+
+        quiet_time = _port_quiet_times.get(serial_port)
+        if quiet_time is not None:
+            delay = quiet_time - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            del _port_quiet_times[serial_port]
+
+        ser.reset_input_buffer()
+        ser.baudrate = baudrate
+
+        token = self._next_token
+        self._next_token = (self._next_token + 1)%256
+
+        t = Transaction()
+        t.new_command(address, port, command, True, token, propcr_order)
+        ser.write(t.cmd_packet_buff[0:t.cmd_packet_size])
+
+        parser = Parser()
+        seconds_per_byte = 10.0 / baudrate
+        now = time.perf_counter()
+        time_limit = now + transaction_timeout
+        max_time_limit = time_limit + seconds_per_byte*2084
+        byte_count = 0
+        results = []
+
+        while parser.min_bytes_expected > 0 and now < time_limit:
+            try:
+                data = await self._read_available(ser, time_limit - now)
+            except asyncio.CancelledError:
+                _port_quiet_times[serial_port] = max_time_limit
+                raise
+            byte_count += len(data)
+            results += parser.parse_data(data, token)
+            time_limit = min(time_limit + seconds_per_byte*len(data), max_time_limit)
+            now = time.perf_counter()
+
+        if parser.min_bytes_expected == 0:
+            for item in results:
+                if item['type'] == 'response' and item['token'] == token:
+                    t.response = item['payload']
+                    if item['is_error']:
+                        self._peekpoke._host._raise_error(t, command)
+                    return t
+                elif item['type'] == 'error' and item['token'] == token:
+                    raise NoResponseError(address, port, byte_count, item['message'])
+        raise NoResponseError(address, port, byte_count)
+
+    async def _read_available(self, ser, timeout):
+        # Returns the bytes in the serial port's input buffer, first waiting up to
+        #  timeout seconds for at least one byte to arrive if it is empty.
+        waiting = ser.in_waiting
+        if waiting == 0:
+            loop = asyncio.get_running_loop()
+            fileno = getattr(ser, 'fileno', None)
+            if self._use_reader and fileno is not None:
+                readable = loop.create_future()
+                fd = fileno()
+                try:
+                    loop.add_reader(fd, lambda: readable.done() or readable.set_result(None))
+                except NotImplementedError:
+                    # Some event loops (e.g. the proactor loop on Windows) do not
+                    #  support readers, so fall back to polling.
+                    self._use_reader = False
+                else:
+                    try:
+                        await asyncio.wait_for(readable, timeout)
+                    except asyncio.TimeoutError:
+                        pass
+                    finally:
+                        loop.remove_reader(fd)
+            if not self._use_reader or fileno is None:
+                await asyncio.sleep(min(self.poll_interval, timeout))
+            waiting = ser.in_waiting
+        if waiting == 0:
+            return b''
+        return ser.read(waiting)
+
@@ -0,0 +1,275 @@
+# batch.py
+# Batched hub memory operations for PeekPoke
+# source: https://github.com/chris-siedell/PeekPoke
+# python: https://pypi.org/project/peekpoke/
+# homepage: http://siedell.com/projects/PeekPoke/
+
+
+# A Batch queues hub memory reads and writes and performs them together. It is
+#  created by PeekPoke.batch and is normally used as a context manager:
+#
+#   with p.batch() as b:
+#       state = b.get_int(0x7000, 4)
+#       b.set_int(0x7004, 4, 1)
+#       name = b.get_str(0x7100, 16)
+#   state.result()
+#
+# Each method verifies its arguments immediately and returns a BatchFuture. The
+#  operations are performed when the block exits (or when run is called), and
+#  then each future holds its result or error. If the block raises an exception
+#  the queued operations are not performed and the futures are cancelled.
+#
+# Planning: the queue is divided into stages of reads and stages of writes. An
+#  operation is moved to the earliest stage it may join without passing an
+#  operation on overlapping bytes, so accesses to the same bytes keep their
+#  order, but accesses to different bytes may be reordered. Each read stage is
+#  performed by PeekPoke.read_many and each write stage by PeekPoke.write_many,
+#  so adjacent ranges are coalesced into as few commands as possible, and the
+#  commands are pipelined if the pipeline window allows. Neither method divides
+#  a range that fits in one command, so get_int and set_int remain atomic.
+#  Writes are sent immediately, even if a write-back shadow is used.
+# Errors: if a stage fails its operations are retried one at a time, so that
+#  each future gets its own result or error, and the later stages are still
+#  performed. Operations retried after a failed write stage may be written a
+#  second time.
+
+
+from peekpoke import PeekPoke
+
+
+class BatchFuture():
+
+    # The result of a queued operation, available once the batch has run.
+
+    def __init__(self):
+        self._state = 'pending'
+        self._result = None
+        self._exception = None
+
+    def done(self):
+        return self._state != 'pending'
+
+    def cancelled(self):
+        return self._state == 'cancelled'
+
+    def result(self):
+        """Returns the operation's result (None for writes), raising its error if it failed."""
+        self._verify_done()
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self):
+        """Returns the operation's error, or None if it succeeded."""
+        self._verify_done()
+        return self._exception
+
+    def _verify_done(self):
+        if self._state == 'pending':
+            raise RuntimeError("The batch has not been run yet.")
+        if self._state == 'cancelled':
+            raise RuntimeError("The batch was cancelled.")
+
+    def _set_result(self, result):
+        self._state = 'done'
+        self._result = result
+
+    def _set_exception(self, exception):
+        self._state = 'done'
+        self._exception = exception
+
+    def __repr__(self):
+        if self._state == 'done' and self._exception is not None:
+            return "BatchFuture(error=" + repr(self._exception) + ")"
+        if self._state == 'done':
+            return "BatchFuture(result=" + repr(self._result) + ")"
+        return "BatchFuture(" + self._state + ")"
+
+
+class _Operation():
+
+    # A queued read or write. finish converts the bytes read into the result.
+
+    __slots__ = ('is_read', 'hub_address', 'count', 'data', 'finish', 'future')
+
+    def __init__(self, is_read, hub_address, count, data, finish):
+        self.is_read = is_read
+        self.hub_address = hub_address
+        self.count = count
+        self.data = data
+        self.finish = finish
+        self.future = BatchFuture()
+
+    def overlaps(self, other):
+        return self.hub_address < other.hub_address + other.count and other.hub_address < self.hub_address + self.count
+
+
+class Batch():
+
+    def __init__(self, peekpoke):
+        self._peekpoke = peekpoke
+        self._operations = []
+        self._has_run = False
+        # The number of read and write stages performed by run.
+        self.stage_count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.run()
+        else:
+            self.cancel()
+
+    def __len__(self):
+        return len(self._operations)
+
+
+    # Queueing Methods
+
+    # These take the same arguments as the PeekPoke methods of the same name,
+    #  except that there is no atomic argument, and return a BatchFuture.
+
+    def get_bytes(self, hub_address, count):
+        self._peekpoke._verify_hub_args(hub_address, count, True, False)
+        return self._queue(True, hub_address, count, None, None)
+
+    def set_bytes(self, hub_address, data):
+        self._peekpoke._verify_hub_args(hub_address, len(data), False, False)
+        return self._queue(False, hub_address, len(data), bytes(data), None)
+
+    def get_int(self, hub_address, length, *, alignment='length', byteorder='little', signed=False):
+        PeekPoke._verify_int_length(length)
+        self._peekpoke._verify_hub_args(hub_address, length, True, True)
+        PeekPoke._verify_int_alignment(hub_address, length, alignment)
+        return self._queue(True, hub_address, length, None, lambda data: int.from_bytes(data, byteorder, signed=signed))
+
+    def set_int(self, hub_address, length, integer, *, alignment='length', byteorder='little', signed=False):
+        PeekPoke._verify_int_length(length)
+        self._peekpoke._verify_hub_args(hub_address, length, False, True)
+        PeekPoke._verify_int_alignment(hub_address, length, alignment)
+        return self._queue(False, hub_address, length, integer.to_bytes(length, byteorder, signed=signed), None)
+
+    def get_ints(self, hub_address, length, count, *, alignment='length', byteorder='little', signed=False):
+        PeekPoke._verify_int_length(length)
+        PeekPoke._verify_int_alignment(hub_address, length, alignment)
+        self._peekpoke._verify_hub_args(hub_address, count*length, True, False)
+        return self._queue(True, hub_address, count*length, None, lambda data: PeekPoke._ints_from_bytes(data, length, count, byteorder, signed))
+
+    def set_ints(self, hub_address, length, integers, *, alignment='length', byteorder='little', signed=False):
+        PeekPoke._verify_int_length(length)
+        PeekPoke._verify_int_alignment(hub_address, length, alignment)
+        data = bytes(PeekPoke._ints_to_bytes(integers, length, byteorder, signed))
+        self._peekpoke._verify_hub_args(hub_address, len(data), False, False)
+        return self._queue(False, hub_address, len(data), data, None)
+
+    def get_str(self, hub_address, max_bytes, *, encoding='latin_1', errors='replace', nul_terminated=True):
+        # All max_bytes bytes are read (with readHub, so the read may be coalesced),
+        #  and the string ends at the first NUL.
+        self._peekpoke._verify_hub_args(hub_address, max_bytes, True, False)
+        def finish(data):
+            if nul_terminated:
+                nul_index = data.find(0)
+                if nul_index != -1:
+                    data = data[0:nul_index+1]
+            return PeekPoke._decode_str(data, encoding, errors, nul_terminated)
+        return self._queue(True, hub_address, max_bytes, None, finish)
+
+    def set_str(self, hub_address, max_bytes, string, *, encoding='latin_1', errors='replace', nul_terminated=True, truncate=False):
+        data = bytes(PeekPoke._encode_str(max_bytes, string, encoding, errors, nul_terminated, truncate))
+        self._peekpoke._verify_hub_args(hub_address, len(data), False, False)
+        return self._queue(False, hub_address, len(data), data, None)
+
+
+    # Running
+
+    def run(self):
+        """Performs the queued operations, resolving their futures."""
+        if self._has_run:
+            raise RuntimeError("A batch may only be run once.")
+        self._has_run = True
+        stages = Batch._plan(self._operations)
+        self.stage_count = len(stages)
+        for is_read, operations in stages:
+            self._run_stage(is_read, operations)
+
+    def cancel(self):
+        """Discards the queued operations, cancelling their futures."""
+        self._has_run = True
+        for operation in self._operations:
+            if not operation.future.done():
+                operation.future._state = 'cancelled'
+
+    def _queue(self, is_read, hub_address, count, data, finish):
+        if self._has_run:
+            raise RuntimeError("The batch has already been run.")
+        operation = _Operation(is_read, hub_address, count, data, finish)
+        self._operations.append(operation)
+        return operation.future
+
+    @staticmethod
+    def _plan(operations):
+        # Returns a list of (is_read, operations) stages. Operations keep their
+        #  queue order within a stage, which write_many relies on where writes
+        #  overlap.
+        stages = []
+        for operation in operations:
+            if operation.count == 0:
+                # Nothing to send, so it may go anywhere.
+                earliest = 0
+            else:
+                # An operation may not move before a stage with an overlapping
+                #  operation that must precede it: any write for a read, and any
+                #  read for a write. Overlapping writes may share a stage.
+                earliest = 0
+                for index in range(len(stages) - 1, -1, -1):
+                    is_read, members = stages[index]
+                    if any(operation.overlaps(other) for other in members if other.count > 0):
+                        if is_read == operation.is_read:
+                            earliest = index
+                        else:
+                            earliest = index + 1
+                        break
+            for index in range(earliest, len(stages)):
+                if stages[index][0] == operation.is_read:
+                    stages[index][1].append(operation)
+                    break
+            else:
+                stages.append((operation.is_read, [operation]))
+        return stages
+
+    def _run_stage(self, is_read, operations):
+        peekpoke = self._peekpoke
+        try:
+            if is_read:
+                results = peekpoke.read_many([(op.hub_address, op.count) for op in operations])
+            else:
+                peekpoke.write_many([(op.hub_address, op.data) for op in operations])
+                results = [None]*len(operations)
+        except Exception:
+            # Retry one at a time so that each future gets its own result or error.
+            for operation in operations:
+                try:
+                    if is_read:
+                        result = peekpoke.read_many([(operation.hub_address, operation.count)])[0]
+                    else:
+                        peekpoke.write_many([(operation.hub_address, operation.data)])
+                        result = None
+                except Exception as e:
+                    operation.future._set_exception(e)
+                else:
+                    Batch._finish(operation, result)
+            return
+        for operation, result in zip(operations, results):
+            Batch._finish(operation, result)
+
+    @staticmethod
+    def _finish(operation, data):
+        if operation.finish is None:
+            operation.future._set_result(data)
+            return
+        try:
+            operation.future._set_result(operation.finish(data))
+        except Exception as e:
+            operation.future._set_exception(e)
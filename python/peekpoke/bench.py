@@ -0,0 +1,213 @@
+# bench.py
+# Throughput and latency benchmarks for PeekPoke
+# source: https://github.com/chris-siedell/PeekPoke
+# python: https://pypi.org/project/peekpoke/
+# homepage: http://siedell.com/projects/PeekPoke/
+
+
+# This module measures the throughput and latency of the PeekPoke hub memory
+#  and token methods, sweeping baudrate, transfer size, and chunk size. The
+#  results are JSON so that runs can be compared between releases.
+#
+# Usage:
+#   python -m peekpoke.bench <serial port name> [options]
+#   python -m peekpoke.bench --sim [options]
+#
+# With --sim a simulated device (see peekpoke.sim) is used. Unless --realtime
+#  is also given the simulation does not sleep, so the wall clock times mostly
+#  measure the client's own overhead, and the simulation's modeled wire time
+#  is reported separately as modeled_seconds.
+#
+# Writes are only benchmarked on a real device if --write-address is given,
+#  since they overwrite hub memory.
+
+
+import argparse
+import json
+import math
+import platform
+import time
+
+import peekpoke
+from peekpoke import PeekPoke
+
+
+OPERATIONS = ['get_bytes', 'set_bytes', 'get_str', 'get_ints', 'token']
+TRANSFER_SIZES = [4, 64, 1024, 8192]
+CHUNK_SIZES = [None, 64]
+
+
+def percentile(values, fraction):
+    # Nearest-rank percentile of a non-empty list.
+    ordered = sorted(values)
+    rank = max(int(math.ceil(fraction * len(ordered))), 1)
+    return ordered[rank - 1]
+
+
+def run(p, *, operations=OPERATIONS, transfer_sizes=TRANSFER_SIZES, chunk_sizes=CHUNK_SIZES, baudrates=None,
+        iterations=20, read_address=None, write_address=None, clkfreq=None, simulated_serial=None):
+    """Runs the benchmarks using the PeekPoke object p, returning a dict suitable for JSON."""
+    # A chunk size of None means that each transfer is a single call, which
+    #  PeekPoke splits into commands of up to max_atomic_read/max_atomic_write
+    #  bytes. Otherwise each transfer is made with atomic calls of at most
+    #  chunk size bytes. The token operation ignores the sizes.
+    info = p.get_info()
+    if read_address is None:
+        read_address = info.min_read_address
+    original_baudrate = p.baudrate
+    if baudrates is None:
+        baudrates = [original_baudrate]
+    if clkfreq is None and any(b != original_baudrate for b in baudrates):
+        clkfreq = p.estimate_clkfreq()
+    results = []
+    try:
+        for baudrate in baudrates:
+            if baudrate != p.baudrate:
+                p.switch_baudrate(baudrate, clkfreq=clkfreq)
+            for operation in operations:
+                if operation == 'set_bytes' and write_address is None:
+                    continue
+                if operation == 'token':
+                    results.append(_measure(p, operation, baudrate, 4, None, iterations, None, simulated_serial))
+                    continue
+                address = write_address if operation == 'set_bytes' else read_address
+                for transfer_size in transfer_sizes:
+                    for chunk_size in chunk_sizes:
+                        results.append(_measure(p, operation, baudrate, transfer_size, chunk_size, iterations, address, simulated_serial))
+    finally:
+        if p.baudrate != original_baudrate:
+            p.switch_baudrate(original_baudrate, clkfreq=clkfreq)
+    return {
+        'peekpoke_version': peekpoke.__version__,
+        'python_version': platform.python_version(),
+        'serial_port_name': p.serial_port_name,
+        'simulated': simulated_serial is not None,
+        'max_atomic_read': info.max_atomic_read,
+        'max_atomic_write': info.max_atomic_write,
+        'iterations': iterations,
+        'results': results,
+    }
+
+
+def _measure(p, operation, baudrate, transfer_size, chunk_size, iterations, hub_address, simulated_serial):
+    info = p.get_info()
+    if operation == 'set_bytes':
+        max_chunk = info.max_atomic_write
+    else:
+        max_chunk = info.max_atomic_read
+    chunk = max_chunk if chunk_size is None else min(chunk_size, max_chunk)
+    if operation == 'token':
+        call = p.get_token
+        commands = 1
+    else:
+        if operation == 'set_bytes':
+            data = bytes(i & 0xff for i in range(transfer_size))
+        chunks = []
+        for index in range(0, transfer_size, chunk):
+            chunks.append((hub_address + index, min(chunk, transfer_size - index)))
+        commands = len(chunks)
+        if chunk_size is None:
+            chunks = [(hub_address, transfer_size)]
+        atomic = chunk_size is not None
+        if operation == 'get_bytes':
+            def call():
+                for address, count in chunks:
+                    p.get_bytes(address, count, atomic=atomic)
+        elif operation == 'set_bytes':
+            def call():
+                for address, count in chunks:
+                    index = address - hub_address
+                    p.set_bytes(address, data[index:index+count], atomic=atomic)
+        elif operation == 'get_str':
+            def call():
+                for address, count in chunks:
+                    p.get_str(address, count, nul_terminated=False, atomic=atomic)
+        elif operation == 'get_ints':
+            if transfer_size % 4 != 0 or chunk % 4 != 0:
+                raise ValueError("get_ints requires transfer and chunk sizes divisible by 4.")
+            def call():
+                for address, count in chunks:
+                    p.get_ints(address, 4, count//4, atomic=atomic)
+        else:
+            raise ValueError("Unknown operation '" + operation + "'.")
+    # One untimed call makes sure cached info and the shadow (if any) are warm.
+    call()
+    latencies = []
+    modeled_start = simulated_serial.elapsed_time if simulated_serial is not None else None
+    start = time.perf_counter()
+    for _i in range(iterations):
+        t = time.perf_counter()
+        call()
+        latencies.append(time.perf_counter() - t)
+    total = time.perf_counter() - start
+    result = {
+        'operation': operation,
+        'baudrate': baudrate,
+        'transfer_size': transfer_size,
+        'chunk_size': chunk_size,
+        'commands_per_transfer': commands,
+        'seconds': total,
+        'commands_per_second': commands*iterations/total,
+        'bytes_per_second': transfer_size*iterations/total,
+        'latency_p50': percentile(latencies, 0.50),
+        'latency_p99': percentile(latencies, 0.99),
+    }
+    if simulated_serial is not None:
+        modeled = simulated_serial.elapsed_time - modeled_start
+        result['modeled_seconds'] = modeled
+        if modeled > 0:
+            result['modeled_bytes_per_second'] = transfer_size*iterations/modeled
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m peekpoke.bench', description="Benchmarks PeekPoke throughput and latency, printing JSON.")
+    parser.add_argument('serial_port_name', nargs='?', help="the serial port of a device running PeekPoke.spin")
+    parser.add_argument('--sim', action='store_true', help="use a simulated device instead of a serial port")
+    parser.add_argument('--realtime', action='store_true', help="make the simulated device run in real time")
+    parser.add_argument('--address', type=int, default=1, help="the device's Crow address (default 1)")
+    parser.add_argument('--port', type=int, default=112, help="the PeekPoke service's Crow port (default 112)")
+    parser.add_argument('--operations', default=','.join(OPERATIONS), help="comma separated list of operations")
+    parser.add_argument('--sizes', default=','.join(str(s) for s in TRANSFER_SIZES), help="comma separated transfer sizes")
+    parser.add_argument('--chunks', default='all,64', help="comma separated chunk sizes, where 'all' means one call per transfer")
+    parser.add_argument('--baudrates', default=None, help="comma separated baudrates (default is the current baudrate)")
+    parser.add_argument('--iterations', type=int, default=20, help="timed calls per measurement (default 20)")
+    parser.add_argument('--read-address', type=lambda s: int(s, 0), default=None, help="hub address to read from")
+    parser.add_argument('--write-address', type=lambda s: int(s, 0), default=None, help="hub address of a scratch area to write to")
+    parser.add_argument('--clkfreq', type=int, default=None, help="the Propeller's clock frequency, used when switching baudrates")
+    parser.add_argument('--output', default=None, help="file to write the JSON to (default is stdout)")
+    args = parser.parse_args(argv)
+
+    simulated_serial = None
+    if args.sim:
+        from peekpoke.sim import SimulatedDevice, attach
+        serial_port_name = 'peekpoke-bench-sim'
+        device = SimulatedDevice(address=args.address, port=args.port)
+        simulated_serial = attach(serial_port_name, device, realtime=args.realtime)
+        write_address = 0x4000 if args.write_address is None else args.write_address
+    elif args.serial_port_name is None:
+        parser.error("a serial port name or --sim is required")
+    else:
+        serial_port_name = args.serial_port_name
+        write_address = args.write_address
+
+    chunk_sizes = [None if c == 'all' else int(c) for c in args.chunks.split(',')]
+    baudrates = None
+    if args.baudrates is not None:
+        baudrates = [int(b) for b in args.baudrates.split(',')]
+
+    p = PeekPoke(serial_port_name, args.address, args.port)
+    report = run(p, operations=args.operations.split(','), transfer_sizes=[int(s) for s in args.sizes.split(',')],
+                 chunk_sizes=chunk_sizes, baudrates=baudrates, iterations=args.iterations,
+                 read_address=args.read_address, write_address=write_address, clkfreq=args.clkfreq,
+                 simulated_serial=simulated_serial)
+    text = json.dumps(report, indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
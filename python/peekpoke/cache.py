@@ -0,0 +1,125 @@
+# cache.py
+# Persistent device information cache for PeekPoke
+# source: https://github.com/chris-siedell/PeekPoke
+# python: https://pypi.org/project/peekpoke/
+# homepage: http://siedell.com/projects/PeekPoke/
+
+
+import json
+import os
+import time
+
+
+def default_path():
+    """Returns the default cache file path, which may be set with the PEEKPOKE_CACHE environment variable."""
+    path = os.environ.get('PEEKPOKE_CACHE')
+    if path:
+        return path
+    cache_dir = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_dir, 'peekpoke', 'devices.json')
+
+
+class DeviceCache():
+
+    # DeviceCache keeps a JSON file of information about PeekPoke devices so that
+    #  new PeekPoke objects can skip the getInfo and getSerialTimings round trips.
+    #  It is used by passing cache=True (or a path, or a DeviceCache) to PeekPoke.
+    # Each entry is keyed by serial port name, address, port, layout_id, and
+    #  identifier. There is at most one entry for each serial port, address, and
+    #  port combination (a location): storing an entry for a device with a different
+    #  layout_id or identifier replaces the old one.
+    # An entry holds the raw getInfo response, the last good baudrate, and the
+    #  serial timings last read from or sent to the device (with the baudrate
+    #  they were for). The file is read on every lookup and rewritten on every
+    #  change, which is cheap for the handful of devices expected. Problems
+    #  reading or writing the file are ignored, since the cache is only an
+    #  optimization.
+
+    def __init__(self, path=None):
+        if path is None:
+            path = default_path()
+        self.path = path
+
+    def lookup(self, serial_port_name, address, port):
+        """Returns the entry (a dict) for the location, or None."""
+        for entry in self._load().values():
+            if entry.get('serial_port_name') == serial_port_name and entry.get('address') == address and entry.get('port') == port:
+                return entry
+        return None
+
+    def store(self, serial_port_name, address, port, info, *, baudrate=None, timings=None, timings_baudrate=None):
+        """Adds or replaces the entry for the location."""
+        entries = self._load()
+        key = DeviceCache._key(serial_port_name, address, port, info.layout_id, info.identifier)
+        previous = entries.get(key)
+        DeviceCache._remove_location(entries, serial_port_name, address, port)
+        entry = {
+            'serial_port_name': serial_port_name,
+            'address': address,
+            'port': port,
+            'layout_id': info.layout_id.hex(),
+            'identifier': info.identifier,
+            'info': info.as_bytes().hex(),
+            'baudrate': baudrate,
+            'timings': None,
+            'timings_baudrate': None,
+            'time': time.time(),
+        }
+        if timings is not None:
+            entry['timings'] = timings.as_bytes().hex()
+            entry['timings_baudrate'] = timings_baudrate
+        elif previous is not None:
+            # Timings for the same device are kept until replaced.
+            entry['timings'] = previous.get('timings')
+            entry['timings_baudrate'] = previous.get('timings_baudrate')
+        if baudrate is None and previous is not None:
+            entry['baudrate'] = previous.get('baudrate')
+        entries[key] = entry
+        self._save(entries)
+        return entry
+
+    def remove(self, serial_port_name, address, port):
+        """Removes the entry for the location, if there is one."""
+        entries = self._load()
+        if DeviceCache._remove_location(entries, serial_port_name, address, port):
+            self._save(entries)
+
+    def clear(self):
+        """Removes all entries."""
+        self._save({})
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(entries, dict):
+            return {}
+        return entries
+
+    def _save(self, entries):
+        # The file is replaced atomically so that concurrent readers never see a
+        #  partially written file.
+        temp_path = self.path + '.' + str(os.getpid()) + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with open(temp_path, 'w') as f:
+                json.dump(entries, f, indent=1, sort_keys=True)
+            os.replace(temp_path, self.path)
+        except OSError:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+
+    @staticmethod
+    def _key(serial_port_name, address, port, layout_id, identifier):
+        return serial_port_name + '|' + str(address) + '|' + str(port) + '|' + layout_id.hex() + '|' + str(identifier)
+
+    @staticmethod
+    def _remove_location(entries, serial_port_name, address, port):
+        keys = [k for k, e in entries.items() if e.get('serial_port_name') == serial_port_name and e.get('address') == address and e.get('port') == port]
+        for k in keys:
+            del entries[k]
+        return len(keys) > 0
@@ -0,0 +1,156 @@
+# combine.py
+# Write combining for PeekPoke
+# source: https://github.com/chris-siedell/PeekPoke
+# python: https://pypi.org/project/peekpoke/
+# homepage: http://siedell.com/projects/PeekPoke/
+
+
+class WriteCombiner():
+
+    # WriteCombiner buffers small hub writes so that writes to contiguous or
+    #  overlapping addresses are sent together, with one writeHub command. It is
+    #  created by PeekPoke.enable_write_combining, and PeekPoke decides which
+    #  writes are buffered and sends the spans WriteCombiner returns.
+    #  WriteCombiner itself performs no communication.
+    # Buffered writes are kept as non-overlapping spans. A write that overlaps or
+    #  adjoins spans is merged with them (later bytes win) as long as the merged
+    #  span is no longer than the limit, which is max_bytes or max_atomic_write,
+    #  whichever is smaller. Otherwise those spans are taken to be sent first.
+    # A span is taken to be sent as soon as it reaches the limit, when a read
+    #  overlaps it, or when its oldest write is more than max_age seconds old (None
+    #  for no limit). Age is only checked when PeekPoke next reads or writes hub
+    #  memory; nothing sends an old span on its own, so PeekPoke's callers must
+    #  call flush at the end of a burst of writes.
+    # Each write lies entirely within one span, so a write that fits in one
+    #  command is still written atomically.
+
+    def __init__(self, *, max_age=0.01, max_bytes=None):
+        if max_age is not None and max_age < 0:
+            raise ValueError("max_age must be None or non-negative.")
+        if max_bytes is not None and max_bytes < 1:
+            raise ValueError("max_bytes must be None or positive.")
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.reset()
+
+    def reset(self):
+        """Discards any buffered writes and clears the statistics."""
+        # _spans holds [hub_address, data, time] lists in address order, where
+        #  time is when the span's oldest write was buffered.
+        self._spans = []
+        self.writes = 0
+        self.commands = 0
+        self.bytes_sent = 0
+
+    def discard(self):
+        """Discards any buffered writes."""
+        self._spans = []
+
+    @property
+    def pending(self):
+        """True if there are buffered writes."""
+        return len(self._spans) > 0
+
+    @property
+    def pending_bytes(self):
+        return sum(len(span[1]) for span in self._spans)
+
+    @property
+    def writes_per_command(self):
+        """The number of writes buffered per command sent, or None if none have been sent."""
+        if self.commands == 0:
+            return None
+        return self.writes/self.commands
+
+    def snapshot(self):
+        """Returns a dict of the statistics."""
+        return {
+            'writes': self.writes,
+            'commands': self.commands,
+            'bytes_sent': self.bytes_sent,
+            'writes_per_command': self.writes_per_command,
+            'pending_spans': len(self._spans),
+            'pending_bytes': self.pending_bytes,
+        }
+
+    def limit(self, max_atomic_write):
+        # Returns the largest span allowed.
+        if self.max_bytes is None:
+            return max_atomic_write
+        return min(self.max_bytes, max_atomic_write)
+
+    def add(self, hub_address, data, limit, now):
+        # Buffers the write, which must be shorter than limit. Returns a list of
+        #  (hub_address, data) spans to send now, in the order given: any spans
+        #  that could not be merged with the write, followed by the write's span
+        #  if it has reached the limit.
+        spans = self._spans
+        end = hub_address + len(data)
+        # The spans that overlap or adjoin the write are consecutive.
+        first = 0
+        while first < len(spans) and spans[first][0] + len(spans[first][1]) < hub_address:
+            first += 1
+        last = first
+        while last < len(spans) and spans[last][0] <= end:
+            last += 1
+        taken = []
+        start = hub_address
+        stop = end
+        if last > first:
+            start = min(hub_address, spans[first][0])
+            stop = max(end, spans[last-1][0] + len(spans[last-1][1]))
+            if stop - start > limit:
+                taken = self._take(first, last)
+                last = first
+                start = hub_address
+                stop = end
+        if last == first:
+            spans.insert(first, [hub_address, bytearray(data), now])
+        else:
+            merged = bytearray(stop - start)
+            oldest = now
+            for span_address, span_data, span_time in spans[first:last]:
+                merged[span_address-start:span_address-start+len(span_data)] = span_data
+                oldest = min(oldest, span_time)
+            merged[hub_address-start:end-start] = data
+            spans[first:last] = [[start, merged, oldest]]
+        self.writes += 1
+        if stop - start >= limit:
+            taken += self._take(first, first + 1)
+        return taken
+
+    def take(self, hub_address, count, now):
+        # Removes and returns the spans overlapping the range, and any that are
+        #  too old, as a list of (hub_address, data) tuples. An empty range
+        #  overlaps nothing, so a count of zero takes only the old spans.
+        spans = self._spans
+        end = hub_address + count
+        max_age = self.max_age
+        taken = []
+        kept = []
+        for span in spans:
+            if (count > 0 and span[0] < end and hub_address < span[0] + len(span[1])) or (max_age is not None and now - span[2] > max_age):
+                taken.append((span[0], span[1]))
+            else:
+                kept.append(span)
+        if len(taken) > 0:
+            self._spans = kept
+            self._count(taken)
+        return taken
+
+    def take_all(self):
+        # Removes and returns all the spans.
+        taken = [(span[0], span[1]) for span in self._spans]
+        self._spans = []
+        self._count(taken)
+        return taken
+
+    def _take(self, first, last):
+        taken = [(span[0], span[1]) for span in self._spans[first:last]]
+        del self._spans[first:last]
+        self._count(taken)
+        return taken
+
+    def _count(self, taken):
+        self.commands += len(taken)
+        self.bytes_sent += sum(len(data) for _address, data in taken)
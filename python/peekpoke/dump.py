@@ -0,0 +1,314 @@
+# dump.py
+# Hub memory dump files for PeekPoke
+# source: https://github.com/chris-siedell/PeekPoke
+# python: https://pypi.org/project/peekpoke/
+# homepage: http://siedell.com/projects/PeekPoke/
+
+
+# A dump file holds an image of some or all of a Propeller's hub memory. It is
+#  written as the data arrives from the device, so a dump of the whole hub
+#  never needs to be held in memory, and a dump interrupted by an error still
+#  contains everything read up to that point.
+#
+# Format (version 1, all integers little endian):
+#   header:
+#     magic           4 bytes, b'PPHD'
+#     version         uint16
+#     compression     uint8, 0 = none, 1 = zlib, 2 = lzma
+#     reserved        uint8, 0
+#     layout_id       4 bytes, from the device's getInfo response
+#     identifier      uint32, from the device's getInfo response
+#     timestamp       float64, seconds since the epoch when the dump started
+#     range count     uint16
+#     ranges          range count pairs of uint32 (hub address, byte count)
+#     header crc      uint32, the CRC-32 of all the preceding header bytes
+#   blocks, each:
+#     hub address     uint32
+#     size            uint32, the number of hub memory bytes in the block
+#     stored size     uint32, the number of bytes that follow
+#     crc             uint32, the CRC-32 of the block's hub memory bytes
+#     data            the bytes, compressed unless stored size equals size
+#   end marker:
+#     16 bytes, a block header with a size and stored size of zero, where the
+#     hub address field is the number of blocks and the crc field is the
+#     CRC-32 of the header crc and all the block crcs
+#
+# Each block is compressed independently, so any block can be read without
+#  reading the ones before it.
+
+
+import struct
+import time
+import zlib
+
+
+FORMAT_VERSION = 1
+MAGIC = b'PPHD'
+COMPRESSION_CODES = {None: 0, 'none': 0, 'zlib': 1, 'lzma': 2}
+COMPRESSION_NAMES = {0: 'none', 1: 'zlib', 2: 'lzma'}
+
+_HEADER = struct.Struct('<4sHBB4sIdH')
+_RANGE = struct.Struct('<II')
+_CRC = struct.Struct('<I')
+_BLOCK = struct.Struct('<IIII')
+
+DEFAULT_BLOCK_SIZE = 1024
+
+
+class DumpHeader():
+
+    # The information stored at the start of a dump file. ranges is a list of
+    #  (hub_address, count) tuples.
+
+    def __init__(self, *, version=FORMAT_VERSION, compression='zlib', layout_id=b'\x00\x00\x00\x00', identifier=0, timestamp=0.0, ranges=None):
+        self.version = version
+        self.compression = 'none' if compression is None else compression
+        self.layout_id = layout_id
+        self.identifier = identifier
+        self.timestamp = timestamp
+        self.ranges = [] if ranges is None else list(ranges)
+
+    def as_bytes(self):
+        data = bytearray(_HEADER.pack(MAGIC, self.version, COMPRESSION_CODES[self.compression], 0,
+                                      self.layout_id, self.identifier, self.timestamp, len(self.ranges)))
+        for hub_address, count in self.ranges:
+            data += _RANGE.pack(hub_address, count)
+        data += _CRC.pack(zlib.crc32(data))
+        return data
+
+    def __str__(self):
+        return "PeekPoke dump, version " + str(self.version) + ", compression: " + self.compression + ", layout_id: " + self.layout_id.hex() + ", identifier: " + str(self.identifier) + ", timestamp: " + str(self.timestamp) + ", ranges: " + str(self.ranges)
+
+
+class DumpWriter():
+
+    # Writes a dump file block by block. file may be a path or a binary file
+    #  object (which is not closed). The header is written on creation and the
+    #  end marker by close.
+
+    def __init__(self, file, header, *, level=None):
+        if header.compression not in COMPRESSION_CODES:
+            raise ValueError("Unknown compression '" + str(header.compression) + "'. It must be 'none', 'zlib', or 'lzma'.")
+        self._compress = _compressor(COMPRESSION_CODES[header.compression], level)
+        if hasattr(file, 'write'):
+            self._file = file
+            self._owns_file = False
+        else:
+            self._file = open(file, 'wb')
+            self._owns_file = True
+        self.header = header
+        header_bytes = header.as_bytes()
+        self._crc = zlib.crc32(header_bytes[-4:])
+        self._block_count = 0
+        self._file.write(header_bytes)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self._owns_file:
+            # The end marker is left out so that the dump is seen to be incomplete.
+            self._file.close()
+
+    def write_block(self, hub_address, data):
+        block, crc = _encode_block(self._compress, hub_address, data)
+        self._file.write(block)
+        self._crc = zlib.crc32(_CRC.pack(crc), self._crc)
+        self._block_count += 1
+
+    def close(self):
+        if self._file is None:
+            return
+        self._file.write(_BLOCK.pack(self._block_count, 0, 0, self._crc))
+        if self._owns_file:
+            self._file.close()
+        else:
+            self._file.flush()
+        self._file = None
+
+
+class DumpReader():
+
+    # Reads a dump file. file may be a path or a binary file object (which is
+    #  not closed). The header is read on creation. Iterating yields
+    #  (hub_address, data) tuples, verifying each block's checksum. ValueError
+    #  is raised if the file is damaged or incomplete, but only after the
+    #  intact blocks before the problem have been yielded.
+
+    def __init__(self, file):
+        if hasattr(file, 'read'):
+            self._file = file
+            self._owns_file = False
+        else:
+            self._file = open(file, 'rb')
+            self._owns_file = True
+        try:
+            self.header = self._read_header()
+        except Exception:
+            self.close()
+            raise
+        self._decompress = _decompressor(COMPRESSION_CODES[self.header.compression])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __iter__(self):
+        return self.blocks()
+
+    def blocks(self):
+        crc = self._header_crc
+        block_count = 0
+        while True:
+            hub_address, data, block_crc = _read_block(self._file, self._decompress)
+            if data is None:
+                if hub_address != block_count or block_crc != crc:
+                    raise ValueError("The dump's end marker does not match its blocks.")
+                return
+            crc = zlib.crc32(_CRC.pack(block_crc), crc)
+            block_count += 1
+            yield (hub_address, data)
+
+    def close(self):
+        if self._owns_file and self._file is not None:
+            self._file.close()
+        self._file = None
+
+    def _read_header(self):
+        data = self._read_exactly(_HEADER.size, "the header")
+        magic, version, compression, _reserved, layout_id, identifier, timestamp, range_count = _HEADER.unpack(data)
+        if magic != MAGIC:
+            raise ValueError("The file is not a PeekPoke dump.")
+        if version != FORMAT_VERSION:
+            raise ValueError("The dump's format version (" + str(version) + ") is not supported.")
+        if compression not in COMPRESSION_NAMES:
+            raise ValueError("The dump's compression code (" + str(compression) + ") is unknown.")
+        range_data = self._read_exactly(range_count*_RANGE.size, "the header")
+        crc_data = self._read_exactly(_CRC.size, "the header")
+        if _CRC.unpack(crc_data)[0] != zlib.crc32(range_data, zlib.crc32(data)):
+            raise ValueError("The dump's header is damaged (checksum mismatch).")
+        self._header_crc = zlib.crc32(crc_data)
+        ranges = [_RANGE.unpack_from(range_data, i*_RANGE.size) for i in range(range_count)]
+        return DumpHeader(version=version, compression=COMPRESSION_NAMES[compression], layout_id=layout_id,
+                          identifier=identifier, timestamp=timestamp, ranges=ranges)
+
+    def _read_exactly(self, size, what):
+        return _read_exactly(self._file, size, what)
+
+
+def dump(peekpoke, file, ranges=None, *, compression='zlib', level=None, block_size=DEFAULT_BLOCK_SIZE):
+    """Reads hub memory into a dump file. Returns the DumpHeader."""
+    # ranges is a list of (hub_address, count) tuples, and by default is the
+    #  device's entire allowed read range. Each range is read with a single
+    #  get_bytes call, so the fewest readHub commands are used, and is then
+    #  written block by block.
+    if block_size < 1:
+        raise ValueError("block_size must be positive.")
+    info = peekpoke.get_info()
+    if ranges is None:
+        ranges = [(info.min_read_address, info.max_read_address + 1 - info.min_read_address)]
+    else:
+        ranges = [(hub_address, count) for hub_address, count in ranges if count > 0]
+    for hub_address, count in ranges:
+        peekpoke._verify_hub_args(hub_address, count, True, False)
+    header = DumpHeader(compression=compression, layout_id=bytes(info.layout_id), identifier=info.identifier,
+                        timestamp=time.time(), ranges=ranges)
+    with DumpWriter(file, header, level=level) as writer:
+        for hub_address, count in ranges:
+            data = memoryview(peekpoke.get_bytes(hub_address, count))
+            for offset in range(0, count, block_size):
+                writer.write_block(hub_address + offset, data[offset:offset+block_size])
+    return header
+
+
+def restore(peekpoke, file, *, check_device=True):
+    """Writes the contents of a dump file back to hub memory. Returns the number of bytes written."""
+    # Only the parts of blocks inside the device's allowed write range are
+    #  written. If check_device is True then a ValueError is raised if the
+    #  device's layout_id or identifier differ from those in the dump. Blocks
+    #  are written as they are read, so if the dump is damaged the blocks before
+    #  the problem will have been written when the ValueError is raised.
+    info = peekpoke.get_info()
+    written = 0
+    with DumpReader(file) as reader:
+        header = reader.header
+        if check_device and (header.layout_id != bytes(info.layout_id) or header.identifier != info.identifier):
+            raise ValueError("The dump was made from a device with a different layout_id or identifier.")
+        for hub_address, data in reader:
+            start = max(hub_address, info.min_write_address)
+            end = min(hub_address + len(data), info.max_write_address + 1)
+            if start < end:
+                peekpoke.set_bytes(start, memoryview(data)[start-hub_address:end-hub_address])
+                written += end - start
+    return written
+
+
+def _encode_block(compress, hub_address, data):
+    # Returns the encoded block (header and stored data) and its crc. compress
+    #  may be None.
+    crc = zlib.crc32(data)
+    stored = data
+    if compress is not None:
+        compressed = compress(data)
+        if len(compressed) < len(data):
+            stored = compressed
+    return _BLOCK.pack(hub_address, len(data), len(stored), crc) + stored, crc
+
+
+def _read_block(file, decompress):
+    # Reads a block from the file's current position, returning (hub_address,
+    #  data, crc). data is None for an end marker.
+    hub_address, size, stored_size, crc = _BLOCK.unpack(_read_exactly(file, _BLOCK.size, "a block header"))
+    if size == 0 and stored_size == 0:
+        return (hub_address, None, crc)
+    stored = _read_exactly(file, stored_size, "a block")
+    data = stored
+    if stored_size != size:
+        try:
+            data = decompress(stored)
+        except Exception:
+            data = b''
+    if len(data) != size or zlib.crc32(data) != crc:
+        raise ValueError("The dump block at hub address " + str(hub_address) + " is damaged (checksum mismatch).")
+    return (hub_address, data, crc)
+
+
+def _read_exactly(file, size, what):
+    data = file.read(size)
+    if len(data) != size:
+        raise ValueError("The dump is incomplete (it ends in " + what + ").")
+    return data
+
+
+def _compressor(code, level):
+    if code == 1:
+        if level is None:
+            return zlib.compress
+        return lambda data: zlib.compress(data, level)
+    elif code == 2:
+        lzma = _import_lzma()
+        preset = lzma.PRESET_DEFAULT if level is None else level
+        return lambda data: lzma.compress(data, format=lzma.FORMAT_ALONE, preset=preset)
+    return None
+
+
+def _decompressor(code):
+    if code == 1:
+        return zlib.decompress
+    elif code == 2:
+        lzma = _import_lzma()
+        return lambda data: lzma.decompress(data, format=lzma.FORMAT_ALONE)
+    return None
+
+
+def _import_lzma():
+    # Some Python builds lack the lzma module.
+    try:
+        import lzma
+    except ImportError:
+        raise ImportError("lzma compression requires Python's lzma module, which this Python lacks.") from None
+    return lzma
@@ -0,0 +1,420 @@
+# history.py
+# Content-addressed hub memory snapshot history for PeekPoke
+# source: https://github.com/chris-siedell/PeekPoke
+# python: https://pypi.org/project/peekpoke/
+# homepage: http://siedell.com/projects/PeekPoke/
+
+
+# A SnapshotStore keeps a history of hub memory snapshots in a directory. Each
+#  snapshot is split into fixed size blocks, aligned to multiples of the block
+#  size, and each distinct block is stored only once (blocks are identified
+#  by a BLAKE2b hash of their contents). When only a few hundred bytes change
+#  between snapshots only the blocks containing them take new space.
+#
+# The directory holds two append-only files:
+#   blocks.pack     a header (b'PPBP', uint16 version, uint16 0) followed by
+#                   records of a 16 byte hash and a block encoded as in dump
+#                   files (see peekpoke.dump), including its CRC-32,
+#   snapshots.idx   a header (b'PPSI', uint16 version, uint16 block size)
+#                   followed by snapshot records: float64 timestamp,
+#                   4 byte layout_id, uint32 identifier, uint16 range count,
+#                   uint32 block count, range count (uint32, uint32) ranges,
+#                   and then a uint32 block number for each block.
+# Block numbers are positions in blocks.pack, so the index costs four bytes
+#  per block per snapshot. Blocks are added to the pack before the snapshot
+#  referencing them is added to the index, and an incomplete record at the
+#  end of either file (from an interrupted write) is removed on opening.
+#
+# The index is loaded into memory on opening. Reading a range of a snapshot
+#  only reads the blocks covering it, and decoded blocks are kept in a small
+#  cache.
+
+
+import bisect
+import hashlib
+import os
+import struct
+import time
+
+from peekpoke.dump import COMPRESSION_CODES
+from peekpoke.dump import DumpHeader
+from peekpoke.dump import DumpReader
+from peekpoke.dump import DumpWriter
+from peekpoke.dump import _BLOCK
+from peekpoke.dump import _compressor
+from peekpoke.dump import _decompressor
+from peekpoke.dump import _encode_block
+from peekpoke.dump import _read_block
+
+
+FORMAT_VERSION = 1
+
+_PACK_HEADER = struct.Struct('<4sHH')
+_INDEX_HEADER = struct.Struct('<4sHH')
+_SNAPSHOT = struct.Struct('<d4sIHI')
+_RANGE = struct.Struct('<II')
+_HASH_SIZE = 16
+
+
+class Snapshot():
+
+    # Describes a snapshot in a SnapshotStore. ranges is a sorted list of
+    #  (hub_address, count) tuples. The block numbers are internal.
+
+    def __init__(self, index, timestamp, layout_id, identifier, ranges, block_numbers):
+        self.index = index
+        self.timestamp = timestamp
+        self.layout_id = layout_id
+        self.identifier = identifier
+        self.ranges = ranges
+        self._block_numbers = block_numbers
+        self._block_addresses = None
+
+    def __str__(self):
+        return "Snapshot " + str(self.index) + ", timestamp: " + str(self.timestamp) + ", ranges: " + str(self.ranges)
+
+
+class SnapshotStore():
+
+    def __init__(self, directory, *, block_size=256, compression='zlib', level=None, cache_blocks=256):
+        # block_size and compression are only used when creating a new store. An
+        #  existing store keeps the values it was created with.
+        if compression not in COMPRESSION_CODES:
+            raise ValueError("Unknown compression '" + str(compression) + "'. It must be 'none', 'zlib', or 'lzma'.")
+        if block_size < 1 or block_size > 65535:
+            raise ValueError("block_size must be 1 to 65535.")
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._cache_blocks = cache_blocks
+        self._cache = {}
+        self._snapshots = []
+        self._timestamps = []
+        self._block_offsets = []
+        self._block_numbers_by_hash = {}
+        self._open_pack(COMPRESSION_CODES[compression], level)
+        self._open_index(block_size)
+
+    @property
+    def block_size(self):
+        return self._block_size
+
+    @property
+    def snapshots(self):
+        """The list of Snapshot objects, oldest first."""
+        return list(self._snapshots)
+
+    @property
+    def block_count(self):
+        """The number of distinct blocks stored."""
+        return len(self._block_offsets)
+
+    def close(self):
+        if self._pack is not None:
+            self._pack.close()
+            self._index.close()
+            self._pack = None
+            self._index = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def capture(self, peekpoke, ranges=None, *, timestamp=None):
+        """Reads hub memory from the PeekPoke object and adds it as a snapshot. Returns the Snapshot."""
+        # ranges is a list of (hub_address, count) tuples, and by default is the
+        #  device's entire allowed read range. Each range is read with a single
+        #  get_bytes call, so the fewest readHub commands are used, and is then
+        #  divided into blocks.
+        info = peekpoke.get_info()
+        if ranges is None:
+            ranges = [(info.min_read_address, info.max_read_address + 1 - info.min_read_address)]
+        ranges = sorted((hub_address, count) for hub_address, count in ranges if count > 0)
+        for hub_address, count in ranges:
+            peekpoke._verify_hub_args(hub_address, count, True, False)
+        if timestamp is None:
+            timestamp = time.time()
+        block_numbers = []
+        for hub_address, count in ranges:
+            data = memoryview(peekpoke.get_bytes(hub_address, count))
+            for block_address, size in self._split(hub_address, count):
+                offset = block_address - hub_address
+                block_numbers.append(self._add_block(block_address, data[offset:offset+size]))
+        return self._add_snapshot(timestamp, bytes(info.layout_id), info.identifier, ranges, block_numbers)
+
+    def add(self, hub_address, data, *, timestamp=None, layout_id=b'\x00\x00\x00\x00', identifier=0):
+        """Adds an image of hub memory starting at hub_address as a snapshot. Returns the Snapshot."""
+        if timestamp is None:
+            timestamp = time.time()
+        data = memoryview(data)
+        block_numbers = []
+        for block_address, size in self._split(hub_address, len(data)):
+            offset = block_address - hub_address
+            block_numbers.append(self._add_block(block_address, data[offset:offset+size]))
+        ranges = [(hub_address, len(data))] if len(data) > 0 else []
+        return self._add_snapshot(timestamp, bytes(layout_id), identifier, ranges, block_numbers)
+
+    def add_dump(self, file):
+        """Adds the contents of a dump file (see peekpoke.dump) as a snapshot. Returns the Snapshot."""
+        # The dump's blocks are regrouped into the store's blocks. A dump's ranges
+        #  must not overlap.
+        with DumpReader(file) as reader:
+            header = reader.header
+            ranges = sorted(header.ranges)
+            images = [bytearray(count) for _hub_address, count in ranges]
+            starts = [hub_address for hub_address, _count in ranges]
+            for hub_address, data in reader:
+                i = bisect.bisect_right(starts, hub_address) - 1
+                if i < 0 or hub_address + len(data) > starts[i] + len(images[i]):
+                    raise ValueError("The dump has a block outside its ranges.")
+                offset = hub_address - starts[i]
+                images[i][offset:offset+len(data)] = data
+        block_numbers = []
+        for (hub_address, count), image in zip(ranges, images):
+            for block_address, size in self._split(hub_address, count):
+                offset = block_address - hub_address
+                block_numbers.append(self._add_block(block_address, image[offset:offset+size]))
+        return self._add_snapshot(header.timestamp, header.layout_id, header.identifier, ranges, block_numbers)
+
+    def find(self, timestamp):
+        """Returns the latest Snapshot taken at or before timestamp, or None."""
+        # Snapshots are assumed to be added in time order.
+        i = bisect.bisect_right(self._timestamps, timestamp)
+        if i == 0:
+            return None
+        return self._snapshots[i-1]
+
+    def read(self, snapshot, hub_address, count):
+        """Returns the bytes at hub_address in the snapshot (a Snapshot, or its index)."""
+        # ValueError is raised if the snapshot does not cover the whole range.
+        snapshot = self._get_snapshot(snapshot)
+        if snapshot._block_addresses is None:
+            snapshot._block_addresses = [block_address for block_address, _n in self._blocks_of(snapshot)]
+        addresses = snapshot._block_addresses
+        result = bytearray(count)
+        covered = 0
+        end = hub_address + count
+        # Ranges are sorted, so the blocks are found by bisection.
+        i = max(bisect.bisect_right(addresses, hub_address) - 1, 0)
+        while i < len(addresses) and addresses[i] < end:
+            block_address = addresses[i]
+            data = self._get_block(snapshot._block_numbers[i])
+            i += 1
+            block_end = block_address + len(data)
+            if block_end <= hub_address:
+                continue
+            start = max(block_address, hub_address)
+            stop = min(block_end, end)
+            result[start-hub_address:stop-hub_address] = data[start-block_address:stop-block_address]
+            covered += stop - start
+        if covered != count:
+            raise ValueError("The snapshot does not cover the whole range.")
+        return result
+
+    def read_at(self, timestamp, hub_address, count):
+        """Returns the bytes at hub_address in the latest snapshot taken at or before timestamp."""
+        snapshot = self.find(timestamp)
+        if snapshot is None:
+            raise ValueError("There is no snapshot at or before the given time.")
+        return self.read(snapshot, hub_address, count)
+
+    def diff(self, a, b, *, gap_threshold=0):
+        """Returns a list of (hub_address, count) ranges that differ between two snapshots."""
+        # Only addresses covered by both snapshots are compared. Their ranges may
+        #  start at different offsets within a block, so the overlap is compared
+        #  block by block by address, but a block that both snapshots store with
+        #  the same block number (so the same bytes at the same address) is
+        #  skipped without reading it. Runs separated by gap_threshold or fewer
+        #  equal bytes are merged.
+        from peekpoke import PeekPoke
+        a = self._get_snapshot(a)
+        b = self._get_snapshot(b)
+        blocks_a = dict(self._blocks_of(a))
+        blocks_b = dict(self._blocks_of(b))
+        ranges = []
+        for start, end in SnapshotStore._intersect(a.ranges, b.ranges):
+            for block_address, size in self._split(start, end - start):
+                number = blocks_a.get(block_address)
+                if number is not None and number == blocks_b.get(block_address):
+                    continue
+                data_a = self.read(a, block_address, size)
+                data_b = self.read(b, block_address, size)
+                for index, run in PeekPoke._diff_ranges(data_a, data_b, gap_threshold):
+                    run_start = block_address + index
+                    if len(ranges) > 0 and run_start - (ranges[-1][0] + ranges[-1][1]) <= gap_threshold:
+                        ranges[-1] = (ranges[-1][0], run_start + run - ranges[-1][0])
+                    else:
+                        ranges.append((run_start, run))
+        return ranges
+
+    def export(self, snapshot, file, *, compression='zlib', level=None, block_size=1024):
+        """Writes a snapshot as a dump file (see peekpoke.dump). Returns the DumpHeader."""
+        snapshot = self._get_snapshot(snapshot)
+        header = DumpHeader(compression=compression, layout_id=snapshot.layout_id, identifier=snapshot.identifier,
+                            timestamp=snapshot.timestamp, ranges=snapshot.ranges)
+        with DumpWriter(file, header, level=level) as writer:
+            for hub_address, count in snapshot.ranges:
+                for offset in range(0, count, block_size):
+                    block_address = hub_address + offset
+                    writer.write_block(block_address, self.read(snapshot, block_address, min(block_size, count - offset)))
+        return header
+
+    def _split(self, hub_address, count):
+        # Yields (block_address, size) for the aligned blocks covering the range.
+        #  The first and last may be partial.
+        block_size = self._block_size
+        end = hub_address + count
+        while hub_address < end:
+            block_end = min((hub_address//block_size + 1)*block_size, end)
+            yield (hub_address, block_end - hub_address)
+            hub_address = block_end
+
+    @staticmethod
+    def _intersect(ranges_a, ranges_b):
+        # Returns a sorted list of the (start, end) intervals covered by both
+        #  lists of (hub_address, count) ranges.
+        def merged(ranges):
+            intervals = []
+            for hub_address, count in sorted(ranges):
+                if len(intervals) > 0 and hub_address <= intervals[-1][1]:
+                    intervals[-1][1] = max(intervals[-1][1], hub_address + count)
+                else:
+                    intervals.append([hub_address, hub_address + count])
+            return intervals
+        intervals_a = merged(ranges_a)
+        intervals_b = merged(ranges_b)
+        result = []
+        i = 0
+        j = 0
+        while i < len(intervals_a) and j < len(intervals_b):
+            start = max(intervals_a[i][0], intervals_b[j][0])
+            end = min(intervals_a[i][1], intervals_b[j][1])
+            if start < end:
+                result.append((start, end))
+            if intervals_a[i][1] < intervals_b[j][1]:
+                i += 1
+            else:
+                j += 1
+        return result
+
+    def _blocks_of(self, snapshot):
+        # Yields (block_address, block_number) for the snapshot's blocks.
+        numbers = iter(snapshot._block_numbers)
+        for hub_address, count in snapshot.ranges:
+            for block_address, _size in self._split(hub_address, count):
+                yield (block_address, next(numbers))
+
+    def _get_snapshot(self, snapshot):
+        if isinstance(snapshot, Snapshot):
+            return snapshot
+        return self._snapshots[snapshot]
+
+    def _get_block(self, block_number):
+        data = self._cache.get(block_number)
+        if data is None:
+            self._pack.seek(self._block_offsets[block_number] + _HASH_SIZE)
+            _hub_address, data, _crc = _read_block(self._pack, self._decompress)
+            if len(self._cache) >= self._cache_blocks:
+                # Blocks are evicted oldest first.
+                del self._cache[next(iter(self._cache))]
+            self._cache[block_number] = data
+        return data
+
+    def _add_block(self, hub_address, data):
+        # Returns the block number of the data, adding it to the pack if it is new.
+        #  The address is recorded but is not part of the block's identity.
+        digest = hashlib.blake2b(data, digest_size=_HASH_SIZE).digest()
+        block_number = self._block_numbers_by_hash.get(digest)
+        if block_number is None:
+            block, _crc = _encode_block(self._compress, hub_address, bytes(data))
+            self._pack.seek(self._pack_size)
+            self._pack.write(digest + block)
+            block_number = len(self._block_offsets)
+            self._block_offsets.append(self._pack_size)
+            self._block_numbers_by_hash[digest] = block_number
+            self._pack_size += len(digest) + len(block)
+        return block_number
+
+    def _add_snapshot(self, timestamp, layout_id, identifier, ranges, block_numbers):
+        self._pack.flush()
+        record = bytearray(_SNAPSHOT.pack(timestamp, layout_id, identifier, len(ranges), len(block_numbers)))
+        for hub_address, count in ranges:
+            record += _RANGE.pack(hub_address, count)
+        record += struct.pack('<' + str(len(block_numbers)) + 'I', *block_numbers)
+        self._index.seek(self._index_size)
+        self._index.write(record)
+        self._index.flush()
+        self._index_size += len(record)
+        snapshot = Snapshot(len(self._snapshots), timestamp, layout_id, identifier, list(ranges), block_numbers)
+        self._snapshots.append(snapshot)
+        self._timestamps.append(timestamp)
+        return snapshot
+
+    def _open_pack(self, compression, level):
+        path = os.path.join(self.directory, 'blocks.pack')
+        mode = 'r+b' if os.path.exists(path) else 'w+b'
+        self._pack = open(path, mode)
+        header = self._pack.read(_PACK_HEADER.size)
+        if len(header) == 0:
+            self._pack.write(_PACK_HEADER.pack(b'PPBP', FORMAT_VERSION, compression))
+            self._pack_size = _PACK_HEADER.size
+        else:
+            magic, version, compression = _PACK_HEADER.unpack(header)
+            if magic != b'PPBP' or version != FORMAT_VERSION:
+                raise ValueError("The block pack is not a supported PeekPoke snapshot store file.")
+            self._pack_size = self._scan_pack()
+            self._pack.truncate(self._pack_size)
+        self._compress = _compressor(compression, level)
+        self._decompress = _decompressor(compression)
+
+    def _scan_pack(self):
+        # Reads each record's hash and block header, skipping the data. Returns the
+        #  size of the intact records.
+        pack = self._pack
+        offset = _PACK_HEADER.size
+        file_size = pack.seek(0, os.SEEK_END)
+        while offset + _HASH_SIZE + _BLOCK.size <= file_size:
+            pack.seek(offset)
+            digest = pack.read(_HASH_SIZE)
+            _hub_address, _size, stored_size, _crc = _BLOCK.unpack(pack.read(_BLOCK.size))
+            end = offset + _HASH_SIZE + _BLOCK.size + stored_size
+            if end > file_size:
+                break
+            self._block_numbers_by_hash[digest] = len(self._block_offsets)
+            self._block_offsets.append(offset)
+            offset = end
+        return offset
+
+    def _open_index(self, block_size):
+        path = os.path.join(self.directory, 'snapshots.idx')
+        mode = 'r+b' if os.path.exists(path) else 'w+b'
+        self._index = open(path, mode)
+        data = self._index.read()
+        if len(data) == 0:
+            self._index.write(_INDEX_HEADER.pack(b'PPSI', FORMAT_VERSION, block_size))
+            self._index_size = _INDEX_HEADER.size
+            self._block_size = block_size
+            return
+        magic, version, self._block_size = _INDEX_HEADER.unpack_from(data, 0)
+        if magic != b'PPSI' or version != FORMAT_VERSION:
+            raise ValueError("The snapshot index is not a supported PeekPoke snapshot store file.")
+        offset = _INDEX_HEADER.size
+        block_total = len(self._block_offsets)
+        while offset + _SNAPSHOT.size <= len(data):
+            timestamp, layout_id, identifier, range_count, block_count = _SNAPSHOT.unpack_from(data, offset)
+            end = offset + _SNAPSHOT.size + range_count*_RANGE.size + block_count*4
+            if end > len(data):
+                break
+            position = offset + _SNAPSHOT.size
+            ranges = [_RANGE.unpack_from(data, position + i*_RANGE.size) for i in range(range_count)]
+            position += range_count*_RANGE.size
+            block_numbers = list(struct.unpack_from('<' + str(block_count) + 'I', data, position))
+            if any(n >= block_total for n in block_numbers):
+                # The snapshot's blocks were lost from the pack.
+                break
+            self._snapshots.append(Snapshot(len(self._snapshots), timestamp, layout_id, identifier, ranges, block_numbers))
+            self._timestamps.append(timestamp)
+            offset = end
+        self._index_size = offset
+        self._index.truncate(offset)
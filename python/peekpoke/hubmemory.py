@@ -0,0 +1,278 @@
+# hubmemory.py
+# Paged view of hub memory for PeekPoke
+# source: https://github.com/chris-siedell/PeekPoke
+# python: https://pypi.org/project/peekpoke/
+# homepage: http://siedell.com/projects/PeekPoke/
+
+
+import collections
+import struct
+import time
+
+
+class HubMemory():
+
+    # HubMemory is a sequence-like view of the 64 KB hub address space, created
+    #  by PeekPoke.hub_memory. Indexing reads through a bounded cache of pages:
+    #
+    #   hub = p.hub_memory()
+    #   hub[0x100]              # an int
+    #   hub[0x100:0x200]        # a bytearray
+    #   hub.long[0x7000]        # the long at hub address 0x7000
+    #   hub.word[0x10:0x20]     # a list of the words at 0x10, 0x12, ..., 0x1e
+    #
+    # As in Spin, the byte, word, and long views are indexed by hub address, not
+    #  by item number. The address must be aligned to the item size.
+    # Pages are read when first accessed (consecutive missing pages are read
+    #  together) and at most max_pages are kept, with the least recently used
+    #  page evicted first. A page is reread once it is older than its maximum
+    #  age: max_age by default, or the smallest age given by set_max_age for
+    #  regions overlapping it. None means pages never become stale, and 0 means
+    #  the region is always read from the device.
+    # Writes (hub[a:b] = data, hub.long[a] = value) go to the device immediately
+    #  and update any cached pages. Changes made by other means (including
+    #  other PeekPoke methods) are only seen when pages become stale or are
+    #  invalidated.
+    # Reads go through PeekPoke's usual read path, so a shadow (if enabled) is
+    #  used and write-back data is flushed first. Pages are only read within the
+    #  allowed read range. Accessing bytes outside it sends the read uncached,
+    #  so the device reports the AccessError.
+
+    def __init__(self, peekpoke, *, page_size=256, max_pages=64, max_age=None):
+        if page_size < 4 or page_size > 4096 or page_size & (page_size - 1) != 0:
+            raise ValueError("The page size must be a power of two from 4 to 4096.")
+        if max_pages < 1:
+            raise ValueError("max_pages must be at least 1.")
+        if max_age is not None and max_age < 0:
+            raise ValueError("max_age must be None or non-negative.")
+        self._peekpoke = peekpoke
+        self._page_size = page_size
+        self._page_shift = page_size.bit_length() - 1
+        self.max_pages = max_pages
+        self.max_age = max_age
+        self._region_ages = []
+        # _pages maps page numbers to [data, read_time, max_age] lists, in least
+        #  to most recently used order.
+        self._pages = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.byte = _ItemView(self, 1)
+        self.word = _ItemView(self, 2)
+        self.long = _ItemView(self, 4)
+
+    @property
+    def page_size(self):
+        return self._page_size
+
+    @property
+    def cached_pages(self):
+        return len(self._pages)
+
+    def __len__(self):
+        return 65536
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop = HubMemory._slice_bounds(key)
+            return self.read(start, stop - start)
+        index = HubMemory._index(key)
+        return self.read(index, 1)[0]
+
+    def __setitem__(self, key, value):
+        if isinstance(key, slice):
+            start, stop = HubMemory._slice_bounds(key)
+            if len(value) != stop - start:
+                raise ValueError("HubMemory slice assignment cannot change the size of hub memory.")
+            self.write(start, value)
+        else:
+            self.write(HubMemory._index(key), bytes([value]))
+
+    def __iter__(self):
+        for hub_address in range(0, 65536, self._page_size):
+            yield from self.read(hub_address, self._page_size)
+
+    def read(self, hub_address, count):
+        """Returns a bytearray of count bytes starting at hub_address."""
+        peekpoke = self._peekpoke
+        peekpoke._verify_hub_args(hub_address, count, True, False)
+        result = bytearray(count)
+        if count == 0:
+            return result
+        info = peekpoke.get_info()
+        if hub_address < info.min_read_address or hub_address + count > info.max_read_address + 1:
+            return peekpoke.get_bytes(hub_address, count)
+        now = time.monotonic()
+        shift = self._page_shift
+        end = hub_address + count
+        page = hub_address >> shift
+        last = (end - 1) >> shift
+        while page <= last:
+            data = self._cached_page(page, now)
+            if data is not None:
+                self.hits += 1
+                self._copy(result, hub_address, end, page << shift, data)
+                page += 1
+                continue
+            # Consecutive missing pages are read together.
+            run_end = page + 1
+            while run_end <= last and self._cached_page(run_end, now) is None:
+                run_end += 1
+            self.misses += run_end - page
+            run_start_address = max(page << shift, info.min_read_address)
+            run_end_address = min(run_end << shift, info.max_read_address + 1)
+            data = bytearray(run_end_address - run_start_address)
+            peekpoke._read_bytes_into(run_start_address, memoryview(data), False)
+            self._copy(result, hub_address, end, run_start_address, data)
+            for p in range(page, run_end):
+                # Each page keeps its bytes at page relative offsets; bytes outside
+                #  the allowed read range are left as zeros.
+                page_data = bytearray(self._page_size)
+                page_start = p << shift
+                lo = max(page_start, run_start_address)
+                hi = min(page_start + self._page_size, run_end_address)
+                page_data[lo-page_start:hi-page_start] = data[lo-run_start_address:hi-run_start_address]
+                self._store_page(p, page_data, now)
+            page = run_end
+        return result
+
+    def write(self, hub_address, data):
+        """Writes data to hub memory at hub_address, updating any cached pages."""
+        self._peekpoke.set_bytes(hub_address, data)
+        data = memoryview(data).cast('B')
+        if len(data) == 0:
+            return
+        shift = self._page_shift
+        end = hub_address + len(data)
+        for page in range(hub_address >> shift, ((end - 1) >> shift) + 1):
+            entry = self._pages.get(page)
+            if entry is not None:
+                page_start = page << shift
+                lo = max(page_start, hub_address)
+                hi = min(page_start + self._page_size, end)
+                entry[0][lo-page_start:hi-page_start] = data[lo-hub_address:hi-hub_address]
+
+    def invalidate(self, hub_address=0, count=65536):
+        """Discards the cached pages overlapping the range."""
+        if count <= 0:
+            return
+        shift = self._page_shift
+        for page in range(hub_address >> shift, ((hub_address + count - 1) >> shift) + 1):
+            self._pages.pop(page, None)
+
+    def set_max_age(self, hub_address, count, max_age):
+        """Sets the maximum age, in seconds, of pages overlapping the range (None for no limit)."""
+        # Cached pages in the range are discarded so the new limit applies.
+        if max_age is not None and max_age < 0:
+            raise ValueError("max_age must be None or non-negative.")
+        self._region_ages.append((hub_address, count, max_age))
+        self.invalidate(hub_address, count)
+
+    def clear_max_ages(self):
+        """Removes all limits set with set_max_age."""
+        self._region_ages = []
+        self._pages.clear()
+
+    def _cached_page(self, page, now):
+        # Returns the page's data if it is cached and fresh, updating its recency.
+        entry = self._pages.get(page)
+        if entry is None:
+            return None
+        max_age = entry[2]
+        if max_age is not None and now - entry[1] >= max_age:
+            del self._pages[page]
+            return None
+        self._pages.move_to_end(page)
+        return entry[0]
+
+    def _store_page(self, page, data, now):
+        max_age = self._page_max_age(page)
+        if max_age == 0:
+            return
+        self._pages[page] = [data, now, max_age]
+        self._pages.move_to_end(page)
+        while len(self._pages) > self.max_pages:
+            self._pages.popitem(last=False)
+            self.evictions += 1
+
+    def _page_max_age(self, page):
+        start = page << self._page_shift
+        end = start + self._page_size
+        result = self.max_age
+        overridden = False
+        for hub_address, count, max_age in self._region_ages:
+            if hub_address < end and start < hub_address + count:
+                if not overridden:
+                    result = max_age
+                    overridden = True
+                elif max_age is not None and (result is None or max_age < result):
+                    result = max_age
+        return result
+
+    @staticmethod
+    def _copy(result, hub_address, end, data_address, data):
+        # Copies the overlap of data (which starts at data_address) into result
+        #  (which holds hub_address to end).
+        lo = max(hub_address, data_address)
+        hi = min(end, data_address + len(data))
+        if lo < hi:
+            result[lo-hub_address:hi-hub_address] = data[lo-data_address:hi-data_address]
+
+    @staticmethod
+    def _index(key):
+        index = key.__index__()
+        if index < 0:
+            index += 65536
+        if index < 0 or index > 65535:
+            raise IndexError("The hub address must be 0 to 65535.")
+        return index
+
+    @staticmethod
+    def _slice_bounds(key):
+        start, stop, step = key.indices(65536)
+        if step != 1:
+            raise ValueError("HubMemory slices must have a step of 1.")
+        return start, max(start, stop)
+
+
+class _ItemView():
+
+    # The byte, word, and long views of a HubMemory object. Items are unsigned
+    #  and little endian, and are indexed by hub address.
+
+    _CODES = {1: 'B', 2: 'H', 4: 'I'}
+
+    def __init__(self, hub, size):
+        self._hub = hub
+        self._size = size
+        self._struct = struct.Struct('<' + _ItemView._CODES[size])
+
+    def __getitem__(self, key):
+        size = self._size
+        if isinstance(key, slice):
+            start, stop = HubMemory._slice_bounds(key)
+            self._verify_alignment(start)
+            count = -(-(stop - start)//size)
+            data = self._hub.read(start, count*size)
+            return list(struct.unpack('<' + str(count) + _ItemView._CODES[size], data))
+        hub_address = HubMemory._index(key)
+        self._verify_alignment(hub_address)
+        return self._struct.unpack(self._hub.read(hub_address, size))[0]
+
+    def __setitem__(self, key, value):
+        size = self._size
+        if isinstance(key, slice):
+            start, stop = HubMemory._slice_bounds(key)
+            self._verify_alignment(start)
+            values = list(value)
+            if len(values) != -(-(stop - start)//size):
+                raise ValueError("The number of values does not match the slice.")
+            self._hub.write(start, struct.pack('<' + str(len(values)) + _ItemView._CODES[size], *values))
+        else:
+            hub_address = HubMemory._index(key)
+            self._verify_alignment(hub_address)
+            self._hub.write(hub_address, self._struct.pack(value))
+
+    def _verify_alignment(self, hub_address):
+        if hub_address % self._size != 0:
+            raise ValueError("The hub address must be a multiple of " + str(self._size) + ".")
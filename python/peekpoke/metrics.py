@@ -0,0 +1,135 @@
+# metrics.py
+# Per-command metrics for PeekPoke
+# source: https://github.com/chris-siedell/PeekPoke
+# python: https://pypi.org/project/peekpoke/
+# homepage: http://siedell.com/projects/PeekPoke/
+
+
+import bisect
+import time
+
+
+# Names for the PeekPoke command codes.
+COMMAND_NAMES = {
+    0: 'get_info',
+    1: 'read_hub',
+    2: 'write_hub',
+    3: 'read_hub_str',
+    4: 'get_serial_timings',
+    5: 'set_serial_timings',
+    6: 'get_token',
+    7: 'set_token',
+    8: 'payload_exec',
+}
+
+
+# The upper bounds, in seconds, of the latency histogram buckets. There is an
+#  additional bucket for latencies above the last bound.
+LATENCY_BOUNDS = (0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0)
+
+
+class CommandMetrics():
+
+    # CommandMetrics collects statistics for the commands sent by a PeekPoke
+    #  object. It is created by PeekPoke.enable_metrics, and PeekPoke calls the
+    #  record methods. When metrics are disabled no collector exists, so the
+    #  only cost is a None check per command.
+    # For each command code the following are kept:
+    #   - count: the number of commands sent, including those that failed,
+    #   - bytes_out and bytes_in: command and response payload bytes,
+    #   - latency: total, max, and a histogram (see LATENCY_BOUNDS), for
+    #     commands that received a response,
+    #   - retries: commands resent after a pipeline stall,
+    #   - access_errors, peekpoke_errors, and other_errors.
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Clears all statistics."""
+        self._stats = {}
+        self._start_time = time.monotonic()
+        self.baudrate = None
+
+    def snapshot(self):
+        """Returns a dict of the statistics collected since creation or the last reset."""
+        commands = {}
+        for code in sorted(self._stats):
+            stats = self._stats[code]
+            histogram = []
+            for index, count in enumerate(stats.histogram):
+                bound = LATENCY_BOUNDS[index] if index < len(LATENCY_BOUNDS) else None
+                histogram.append((bound, count))
+            responses = sum(stats.histogram)
+            commands[COMMAND_NAMES.get(code, str(code))] = {
+                'count': stats.count,
+                'bytes_out': stats.bytes_out,
+                'bytes_in': stats.bytes_in,
+                'latency_total': stats.latency_total,
+                'latency_mean': stats.latency_total/responses if responses > 0 else None,
+                'latency_max': stats.latency_max,
+                'latency_histogram': histogram,
+                'retries': stats.retries,
+                'access_errors': stats.access_errors,
+                'peekpoke_errors': stats.peekpoke_errors,
+                'other_errors': stats.other_errors,
+            }
+        return {
+            'elapsed': time.monotonic() - self._start_time,
+            'baudrate': self.baudrate,
+            'commands': commands,
+        }
+
+    def record(self, command_code, bytes_out, bytes_in, latency, baudrate):
+        # Records a command that received a response.
+        stats = self._get_stats(command_code)
+        stats.count += 1
+        stats.bytes_out += bytes_out
+        stats.bytes_in += bytes_in
+        stats.latency_total += latency
+        if latency > stats.latency_max:
+            stats.latency_max = latency
+        stats.histogram[bisect.bisect_left(LATENCY_BOUNDS, latency)] += 1
+        self.baudrate = baudrate
+
+    def record_failure(self, command_code, bytes_out, kind):
+        # Records a command that raised an exception. kind is 'access_error',
+        #  'peekpoke_error', or 'other_error'.
+        stats = self._get_stats(command_code)
+        stats.count += 1
+        stats.bytes_out += bytes_out
+        self.record_error(command_code, kind)
+
+    def record_error(self, command_code, kind):
+        # Records an error for a command already counted (e.g. a PeekPokeError
+        #  raised while parsing a response).
+        stats = self._get_stats(command_code)
+        setattr(stats, kind + 's', getattr(stats, kind + 's') + 1)
+
+    def record_retries(self, command_code, count):
+        self._get_stats(command_code).retries += count
+
+    def _get_stats(self, command_code):
+        stats = self._stats.get(command_code)
+        if stats is None:
+            stats = _CommandStats()
+            self._stats[command_code] = stats
+        return stats
+
+
+class _CommandStats():
+
+    __slots__ = ('count', 'bytes_out', 'bytes_in', 'latency_total', 'latency_max', 'histogram',
+                 'retries', 'access_errors', 'peekpoke_errors', 'other_errors')
+
+    def __init__(self):
+        self.count = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.histogram = [0] * (len(LATENCY_BOUNDS) + 1)
+        self.retries = 0
+        self.access_errors = 0
+        self.peekpoke_errors = 0
+        self.other_errors = 0
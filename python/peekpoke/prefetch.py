@@ -0,0 +1,138 @@
+# prefetch.py
+# Sequential read-ahead for PeekPoke
+# source: https://github.com/chris-siedell/PeekPoke
+# python: https://pypi.org/project/peekpoke/
+# homepage: http://siedell.com/projects/PeekPoke/
+
+
+import time
+
+
+# The cost of a readHub command's overhead, in bytes: headers, checksums, and the
+#  response header (the turnaround time is extra). Each hit saves at least this.
+COMMAND_COST = 32
+
+
+class ReadAhead():
+
+    # ReadAhead detects sequential and strided hub reads and lets PeekPoke read
+    #  ahead of them. It is created by PeekPoke.enable_prefetch, and PeekPoke
+    #  consults it for reads not served by the shadow. ReadAhead itself performs
+    #  no communication.
+    # A pattern is established when min_confidence consecutive reads are each
+    #  the same positive distance (the stride) after the previous one. Walking a
+    #  table with get_int or get_bytes produces such a pattern. Once it is
+    #  established a read that continues the pattern is extended to a full
+    #  max_atomic_read window, still with a single readHub command, and the
+    #  extra bytes are kept. Later reads that fall entirely within the window
+    #  are served from it, without a command, for up to max_age seconds.
+    # The window is discarded when any write is sent, or when a read misses it.
+    #  Bytes of a discarded window that were never used are counted as wasted.
+    #  Read-ahead is disabled (until reset) once more than max_wasted_bytes
+    #  have been wasted and the waste exceeds the overhead saved by the hits,
+    #  counting COMMAND_COST bytes per hit. Strided reads leave gaps unused, but
+    #  still pay off as long as each window serves a few reads.
+
+    def __init__(self, *, max_age=0.1, min_confidence=2, max_wasted_bytes=8192):
+        if max_age <= 0:
+            raise ValueError("max_age must be greater than zero.")
+        if min_confidence < 1:
+            raise ValueError("min_confidence must be at least 1.")
+        self.max_age = max_age
+        self.min_confidence = min_confidence
+        self.max_wasted_bytes = max_wasted_bytes
+        self.reset()
+
+    def reset(self):
+        """Clears the statistics, the detected pattern, and any window, and re-enables read-ahead."""
+        self.enabled = True
+        self.requests = 0
+        self.hits = 0
+        self.windows = 0
+        self.prefetched_bytes = 0
+        self.used_bytes = 0
+        self.wasted_bytes = 0
+        self._last_address = None
+        self._stride = None
+        self._confidence = 0
+        self._window = None
+
+    @property
+    def hit_rate(self):
+        """The fraction of reads served from a window, or None if there have been none."""
+        if self.requests == 0:
+            return None
+        return self.hits / self.requests
+
+    def snapshot(self):
+        """Returns a dict of the statistics."""
+        return {
+            'enabled': self.enabled,
+            'requests': self.requests,
+            'hits': self.hits,
+            'hit_rate': self.hit_rate,
+            'windows': self.windows,
+            'prefetched_bytes': self.prefetched_bytes,
+            'used_bytes': self.used_bytes,
+            'wasted_bytes': self.wasted_bytes,
+        }
+
+    def invalidate(self):
+        # Discards the window (called when hub memory may have changed).
+        window = self._window
+        if window is None:
+            return
+        self._window = None
+        self.wasted_bytes += window[3].count(0)
+        self.used_bytes += window[3].count(1)
+        if self.wasted_bytes > self.max_wasted_bytes and self.wasted_bytes > self.hits*COMMAND_COST:
+            self.enabled = False
+
+    def lookup(self, hub_address, count, now=None):
+        # Returns a memoryview of the bytes if the read falls within a fresh
+        #  window, otherwise None (discarding the window if the read missed it).
+        self.requests += 1
+        window = self._window
+        if window is None:
+            return None
+        start, data, read_time, used = window
+        if now is None:
+            now = time.monotonic()
+        offset = hub_address - start
+        if now - read_time >= self.max_age or offset < 0 or offset + count > len(data):
+            self.invalidate()
+            return None
+        self.hits += 1
+        used[offset:offset+count] = b'\x01' * count
+        return memoryview(data)[offset:offset+count]
+
+    def observe(self, hub_address, count):
+        # Records a read for pattern detection.
+        if self._last_address is not None:
+            stride = hub_address - self._last_address
+            if stride > 0 and stride == self._stride:
+                self._confidence += 1
+            else:
+                self._stride = stride
+                self._confidence = 1 if stride > 0 else 0
+        self._last_address = hub_address
+
+    def should_extend(self, hub_address, count, window_size):
+        # Returns True if a read (which missed any window) continues the pattern
+        #  and there is room in the window for at least one more read.
+        if not self.enabled or self._confidence < self.min_confidence:
+            return False
+        stride = self._stride
+        return hub_address - self._last_address == stride and stride + count <= window_size
+
+    def store(self, hub_address, data, count, now=None):
+        # Keeps an extended read as the new window. The first count bytes were
+        #  read anyway, so they are marked 2 (not prefetched) rather than 1 (used).
+        self.invalidate()
+        if now is None:
+            now = time.monotonic()
+        used = bytearray(len(data))
+        used[0:count] = b'\x02' * count
+        self._window = (hub_address, data, now, used)
+        self.windows += 1
+        self.prefetched_bytes += len(data) - count
@@ -0,0 +1,183 @@
+# shadow.py
+# Client-side shadow of hub memory for PeekPoke
+# source: https://github.com/chris-siedell/PeekPoke
+# python: https://pypi.org/project/peekpoke/
+# homepage: http://siedell.com/projects/PeekPoke/
+
+
+import time
+
+
+class HubShadow():
+
+    # HubShadow is a local mirror of the 64 KB hub address space. It is created
+    #  by PeekPoke.enable_shadow, and PeekPoke consults it when reading and
+    #  writing. HubShadow itself performs no communication.
+    # Validity is tracked per page. A page becomes valid when it is read in full
+    #  from the device, and stays valid until it is invalidated or, if ttl is not
+    #  None, until ttl seconds have passed since it was read.
+    # In write-back mode writes are made to the mirror and the modified bytes are
+    #  marked dirty until PeekPoke flushes them. In write-through mode writes go
+    #  to the device immediately and the mirror is updated afterwards.
+    # Volatile regions are never served from the mirror and are never buffered.
+
+    def __init__(self, *, page_size=64, ttl=None, write_back=False):
+        if page_size < 4 or page_size > 4096 or page_size & (page_size - 1) != 0:
+            raise ValueError("The page size must be a power of two from 4 to 4096.")
+        if ttl is not None and ttl <= 0:
+            raise ValueError("The ttl must be None or greater than zero.")
+        self._page_size = page_size
+        self._page_shift = page_size.bit_length() - 1
+        self.ttl = ttl
+        self.write_back = write_back
+        self.memory = bytearray(65536)
+        # _read_times[page] is the time the page was read, or None if invalid.
+        self._read_times = [None] * (65536 >> self._page_shift)
+        # _dirty has a non-zero byte for each hub byte with an unflushed write.
+        self._dirty = bytearray(65536)
+        self._dirty_count = 0
+        self._volatile = []
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def page_size(self):
+        return self._page_size
+
+    @property
+    def volatile_regions(self):
+        """A list of (hub_address, count) tuples."""
+        return list(self._volatile)
+
+    @property
+    def has_dirty(self):
+        return self._dirty_count > 0
+
+    def add_volatile(self, hub_address, count):
+        """Marks a region that must always be read from and written to the device."""
+        HubShadow._verify_range(hub_address, count)
+        if count > 0:
+            self._volatile.append((hub_address, count))
+
+    def remove_volatile(self, hub_address, count):
+        """Removes a region previously added with add_volatile."""
+        self._volatile.remove((hub_address, count))
+
+    def is_volatile(self, hub_address, count):
+        """Returns True if the range overlaps any volatile region."""
+        end = hub_address + count
+        for start, n in self._volatile:
+            if hub_address < start + n and start < end:
+                return True
+        return False
+
+    def reset(self):
+        """Discards the contents and any buffered writes, keeping the settings and volatile regions."""
+        self.memory[:] = bytes(65536)
+        self._read_times = [None] * len(self._read_times)
+        self._dirty[:] = bytes(65536)
+        self._dirty_count = 0
+
+    def invalidate(self, hub_address=0, count=65536):
+        """Marks the pages overlapping the range as invalid. Dirty bytes are kept."""
+        HubShadow._verify_range(hub_address, count)
+        if count == 0:
+            return
+        first = hub_address >> self._page_shift
+        last = (hub_address + count - 1) >> self._page_shift
+        for page in range(first, last + 1):
+            self._read_times[page] = None
+
+    def is_valid(self, hub_address, count, now=None):
+        """Returns True if every page overlapping the range is valid."""
+        return len(self.missing_ranges(hub_address, count, now=now)) == 0
+
+    def missing_ranges(self, hub_address, count, *, now=None):
+        # Returns a list of (hub_address, count) tuples for the runs of invalid
+        #  pages overlapping the range. The tuples are page aligned.
+        if count == 0:
+            return []
+        if now is None:
+            now = time.monotonic()
+        ttl = self.ttl
+        shift = self._page_shift
+        ranges = []
+        run_start = None
+        last = (hub_address + count - 1) >> shift
+        for page in range(hub_address >> shift, last + 1):
+            t = self._read_times[page]
+            if t is None or (ttl is not None and now - t >= ttl):
+                if run_start is None:
+                    run_start = page
+            elif run_start is not None:
+                ranges.append((run_start << shift, (page - run_start) << shift))
+                run_start = None
+        if run_start is not None:
+            ranges.append((run_start << shift, (last + 1 - run_start) << shift))
+        return ranges
+
+    def store(self, hub_address, data, *, now=None):
+        # Stores data read from the device. Pages entirely covered become valid.
+        #  Dirty bytes in the range must have been flushed first.
+        count = len(data)
+        self.memory[hub_address:hub_address+count] = data
+        self.mark_valid(hub_address, count, now=now)
+
+    def mark_valid(self, hub_address, count, *, now=None):
+        # Used when data has been read from the device directly into memory.
+        #  Pages entirely covered become valid.
+        if now is None:
+            now = time.monotonic()
+        shift = self._page_shift
+        first = (hub_address + self._page_size - 1) >> shift
+        end = (hub_address + count) >> shift
+        for page in range(first, end):
+            self._read_times[page] = now
+
+    def update(self, hub_address, data):
+        # Records data just written to the device. Validity is unchanged, and
+        #  any dirty bytes in the range are superseded.
+        count = len(data)
+        self.memory[hub_address:hub_address+count] = data
+        if self._dirty_count > 0:
+            self.clear_dirty(hub_address, count)
+
+    def write(self, hub_address, data):
+        # Records a buffered (write-back) write.
+        count = len(data)
+        self.memory[hub_address:hub_address+count] = data
+        self._dirty_count += count - self._dirty[hub_address:hub_address+count].count(1)
+        self._dirty[hub_address:hub_address+count] = b'\x01' * count
+
+    def dirty_ranges(self, hub_address=0, count=65536):
+        # Returns a list of (hub_address, count) tuples for the runs of dirty
+        #  bytes within the range.
+        ranges = []
+        if self._dirty_count == 0:
+            return ranges
+        dirty = self._dirty
+        index = hub_address
+        end = hub_address + count
+        while index < end:
+            start = dirty.find(1, index, end)
+            if start == -1:
+                break
+            stop = dirty.find(0, start, end)
+            if stop == -1:
+                stop = end
+            ranges.append((start, stop - start))
+            index = stop
+        return ranges
+
+    def clear_dirty(self, hub_address, count):
+        # Called after the dirty bytes in the range have been written to the device.
+        self._dirty_count -= self._dirty[hub_address:hub_address+count].count(1)
+        self._dirty[hub_address:hub_address+count] = bytes(count)
+
+    @staticmethod
+    def _verify_range(hub_address, count):
+        if hub_address < 0 or hub_address > 65535:
+            raise ValueError("The hub address must be 0 to 65535.")
+        if count < 0 or hub_address + count > 65536:
+            raise ValueError("The range must be within the hub address space.")
+
@@ -0,0 +1,297 @@
+# shared.py
+# Thread-safe, scheduled front-end for PeekPoke
+# source: https://github.com/chris-siedell/PeekPoke
+# python: https://pypi.org/project/peekpoke/
+# homepage: http://siedell.com/projects/PeekPoke/
+
+
+import bisect
+import collections
+import threading
+import time
+
+from peekpoke import PeekPoke
+from peekpoke.metrics import LATENCY_BOUNDS
+
+
+# The priority classes, most urgent first.
+PRIORITIES = ('high', 'normal', 'low')
+
+
+class SharedPeekPoke():
+
+    # SharedPeekPoke lets several threads use one PeekPoke object. Work is done
+    #  in turns, and only one thread has the turn at a time. The calling thread
+    #  performs its own work while it has the turn, so results and exceptions
+    #  are returned as usual and there is no worker thread.
+    # get_bytes, get_bytes_into, and set_bytes split large jobs at max_atomic_read
+    #  or max_atomic_write boundaries (commands_per_turn commands per turn, which
+    #  are pipelined if the pipeline window allows), taking a new turn for each
+    #  piece. So a small high priority command waits for at most one piece of a
+    #  long dump, not the whole dump. dump and restore are performed the same way
+    #  (dump reads each range as one job, and restore writes each block as one).
+    # When a turn ends it is given to the most urgent priority class with a
+    #  waiting thread. Within a class turns go round-robin between callers, so a
+    #  caller with many large jobs does not crowd out the others. The caller is
+    #  the calling thread unless a caller key is given. Priority between classes
+    #  is strict, so a steady stream of high priority work delays low priority
+    #  work indefinitely.
+    # Every other public PeekPoke method is available with the same arguments,
+    #  plus priority and caller keywords, and is performed in a single turn, as
+    #  is submit. The exceptions are batch and hub_memory, since the objects they
+    #  return use the PeekPoke object later (use them within submit instead).
+    #  Work done during a turn must not call this object again (the thread would
+    #  wait for its own turn forever).
+    # The underlying PeekPoke object (the peekpoke property) holds the settings
+    #  and cached info. It may be used directly inside submit, but not otherwise.
+
+    def __init__(self, serial_port_name, address=1, port=112, *, commands_per_turn=1, **kwargs):
+        # Other keyword arguments are passed to PeekPoke.
+        if commands_per_turn < 1:
+            raise ValueError("commands_per_turn must be at least 1.")
+        self._peekpoke = PeekPoke(serial_port_name, address, port, **kwargs)
+        self.commands_per_turn = commands_per_turn
+        self.metrics = SchedulerMetrics()
+        self._lock = threading.Lock()
+        self._busy = False
+        # _waiting maps each priority to an OrderedDict of caller keys to deques
+        #  of the Events of the threads waiting for a turn.
+        self._waiting = {priority: collections.OrderedDict() for priority in PRIORITIES}
+
+    @property
+    def peekpoke(self):
+        return self._peekpoke
+
+    def __getattr__(self, name):
+        # Forwards the other public PeekPoke methods as single turn jobs.
+        if name.startswith('_') or name in ('batch', 'hub_memory') or not callable(getattr(PeekPoke, name, None)):
+            raise AttributeError("'SharedPeekPoke' object has no attribute '" + name + "'")
+        method = getattr(PeekPoke, name)
+        def forwarded(*args, priority='normal', caller=None, **kwargs):
+            return self.submit(method, *args, priority=priority, caller=caller, **kwargs)
+        forwarded.__name__ = name
+        forwarded.__doc__ = method.__doc__
+        return forwarded
+
+    def submit(self, function, *args, priority='normal', caller=None, **kwargs):
+        """Calls function(peekpoke, *args, **kwargs) in a single turn and returns its result."""
+        return self._run_job(priority, caller, lambda peekpoke: [()], lambda peekpoke: function(peekpoke, *args, **kwargs))
+
+    def get_bytes(self, hub_address, count, *, atomic=False, priority='normal', caller=None):
+        result = bytearray(count)
+        self.get_bytes_into(hub_address, result, atomic=atomic, priority=priority, caller=caller)
+        return result
+
+    def get_bytes_into(self, hub_address, buffer, *, atomic=False, priority='normal', caller=None):
+        """Reads len(buffer) bytes into buffer, taking a turn for each piece. Returns the number of bytes read."""
+        view = PeekPoke._byte_view(buffer)
+        count = len(view)
+        def plan(peekpoke):
+            peekpoke._verify_hub_args(hub_address, count, True, atomic)
+            return PeekPoke._split_hub_range(hub_address, count, peekpoke.get_info().max_atomic_read*self.commands_per_turn)
+        def perform(peekpoke, address, n):
+            index = address - hub_address
+            peekpoke.get_bytes_into(address, view[index:index+n], atomic=atomic)
+        self._run_job(priority, caller, plan, perform)
+        return count
+
+    def set_bytes(self, hub_address, data, *, atomic=False, priority='normal', caller=None):
+        """Writes data to hub memory, taking a turn for each piece."""
+        view = memoryview(data).cast('B')
+        count = len(view)
+        def plan(peekpoke):
+            peekpoke._verify_hub_args(hub_address, count, False, atomic)
+            return PeekPoke._split_hub_range(hub_address, count, peekpoke.get_info().max_atomic_write*self.commands_per_turn)
+        def perform(peekpoke, address, n):
+            index = address - hub_address
+            peekpoke.set_bytes(address, view[index:index+n], atomic=atomic)
+        self._run_job(priority, caller, plan, perform)
+
+    def dump(self, file, ranges=None, *, compression='zlib', level=None, block_size=1024, priority='low', caller=None):
+        """Reads hub memory into a dump file (see PeekPoke.dump), taking turns as get_bytes does. Returns the DumpHeader."""
+        from peekpoke import dump
+        return dump.dump(_PrioritizedView(self, priority, caller), file, ranges, compression=compression, level=level, block_size=block_size)
+
+    def restore(self, file, *, check_device=True, priority='low', caller=None):
+        """Writes a dump file back to hub memory (see PeekPoke.restore), taking turns as set_bytes does. Returns the number of bytes written."""
+        from peekpoke import dump
+        return dump.restore(_PrioritizedView(self, priority, caller), file, check_device=check_device)
+
+    def _run_job(self, priority, caller, plan, perform):
+        # Performs a job in turns. plan is called during the first turn and returns
+        #  a list of argument tuples, and perform is called with each, one per
+        #  turn. With a single tuple perform's result is returned.
+        if priority not in PRIORITIES:
+            raise ValueError("The priority must be 'high', 'normal', or 'low'.")
+        if caller is None:
+            caller = threading.get_ident()
+        peekpoke = self._peekpoke
+        start = time.perf_counter()
+        wait = 0.0
+        turns = 0
+        pieces = None
+        result = None
+        try:
+            while pieces is None or turns < len(pieces):
+                wait += self._acquire(priority, caller)
+                try:
+                    if pieces is None:
+                        pieces = plan(peekpoke)
+                    if turns < len(pieces):
+                        result = perform(peekpoke, *pieces[turns])
+                        turns += 1
+                finally:
+                    self._release()
+        except Exception:
+            self.metrics.record(priority, time.perf_counter() - start, wait, turns, False)
+            raise
+        self.metrics.record(priority, time.perf_counter() - start, wait, turns, True)
+        return result
+
+    def _acquire(self, priority, caller):
+        # Waits for a turn, returning the time spent waiting.
+        with self._lock:
+            if not self._busy:
+                self._busy = True
+                return 0.0
+            event = threading.Event()
+            callers = self._waiting[priority]
+            queue = callers.get(caller)
+            if queue is None:
+                queue = collections.deque()
+                callers[caller] = queue
+            queue.append(event)
+        start = time.perf_counter()
+        try:
+            event.wait()
+        except BaseException:
+            # E.g. KeyboardInterrupt. The turn must not be lost if it was given.
+            with self._lock:
+                if event in queue:
+                    queue.remove(event)
+                    if len(queue) == 0 and callers.get(caller) is queue:
+                        del callers[caller]
+                    event = None
+            if event is not None:
+                self._release()
+            raise
+        return time.perf_counter() - start
+
+    def _release(self):
+        # Gives the turn to the next waiting thread: the first caller of the most
+        #  urgent class, which then moves to the back of its class.
+        with self._lock:
+            for priority in PRIORITIES:
+                callers = self._waiting[priority]
+                if len(callers) == 0:
+                    continue
+                caller, queue = next(iter(callers.items()))
+                event = queue.popleft()
+                if len(queue) == 0:
+                    del callers[caller]
+                else:
+                    callers.move_to_end(caller)
+                # The turn passes directly to the waiting thread, so _busy stays True.
+                event.set()
+                return
+            self._busy = False
+
+
+class _PrioritizedView():
+
+    # The subset of the PeekPoke interface used by peekpoke.dump, performed
+    #  through a SharedPeekPoke with a fixed priority and caller.
+
+    def __init__(self, shared, priority, caller):
+        self._shared = shared
+        self._priority = priority
+        self._caller = threading.get_ident() if caller is None else caller
+
+    def get_info(self):
+        return self._shared.submit(PeekPoke.get_info, priority=self._priority, caller=self._caller)
+
+    def get_bytes(self, hub_address, count):
+        return self._shared.get_bytes(hub_address, count, priority=self._priority, caller=self._caller)
+
+    def set_bytes(self, hub_address, data):
+        self._shared.set_bytes(hub_address, data, priority=self._priority, caller=self._caller)
+
+    def _verify_hub_args(self, hub_address, count, is_read, atomic):
+        self._shared.submit(PeekPoke._verify_hub_args, hub_address, count, is_read, atomic, priority=self._priority, caller=self._caller)
+
+
+class SchedulerMetrics():
+
+    # Statistics kept by a SharedPeekPoke for each priority class:
+    #   - jobs and errors: the jobs finished, and those that raised,
+    #   - turns: the turns taken (one per piece of a split job),
+    #   - latency: total, max, and a histogram (see peekpoke.metrics.LATENCY_BOUNDS)
+    #     of the time from a call to its return,
+    #   - wait: total and max of the time jobs spent waiting for turns.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Clears all statistics."""
+        with self._lock:
+            self._stats = {priority: _ClassStats() for priority in PRIORITIES}
+            self._start_time = time.monotonic()
+
+    def snapshot(self):
+        """Returns a dict of the statistics collected since creation or the last reset."""
+        classes = {}
+        with self._lock:
+            for priority in PRIORITIES:
+                stats = self._stats[priority]
+                histogram = []
+                for index, count in enumerate(stats.histogram):
+                    bound = LATENCY_BOUNDS[index] if index < len(LATENCY_BOUNDS) else None
+                    histogram.append((bound, count))
+                classes[priority] = {
+                    'jobs': stats.jobs,
+                    'errors': stats.errors,
+                    'turns': stats.turns,
+                    'latency_total': stats.latency_total,
+                    'latency_mean': stats.latency_total/stats.jobs if stats.jobs > 0 else None,
+                    'latency_max': stats.latency_max,
+                    'latency_histogram': histogram,
+                    'wait_total': stats.wait_total,
+                    'wait_max': stats.wait_max,
+                }
+            elapsed = time.monotonic() - self._start_time
+        return {
+            'elapsed': elapsed,
+            'classes': classes,
+        }
+
+    def record(self, priority, latency, wait, turns, succeeded):
+        with self._lock:
+            stats = self._stats[priority]
+            stats.jobs += 1
+            if not succeeded:
+                stats.errors += 1
+            stats.turns += turns
+            stats.latency_total += latency
+            if latency > stats.latency_max:
+                stats.latency_max = latency
+            stats.histogram[bisect.bisect_left(LATENCY_BOUNDS, latency)] += 1
+            stats.wait_total += wait
+            if wait > stats.wait_max:
+                stats.wait_max = wait
+
+
+class _ClassStats():
+
+    __slots__ = ('jobs', 'errors', 'turns', 'latency_total', 'latency_max', 'histogram', 'wait_total', 'wait_max')
+
+    def __init__(self):
+        self.jobs = 0
+        self.errors = 0
+        self.turns = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.histogram = [0] * (len(LATENCY_BOUNDS) + 1)
+        self.wait_total = 0.0
+        self.wait_max = 0.0
@@ -0,0 +1,562 @@
+# sim.py
+# Simulated PeekPoke device
+# source: https://github.com/chris-siedell/PeekPoke
+# python: https://pypi.org/project/peekpoke/
+# homepage: http://siedell.com/projects/PeekPoke/
+
+
+# This module implements a software PeekPoke device (protocol v2) that can be
+#  used in place of a Propeller running PeekPoke.spin. It is intended for
+#  testing and benchmarking the Python side without hardware.
+#
+# There are three parts:
+#  - SimulatedDevice executes PeekPoke (and a few CrowAdmin) command payloads
+#    against a 64 KB hub image, mirroring the behavior of PeekPoke.spin,
+#  - SimulatedSerial is a pyserial-like object that carries Crow packets
+#    between a host and any number of simulated devices, modeling per-byte
+#    wire time, command turnaround, the device's single command buffer,
+#    baudrate mismatches, and break conditions,
+#  - attach registers a SimulatedSerial with crow's Host under a serial port
+#    name, so that PeekPoke(<name>) talks to the simulated devices.
+#
+# Example:
+#   dev = SimulatedDevice()
+#   attach('sim0', dev)
+#   p = PeekPoke('sim0')
+
+
+import time
+
+from crow.host import Host
+from crow.host_serial import HostSerialPort
+from crow.host_serial import HostSerialSettings
+from crow.utils import fletcher16
+from crow.utils import fletcher16_checkbytes
+
+
+class SimulatedDevice():
+
+    def __init__(self, *, address=1, port=112, clkfreq=80000000, baudrate=115200, max_payload_size=240,
+                 identifier=0, par=0, layout_id=b'\xaa\xbb\xcc\xdd',
+                 read_range=(0, 0xffff), write_range=(0, 0xffff),
+                 write_hub_enabled=True, set_serial_timings_enabled=True, payload_exec_enabled=False,
+                 break_detection_enabled=True, break_threshold_ms=150, command_buffer_count=1,
+                 turnaround=0.00005, max_reliable_baudrate=None):
+        if address < 1 or address > 31:
+            raise ValueError("The address must be 1 to 31.")
+        if port < 1 or port > 255:
+            raise ValueError("The port must be 1 to 255.")
+        if max_payload_size < 12 or max_payload_size > 2047:
+            raise ValueError("The max payload size must be 12 to 2047.")
+        if command_buffer_count < 1:
+            raise ValueError("The command buffer count must be at least one.")
+        self.address = address
+        self.port = port
+        self.clkfreq = clkfreq
+        self.max_payload_size = max_payload_size
+        self.identifier = identifier
+        self.par = par & 0xfffc
+        self.layout_id = bytes(layout_id)
+        self.min_read_address, self.max_read_address = read_range
+        self.min_write_address, self.max_write_address = write_range
+        self.write_hub_enabled = write_hub_enabled
+        self.set_serial_timings_enabled = set_serial_timings_enabled
+        self.payload_exec_enabled = payload_exec_enabled
+        self.break_detection_enabled = break_detection_enabled
+        self.break_threshold_ms = break_threshold_ms
+        # command_buffer_count is the number of complete commands the device
+        #  can hold while busy. PeekPoke.spin has a single buffer, so any command
+        #  arriving while it is processing or responding is lost.
+        self.command_buffer_count = command_buffer_count
+        # turnaround is the time, in seconds, between receiving the last byte of
+        #  a command and sending the first byte of the response.
+        self.turnaround = turnaround
+        # Baudrates above max_reliable_baudrate corrupt every packet (models the
+        #  limits of a cable or USB bridge). None means there is no limit.
+        self.max_reliable_baudrate = max_reliable_baudrate
+        self.hub = bytearray(65536)
+        self.token = bytearray(4)
+        self.timings = SimulatedDevice.timings_for_baudrate(clkfreq, baudrate, break_threshold_ms)
+        self.last_good_timings = list(self.timings)
+        self.command_count = 0
+        self.dropped_count = 0
+
+    @property
+    def baudrate(self):
+        """The baudrate implied by the device's current serial timings."""
+        return (2.0 * self.clkfreq) / (self.timings[0] + self.timings[1])
+
+    @property
+    def available_commands_bitmask(self):
+        bitmask = 0b11011111
+        if self.write_hub_enabled:
+            bitmask |= 1 << 2
+        if self.set_serial_timings_enabled:
+            bitmask |= 1 << 5
+        if self.payload_exec_enabled:
+            bitmask |= 1 << 8
+        if self.break_detection_enabled:
+            bitmask |= 1 << 15
+        return bitmask
+
+    def receive_break(self, duration):
+        # duration is in milliseconds (the units PeekPoke uses for _break_duration).
+        if not self.break_detection_enabled:
+            return
+        if duration >= self.break_threshold_ms:
+            self.timings = list(self.last_good_timings)
+
+    def execute(self, port, payload):
+        # Executes a command payload addressed to this device. Returns a tuple
+        #  (is_error, response_payload).
+        self.command_count += 1
+        if len(payload) > self.max_payload_size:
+            return (True, bytes([6]))       # OversizedCommand
+        if port == 0:
+            return self._execute_admin(payload)
+        if port != self.port:
+            return (True, bytes([8]))       # PortNotOpen
+        if len(payload) < 4 or payload[0:3] != b'\x70\x70\x00':
+            return (True, bytes([65]))      # UnknownCommandFormat
+        # As in PeekPoke.spin, the timings are saved whenever a PeekPoke command is received.
+        self.last_good_timings = list(self.timings)
+        code = payload[3]
+        if code == 0:
+            return (False, self._get_info_response())
+        elif code >= 1 and code <= 3:
+            return self._execute_hub_command(code, payload)
+        elif code == 4:
+            rsp = bytearray(b'\x70\x70\x00\x04') + bytearray(4)
+            for t in self.timings:
+                rsp += t.to_bytes(4, 'little')
+            return (False, rsp)
+        elif code == 5:
+            if not self.set_serial_timings_enabled:
+                return (True, bytes([69]))
+            if len(payload) != 36 or payload[4] != 0:
+                return (True, bytes([67]))
+            # The change takes effect after the acknowledgement, which the wire
+            #  model accounts for by using the timings at the start of the command.
+            self.timings = [int.from_bytes(payload[i:i+4], 'little') for i in range(8, 36, 4)]
+            return (False, b'\x70\x70\x00\x05')
+        elif code == 6:
+            return (False, b'\x70\x70\x00\x06' + bytes(self.token))
+        elif code == 7:
+            if len(payload) != 8:
+                return (True, bytes([67]))
+            prev_token = bytes(self.token)
+            self.token[0:4] = payload[4:8]
+            return (False, b'\x70\x70\x00\x07' + prev_token)
+        elif code == 8:
+            if not self.payload_exec_enabled:
+                return (True, bytes([69]))
+            if len(payload) < 12 or payload[4:8] != self.layout_id:
+                return (True, bytes([67]))
+            # There is no cog to run PASM code on.
+            return (True, bytes([70]))      # CommandNotImplemented
+        return (True, bytes([69]))          # CommandNotAvailable
+
+    def _get_info_response(self):
+        rsp = bytearray(b'\x70\x70\x00\x00')
+        rsp += (self.max_payload_size - 4).to_bytes(2, 'little')
+        rsp += (self.max_payload_size - 8).to_bytes(2, 'little')
+        rsp += self.min_read_address.to_bytes(2, 'little')
+        rsp += self.max_read_address.to_bytes(2, 'little')
+        rsp += self.min_write_address.to_bytes(2, 'little')
+        rsp += self.max_write_address.to_bytes(2, 'little')
+        rsp += self.layout_id
+        rsp += self.identifier.to_bytes(4, 'little')
+        rsp += self.par.to_bytes(2, 'little')
+        rsp += self.available_commands_bitmask.to_bytes(2, 'little')
+        rsp += b'\x00\x02'      # serial timings format 0, PeekPoke version 2
+        return rsp
+
+    def _execute_hub_command(self, code, payload):
+        if len(payload) < 8:
+            return (True, bytes([67]))
+        address = int.from_bytes(payload[4:6], 'little')
+        count = int.from_bytes(payload[6:8], 'little')
+        last_address = address + count - 1 if count > 0 else address
+        if last_address > 0xffff:
+            return (True, bytes([67]))
+        if code == 2:
+            if not self.write_hub_enabled:
+                return (True, bytes([69]))
+            if len(payload) != 8 + count:
+                return (True, bytes([67]))
+            if address < self.min_write_address or last_address > self.max_write_address:
+                return (True, bytes([128]))     # AccessError
+            self.hub[address:address+count] = payload[8:]
+            return (False, b'\x70\x70\x00\x02')
+        if count > self.max_payload_size - 4:
+            return (True, bytes([67]))
+        if address < self.min_read_address or last_address > self.max_read_address:
+            return (True, bytes([128]))         # AccessError
+        data = self.hub[address:address+count]
+        if code == 3:
+            nul_index = data.find(0)
+            if nul_index != -1:
+                data = data[0:nul_index+1]
+        return (False, bytes([0x70, 0x70, 0x00, code]) + data)
+
+    def _execute_admin(self, payload):
+        if len(payload) == 0:
+            return (False, b'')     # ping
+        if len(payload) < 3 or payload[0:2] != b'CA':
+            return (True, bytes([65]))
+        code = payload[2]
+        if code == 0:
+            return (False, bytes(payload))
+        elif code == 1:
+            rsp = bytearray(b'CA\x01\x02\x01')
+            rsp += self.max_payload_size.to_bytes(2, 'big')
+            rsp += self.max_payload_size.to_bytes(2, 'big')
+            return (False, rsp)
+        elif code == 2:
+            return (False, b'CA\x02\x00\x00' + bytes([self.port]))
+        elif code == 3:
+            if len(payload) != 4:
+                return (True, bytes([67]))
+            if payload[3] == 0:
+                return (False, b'CA\x03\x01')
+            if payload[3] == self.port:
+                return (False, b'CA\x03\x03\x00\x07\x08PeekPoke')
+            return (False, b'CA\x03\x00')
+        return (True, bytes([69]))
+
+    @staticmethod
+    def timings_for_baudrate(clkfreq, baudrate, break_threshold_ms=150):
+        # Returns the seven format 0 timing values, computed as in
+        #  PeekPoke._timings_for_baudrate, with break_threshold_ms in place of
+        #  half the break duration. Baudrates that are too fast are clamped
+        #  instead of raising ValueError.
+        two_bit_period = max(int((2 * clkfreq) / baudrate), 52)
+        bit_period_0 = two_bit_period >> 1
+        bit_period_1 = bit_period_0 + (two_bit_period & 1)
+        start_bit_wait = max((bit_period_0 >> 1) - 10, 5)
+        stop_bit_duration = int((10 * clkfreq) / baudrate) - 5*bit_period_0 - 4*bit_period_1 + 1
+        interbyte_timeout = max(int(clkfreq/1000), 2*two_bit_period)
+        recovery_time = two_bit_period << 3
+        break_multiple = int((break_threshold_ms * clkfreq/1000) / recovery_time)
+        return [bit_period_0, bit_period_1, start_bit_wait, stop_bit_duration, interbyte_timeout, recovery_time, break_multiple]
+
+
+class SimulatedSerial():
+
+    # SimulatedSerial implements the subset of the serial.Serial interface used by
+    #  crow's Host. Written bytes are framed into Crow command packets and handed
+    #  to the attached devices; responses become readable once their modeled wire
+    #  time has elapsed.
+    # If realtime is False no sleeping is done. Instead, a read advances the
+    #  modeled clock (elapsed_time) to when the requested bytes would have
+    #  arrived, or by the read timeout if they never will.
+
+    def __init__(self, name='sim', devices=None, *, baudrate=115200, latency=0.001, realtime=True):
+        self.port = name
+        self.baudrate = baudrate
+        self.bytesize = 8
+        self.parity = 'N'
+        self.stopbits = 1
+        self.timeout = None
+        self.latency = latency
+        self.realtime = realtime
+        self.is_open = True
+        self._devices = {}
+        for d in (devices or []):
+            self.add_device(d)
+        self._rx_buff = bytearray()
+        # _rx_segments holds responses in flight: [start time, seconds per byte, data]
+        self._rx_segments = []
+        self._tx_buff = bytearray()
+        self._clock = 0.0
+        self._tx_free_at = 0.0
+        self._device_free_at = {}
+        self._device_queue = {}
+        self.bytes_written = 0
+        self.bytes_read = 0
+
+    def add_device(self, device):
+        if device.address in self._devices:
+            raise ValueError("There is already a device at address " + str(device.address) + ".")
+        self._devices[device.address] = device
+
+    @property
+    def elapsed_time(self):
+        """The modeled time, in seconds, since the port was created."""
+        return self._now()
+
+    @property
+    def in_waiting(self):
+        if not self.realtime:
+            # A poller would eventually see every byte in flight.
+            self._advance_clock(len(self._rx_buff) + sum(len(seg[2]) for seg in self._rx_segments))
+        self._collect()
+        return len(self._rx_buff)
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+    def reset_input_buffer(self):
+        self._collect()
+        self._rx_buff.clear()
+
+    def reset_output_buffer(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def send_break(self, duration=0.25):
+        # PeekPoke passes its break duration in milliseconds (which is how the
+        #  posix pyserial backend effectively treats it on Linux).
+        for d in self._devices.values():
+            d.receive_break(duration)
+
+    def write(self, data):
+        now = self._now()
+        start = max(now + self.latency, self._tx_free_at)
+        seconds_per_byte = self._seconds_per_byte()
+        self._tx_free_at = start + len(data)*seconds_per_byte
+        self.bytes_written += len(data)
+        # Bytes are framed as a stream, so a packet may span several writes.
+        first_index = len(self._tx_buff)
+        self._tx_buff += data
+        self._frame_packets(start - first_index*seconds_per_byte, seconds_per_byte)
+        return len(data)
+
+    def read(self, size=1):
+        if not self.realtime:
+            self._advance_clock(size)
+            return self._take(size)
+        if self.timeout is not None:
+            deadline = time.perf_counter() + self.timeout
+        else:
+            deadline = None
+        while True:
+            self._collect()
+            if len(self._rx_buff) >= size or not self.realtime:
+                break
+            next_time = self._next_byte_time()
+            if next_time is None:
+                if deadline is not None:
+                    remaining = deadline - time.perf_counter()
+                    if remaining > 0:
+                        time.sleep(remaining)
+                break
+            wait = next_time - self._now()
+            if deadline is not None:
+                wait = min(wait, deadline - time.perf_counter())
+                if wait <= 0:
+                    self._collect()
+                    break
+            if wait > 0:
+                time.sleep(wait)
+        return self._take(size)
+
+    def _take(self, size):
+        self._collect()
+        data = bytes(self._rx_buff[0:size])
+        del self._rx_buff[0:size]
+        self.bytes_read += len(data)
+        return data
+
+    def _now(self):
+        if self.realtime:
+            return time.perf_counter() - self._epoch()
+        return self._clock
+
+    def _epoch(self):
+        if not hasattr(self, '_epoch_value'):
+            self._epoch_value = time.perf_counter()
+        return self._epoch_value
+
+    def _seconds_per_byte(self):
+        return 10.0 / self.baudrate
+
+    def _advance_clock(self, size):
+        # Used when not realtime. Moves the clock forward to the arrival time of
+        #  the size-th unread byte, as a blocking read would wait.
+        self._collect()
+        needed = size - len(self._rx_buff)
+        if needed <= 0:
+            return
+        arrival = None
+        for start, seconds_per_byte, data in sorted(self._rx_segments, key=lambda seg: seg[0]):
+            if needed <= len(data):
+                arrival = start + needed*seconds_per_byte
+                break
+            needed -= len(data)
+        if arrival is None:
+            # The bytes will never arrive, so the read times out.
+            if self.timeout is None:
+                raise RuntimeError("A read without a timeout would block forever.")
+            arrival = self._clock + self.timeout
+        self._clock = max(self._clock, arrival)
+
+    def _collect(self):
+        # Moves bytes whose arrival time has passed into the receive buffer.
+        now = self._now()
+        segments = []
+        for seg in self._rx_segments:
+            start, seconds_per_byte, data = seg
+            # The small allowance avoids losing a byte to rounding.
+            count = min(len(data), max(0, int((now - start) / seconds_per_byte + 1e-6)))
+            self._rx_buff += data[0:count]
+            if count < len(data):
+                segments.append([start + count*seconds_per_byte, seconds_per_byte, data[count:]])
+        self._rx_segments = segments
+
+    def _next_byte_time(self):
+        if len(self._rx_segments) == 0:
+            return None
+        return min(seg[0] + seg[1] for seg in self._rx_segments)
+
+    def _frame_packets(self, buff_start_time, seconds_per_byte):
+        # Extracts complete Crow command packets from the transmit buffer. Bytes
+        #  that cannot begin a valid header are discarded, as PropCR would.
+        buff = self._tx_buff
+        index = 0
+        while len(buff) - index >= 7:
+            header = buff[index:index+7]
+            if header[0] & 0xc7 != 0x01 or fletcher16_sum_ok(header) is False:
+                index += 1
+                continue
+            size = ((header[0] >> 3) << 8) | header[1]
+            remainder = size % 128
+            body_size = (size//128)*130 + ((remainder + 2) if remainder > 0 else 0)
+            if len(buff) - index < 7 + body_size:
+                break
+            body = buff[index+7:index+7+body_size]
+            payload = bytearray()
+            valid = True
+            pos = 0
+            while pos < body_size:
+                chunk_size = min(128, body_size - pos - 2)
+                chunk = body[pos:pos+chunk_size]
+                if fletcher16_checkbytes(chunk) != body[pos+chunk_size:pos+chunk_size+2]:
+                    valid = False
+                payload += chunk
+                pos += chunk_size + 2
+            packet_start = buff_start_time + index*seconds_per_byte
+            index += 7 + body_size
+            packet_end = buff_start_time + index*seconds_per_byte
+            if valid:
+                self._deliver(header, payload, packet_start, packet_end, seconds_per_byte)
+        del buff[0:index]
+
+    def _deliver(self, header, payload, packet_start, packet_end, seconds_per_byte):
+        address = header[2] & 0x1f
+        response_expected = bool(header[2] & 0x80)
+        port = header[3]
+        token = header[4]
+        device = self._devices.get(address)
+        if device is None:
+            return
+        if abs(self.baudrate - device.baudrate) > 0.02*device.baudrate:
+            # The device samples at a different rate, so the packet is garbage.
+            device.dropped_count += 1
+            return
+        if device.max_reliable_baudrate is not None and self.baudrate > device.max_reliable_baudrate:
+            device.dropped_count += 1
+            return
+        free_at = self._device_free_at.get(address, 0.0)
+        queue = [t for t in self._device_queue.get(address, []) if t > packet_start]
+        if packet_start < free_at and len(queue) >= device.command_buffer_count - 1:
+            # The device was busy and had no free buffer for the command.
+            device.dropped_count += 1
+            return
+        process_at = max(packet_end, free_at) + device.turnaround
+        queue.append(process_at)
+        self._device_queue[address] = queue
+        # PropCR reverses each group of four payload bytes (propcr_order).
+        payload = unreverse_propcr_order(payload)
+        device_baudrate = device.baudrate
+        is_error, rsp = device.execute(port, payload)
+        if not response_expected:
+            self._device_free_at[address] = process_at
+            return
+        packet = response_packet(token, rsp, is_error)
+        rsp_seconds_per_byte = 10.0 / device_baudrate
+        self._device_free_at[address] = process_at + len(packet)*rsp_seconds_per_byte
+        if abs(self.baudrate - device_baudrate) > 0.02*device_baudrate:
+            return
+        self._rx_segments.append([process_at + self.latency, rsp_seconds_per_byte, packet])
+
+
+def fletcher16_sum_ok(header):
+    # Verifies the command header check bytes (CH5 and CH6).
+    return fletcher16_checkbytes(header[0:5]) == header[5:7]
+
+
+def unreverse_propcr_order(payload):
+    result = bytearray(len(payload))
+    index = 0
+    size = len(payload)
+    while index < size:
+        chunk_end = min(index + 128, size)
+        while index < chunk_end:
+            group_size = min(4, chunk_end - index)
+            result[index:index+group_size] = payload[index:index+group_size][::-1]
+            index += group_size
+    return result
+
+
+def response_packet(token, payload, is_error=False):
+    # Builds a Crow response packet.
+    size = len(payload)
+    packet = bytearray(5)
+    packet[0] = 0x02 | ((size >> 8) << 3)
+    if is_error:
+        packet[0] |= 0x80
+    packet[1] = size & 0xff
+    packet[2] = token
+    packet[3:5] = fletcher16(packet[0:3])
+    index = 0
+    while index < size:
+        chunk = payload[index:index+128]
+        packet += chunk
+        packet += fletcher16(chunk)
+        index += 128
+    return packet
+
+
+class _SimulatedHostSerialPort(HostSerialPort):
+
+    # HostSerialPort normally creates a serial.Serial instance from the port
+    #  name. This subclass wraps a SimulatedSerial instead.
+
+    def __init__(self, serial, baudrate=115200, transaction_timeout=0.25, propcr_order=False):
+        self.retain_count = None
+        self._serial = serial
+        self._settings = []
+        for i in range(0, 32):
+            self._settings.append(HostSerialSettings())
+        self.default_baudrate = baudrate
+        self.default_transaction_timeout = transaction_timeout
+        self.default_propcr_order = propcr_order
+
+
+def attach(serial_port_name, *devices, realtime=True, latency=0.001, transaction_timeout=0.25):
+    """Registers simulated devices with crow under the given serial port name. Returns the SimulatedSerial."""
+    for sp in Host._serial_ports:
+        if sp.name == serial_port_name:
+            raise ValueError("The serial port name '" + serial_port_name + "' is already in use.")
+    serial = SimulatedSerial(serial_port_name, devices, latency=latency, realtime=realtime)
+    sp = _SimulatedHostSerialPort(serial, transaction_timeout=transaction_timeout)
+    # The extra retain keeps the port registered after the last host releases it.
+    sp.retain_count = 1
+    Host._serial_ports.add(sp)
+    return serial
+
+
+def detach(serial_port_name):
+    """Removes a serial port registered with attach."""
+    for sp in Host._serial_ports:
+        if sp.name == serial_port_name and isinstance(sp, _SimulatedHostSerialPort):
+            Host._serial_ports.remove(sp)
+            return
+    raise ValueError("No simulated serial port named '" + serial_port_name + "' is attached.")
+
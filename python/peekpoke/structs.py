@@ -0,0 +1,210 @@
+# structs.py
+# Typed record layouts for PeekPoke
+# source: https://github.com/chris-siedell/PeekPoke
+# python: https://pypi.org/project/peekpoke/
+# homepage: http://siedell.com/projects/PeekPoke/
+
+
+# A StructLayout describes a record of longs, words, bytes, and byte strings
+#  in hub memory, such as one kept by a Spin object. It is used with
+#  PeekPoke.get_struct, get_structs, and set_struct. For example:
+#
+#   layout = StructLayout([
+#       Field('state', 'long'),
+#       Field('count', 'word', signed=True),
+#       Field('flags', 'byte'),
+#       Field('name', 'bytes', length=8),
+#   ])
+#   record = p.get_struct(0x7000, layout)
+#   record.count        # or record['count']
+#
+# The layout compiles struct formats once, so decoding a whole record is a
+#  single unpack call. The records returned by PeekPoke hold the raw bytes and
+#  decode a field only when it is accessed.
+
+
+import struct
+
+
+# The size and struct format code (unsigned) of each integer field type.
+_INT_TYPES = {'byte': (1, 'B'), 'word': (2, 'H'), 'long': (4, 'I'), 'quad': (8, 'Q')}
+
+
+class Field():
+
+    # A field of a StructLayout. type is 'byte', 'word', 'long', 'quad', or
+    #  'bytes' (which requires a length). If offset is None the field follows the
+    #  previous one, aligned according to the layout's alignment.
+
+    def __init__(self, name, type, *, offset=None, signed=False, length=None):
+        if type in _INT_TYPES:
+            size, code = _INT_TYPES[type]
+            if length is not None and length != size:
+                raise ValueError("The length of a " + type + " field is " + str(size) + ".")
+            self.length = size
+            self.code = code.lower() if signed else code
+        elif type == 'bytes':
+            if length is None or length < 1:
+                raise ValueError("A bytes field requires a positive length.")
+            if signed:
+                raise ValueError("A bytes field cannot be signed.")
+            self.length = length
+            self.code = str(length) + 's'
+        else:
+            raise ValueError("Unknown field type '" + str(type) + "'. It must be 'byte', 'word', 'long', 'quad', or 'bytes'.")
+        if offset is not None and offset < 0:
+            raise ValueError("A field offset must not be negative.")
+        self.name = name
+        self.type = type
+        self.offset = offset
+        self.signed = signed
+
+    def __repr__(self):
+        return "Field(" + repr(self.name) + ", " + repr(self.type) + ", offset=" + str(self.offset) + ", signed=" + str(self.signed) + ", length=" + str(self.length) + ")"
+
+
+class StructLayout():
+
+    def __init__(self, fields, *, alignment='natural', byteorder='little', size=None):
+        # alignment is 'natural' (integer fields are aligned to their size, and
+        #  the record size is a multiple of the largest integer size) or 'packed'.
+        #  size overrides the computed record size (the stride of an array).
+        if alignment not in ('natural', 'packed'):
+            raise ValueError("alignment must be 'natural' or 'packed'.")
+        if byteorder not in ('little', 'big'):
+            raise ValueError("byteorder must be 'little' or 'big'.")
+        self.alignment = alignment
+        self.byteorder = byteorder
+        prefix = '<' if byteorder == 'little' else '>'
+        self.fields = []
+        self._fields = {}
+        self._field_structs = {}
+        offset = 0
+        record_alignment = 1
+        for field in fields:
+            if field.name in self._fields:
+                raise ValueError("The field name '" + str(field.name) + "' is used more than once.")
+            field_alignment = field.length if alignment == 'natural' and field.type in _INT_TYPES else 1
+            record_alignment = max(record_alignment, field_alignment)
+            if field.offset is None:
+                offset = -(-offset//field_alignment)*field_alignment
+            else:
+                offset = field.offset
+            # The layout keeps its own copy of each field, with the offset filled in.
+            placed = Field(field.name, field.type, offset=offset, signed=field.signed, length=field.length)
+            self.fields.append(placed)
+            self._fields[placed.name] = placed
+            self._field_structs[placed.name] = struct.Struct(prefix + placed.code)
+            offset += placed.length
+        end = max((f.offset + f.length for f in self.fields), default=0)
+        if size is None:
+            size = -(-end//record_alignment)*record_alignment
+        elif size < end:
+            raise ValueError("The size is smaller than the fields.")
+        if size < 1:
+            raise ValueError("A layout must have a positive size.")
+        self.size = size
+        self.record_alignment = record_alignment
+        # The whole record format lists the fields in offset order, with pad bytes
+        #  for gaps. Fields that overlap (e.g. unions given by explicit offsets)
+        #  cannot be expressed this way, so then fields are decoded individually.
+        ordered = sorted(self.fields, key=lambda f: f.offset)
+        self._order = None
+        self._struct = None
+        fmt = prefix
+        position = 0
+        for field in ordered:
+            if field.offset < position:
+                break
+            if field.offset > position:
+                fmt += str(field.offset - position) + 'x'
+            fmt += field.code
+            position = field.offset + field.length
+        else:
+            if size > position:
+                fmt += str(size - position) + 'x'
+            self._struct = struct.Struct(fmt)
+            self._order = [f.name for f in ordered]
+
+    def __contains__(self, name):
+        return name in self._fields
+
+    def field(self, name):
+        """Returns the Field with the given name."""
+        return self._fields[name]
+
+    def unpack(self, data, offset=0):
+        """Decodes a record from data at offset, returning a dict of all the fields."""
+        if self._struct is not None:
+            return dict(zip(self._order, self._struct.unpack_from(data, offset)))
+        return {name: s.unpack_from(data, offset + self._fields[name].offset)[0] for name, s in self._field_structs.items()}
+
+    def unpack_field(self, name, data, offset=0):
+        """Decodes one field of a record in data at offset."""
+        try:
+            field = self._fields[name]
+        except KeyError:
+            raise KeyError("The layout has no field named '" + str(name) + "'.") from None
+        return self._field_structs[name].unpack_from(data, offset + field.offset)[0]
+
+    def pack(self, values, data=None):
+        """Returns a bytearray of the record with the fields in the values dict set, starting from data (or zeros)."""
+        result = bytearray(self.size) if data is None else bytearray(data)
+        if len(result) != self.size:
+            raise ValueError("The data must be the size of the record.")
+        for name, value in values.items():
+            try:
+                field = self._fields[name]
+            except KeyError:
+                raise KeyError("The layout has no field named '" + str(name) + "'.") from None
+            self._field_structs[name].pack_into(result, field.offset, value)
+        return result
+
+    def _field_writes(self, hub_address, values):
+        # Returns a list of (hub_address, data) tuples writing just the given fields.
+        writes = []
+        for name, value in values.items():
+            try:
+                field = self._fields[name]
+            except KeyError:
+                raise KeyError("The layout has no field named '" + str(name) + "'.") from None
+            writes.append((hub_address + field.offset, self._field_structs[name].pack(value)))
+        return writes
+
+    def record(self, data, offset=0, hub_address=None):
+        """Returns a StructRecord decoding the record in data at offset."""
+        return StructRecord(self, data, offset, hub_address)
+
+
+class StructRecord():
+
+    # A record read from hub memory. Fields are decoded when accessed, either as
+    #  attributes or by item (record['name']). as_dict decodes them all at once.
+    #  The raw bytes are shared with the other records read by the same call.
+
+    __slots__ = ('layout', 'hub_address', '_data', '_offset')
+
+    def __init__(self, layout, data, offset=0, hub_address=None):
+        self.layout = layout
+        self.hub_address = hub_address
+        self._data = data
+        self._offset = offset
+
+    def __getitem__(self, name):
+        return self.layout.unpack_field(name, self._data, self._offset)
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name not in self.layout:
+            raise AttributeError("'StructRecord' object has no attribute '" + name + "'")
+        return self.layout.unpack_field(name, self._data, self._offset)
+
+    @property
+    def raw(self):
+        """The record's bytes."""
+        return bytes(self._data[self._offset:self._offset+self.layout.size])
+
+    def as_dict(self):
+        return self.layout.unpack(self._data, self._offset)
+
+    def __repr__(self):
+        return "StructRecord(" + repr(self.as_dict()) + ")"
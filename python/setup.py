@@ -73,6 +73,7 @@ setup(
         },
     packages=find_packages(),
     install_requires=['crow-serial'],
+    extras_require={'numpy':['numpy']},
     python_requires='>=3',
 )
 
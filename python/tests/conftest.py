@@ -0,0 +1,30 @@
+# conftest.py
+# Fixtures for the PeekPoke tests, which run against peekpoke.sim.
+
+
+import itertools
+
+import pytest
+
+from peekpoke import PeekPoke
+from peekpoke.sim import SimulatedDevice, attach, detach
+
+
+_names = itertools.count()
+
+
+@pytest.fixture
+def connect():
+    # Returns a function that attaches a SimulatedDevice (created with the given
+    #  keyword arguments) and returns (peekpoke, device). The simulated ports are
+    #  detached when the test ends.
+    names = []
+    def connect(*, realtime=False, **kwargs):
+        device = SimulatedDevice(**kwargs)
+        name = 'pytest-sim-' + str(next(_names))
+        attach(name, device, realtime=realtime)
+        names.append(name)
+        return PeekPoke(name), device
+    yield connect
+    for name in names:
+        detach(name)
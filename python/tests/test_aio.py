@@ -0,0 +1,68 @@
+# Tests for the asyncio front-end.
+
+import asyncio
+import os
+
+import pytest
+
+from peekpoke import AccessError
+from peekpoke.aio import AsyncPeekPoke
+
+
+def test_round_trips(connect):
+    p, device = connect()
+    device.hub[:] = os.urandom(65536)
+    device.hub[500:506] = b'hello\0'
+    async def run():
+        a = AsyncPeekPoke(p.serial_port_name)
+        assert await a.get_bytes(0, 4000) == device.hub[0:4000]
+        buffer = bytearray(300)
+        assert await a.get_bytes_into(1000, buffer) == 300
+        assert buffer == device.hub[1000:1300]
+        await a.set_bytes(8000, b'x'*1000)
+        assert device.hub[8000:9000] == b'x'*1000
+        assert await a.get_str(500, 100) == 'hello'
+        assert await a.get_str(500, 3, nul_terminated=False) == 'hel'
+        await a.set_ints(100, 2, [1, 2, 3])
+        assert await a.get_ints(100, 2, 3) == [1, 2, 3]
+        await a.set_int(104, 4, -5, signed=True)
+        assert await a.get_int(104, 4, signed=True) == -5
+        await a.set_token(7)
+        assert await a.get_token() == 7
+        info = await a.get_info()
+        assert str(info) == str(p.get_info())
+    asyncio.run(run())
+
+
+def test_concurrent_calls_are_serialized(connect):
+    p, device = connect()
+    device.hub[:] = os.urandom(65536)
+    async def run():
+        a = AsyncPeekPoke(p.serial_port_name)
+        b = AsyncPeekPoke(p.serial_port_name)
+        results = await asyncio.gather(*[(a if i%2 else b).get_bytes(1000*i, 700) for i in range(10)])
+        assert results == [device.hub[1000*i:1000*i+700] for i in range(10)]
+    asyncio.run(run())
+
+
+def test_access_error(connect):
+    p, _device = connect(read_range=(0x100, 0x7fff))
+    async def run():
+        a = AsyncPeekPoke(p.serial_port_name)
+        await a.get_info()
+        with pytest.raises(AccessError):
+            await a.get_int(0, 4)
+        assert await a.get_int(0x100, 4) == 0
+    asyncio.run(run())
+
+
+def test_timeout_leaves_the_port_usable(connect):
+    p, device = connect(realtime=True)
+    device.hub[:] = os.urandom(65536)
+    async def run():
+        a = AsyncPeekPoke(p.serial_port_name)
+        await a.get_info()
+        with pytest.raises(asyncio.TimeoutError):
+            await a.get_bytes(0, 30000, timeout=0.05)
+        assert await a.get_bytes(0, 16, timeout=1.0) == device.hub[0:16]
+    asyncio.run(run())
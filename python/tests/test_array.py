@@ -0,0 +1,39 @@
+# Tests for the numpy array methods.
+
+import os
+
+import pytest
+
+numpy = pytest.importorskip('numpy')
+
+
+def test_get_array_matches_hub(connect):
+    p, device = connect()
+    device.hub[:] = os.urandom(65536)
+    array = p.get_array(0x1000, '<u4', 600)
+    assert array.dtype == numpy.dtype('<u4')
+    assert array.tolist() == [int.from_bytes(device.hub[0x1000+4*i:0x1004+4*i], 'little') for i in range(600)]
+    array = p.get_array(0x1000, '>i2', 10)
+    assert array.tolist() == [int.from_bytes(device.hub[0x1000+2*i:0x1002+2*i], 'big', signed=True) for i in range(10)]
+
+
+def test_set_array_round_trip(connect):
+    p, device = connect()
+    values = numpy.arange(-300, 300, dtype=numpy.int16).reshape(20, 30)
+    p.set_array(0x2000, values)
+    assert bytes(device.hub[0x2000:0x2000+1200]) == values.astype('<i2').tobytes()
+    assert (p.get_array(0x2000, numpy.int16, 600) == values.reshape(-1)).all()
+    # The items are converted to dtype first.
+    p.set_array(0x3000, [1, 2, 3], dtype='<u4')
+    assert p.get_ints(0x3000, 4, 3) == [1, 2, 3]
+
+
+def test_array_arguments_are_verified(connect):
+    p, _device = connect()
+    with pytest.raises(ValueError):
+        p.get_array(0x1000, numpy.float32, 4)
+    with pytest.raises(ValueError):
+        p.get_array(0x1002, numpy.uint32, 4)
+    with pytest.raises(ValueError):
+        p.set_array(0x1000, numpy.zeros(4, numpy.float64))
+    assert p.get_array(0x1002, numpy.uint32, 4, alignment='word').shape == (4,)
@@ -0,0 +1,120 @@
+# Tests for batched hub memory operations.
+
+import os
+import random
+
+import pytest
+
+from peekpoke import AccessError
+from peekpoke.batch import Batch, _Operation
+
+
+def _read(hub_address, count):
+    return _Operation(True, hub_address, count, None, None)
+
+
+def _write(hub_address, count):
+    return _Operation(False, hub_address, count, bytes(count), None)
+
+
+def test_plan_moves_independent_operations_forward():
+    r1 = _read(0, 4)
+    w1 = _write(0, 4)
+    r2 = _read(8, 4)
+    w2 = _write(16, 4)
+    stages = Batch._plan([r1, w1, r2, w2])
+    assert stages == [(True, [r1, r2]), (False, [w1, w2])]
+
+
+def test_plan_keeps_order_of_overlapping_operations():
+    w1 = _write(0, 4)
+    r1 = _read(2, 4)
+    w2 = _write(4, 4)
+    r2 = _read(6, 1)
+    w3 = _write(2, 4)
+    stages = Batch._plan([w1, r1, w2, r2, w3])
+    # r1 must follow w1, w2 must follow r1, r2 must follow w2, and the
+    #  overlapping writes w2 and w3 share a stage in queue order.
+    assert stages == [(False, [w1]), (True, [r1]), (False, [w2, w3]), (True, [r2])]
+
+
+def test_plan_places_empty_operations_first():
+    w1 = _write(0, 4)
+    r1 = _read(0, 0)
+    stages = Batch._plan([w1, r1])
+    assert stages == [(False, [w1]), (True, [r1])]
+    r2 = _read(0, 4)
+    w2 = _write(0, 0)
+    stages = Batch._plan([r2, w1, w2])
+    assert stages == [(True, [r2]), (False, [w1, w2])]
+
+
+def test_batch_matches_sequential_operations(connect):
+    p, device = connect()
+    expected = bytearray(os.urandom(256))
+    p.set_bytes(0x1000, expected)
+    rng = random.Random(24)
+    for _trial in range(50):
+        checks = []
+        with p.batch() as b:
+            for _k in range(30):
+                hub_address = 0x1000 + rng.randrange(200)
+                index = hub_address - 0x1000
+                choice = rng.random()
+                if choice < 0.4:
+                    value = rng.randrange(256)
+                    b.set_int(hub_address, 1, value)
+                    expected[index] = value
+                elif choice < 0.5:
+                    data = os.urandom(rng.randrange(1, 12))
+                    b.set_bytes(hub_address, data)
+                    expected[index:index+len(data)] = data
+                elif choice < 0.9:
+                    count = rng.randrange(1, 10)
+                    checks.append((b.get_bytes(hub_address, count), bytes(expected[index:index+count])))
+                else:
+                    hub_address &= ~3
+                    index = hub_address - 0x1000
+                    checks.append((b.get_int(hub_address, 4), int.from_bytes(expected[index:index+4], 'little')))
+        for future, value in checks:
+            assert future.result() == value
+    assert p.get_bytes(0x1000, 256) == expected
+
+
+def test_reads_are_coalesced(connect):
+    p, device = connect()
+    p.get_info()
+    count = device.command_count
+    with p.batch() as b:
+        futures = [b.get_int(0x1000 + 4*i, 4) for i in range(32)]
+        with pytest.raises(RuntimeError):
+            futures[0].result()
+    assert device.command_count - count == 1
+    assert b.stage_count == 1
+    assert [f.result() for f in futures] == [0]*32
+
+
+def test_errors_belong_to_their_futures(connect):
+    p, _device = connect(read_range=(0, 0x7fff), write_range=(0x1000, 0x7fff))
+    with p.batch() as b:
+        good = b.get_int(0x1000, 4)
+        bad_write = b.set_int(0x0100, 4, 1)
+        bad_read = b.get_bytes(0x7ff0, 32)
+        good_write = b.set_int(0x1004, 4, 7)
+    assert good.exception() is None
+    assert isinstance(bad_write.exception(), AccessError)
+    assert isinstance(bad_read.exception(), AccessError)
+    assert good_write.result() is None
+    assert p.get_int(0x1004, 4) == 7
+
+
+def test_exception_cancels_batch(connect):
+    p, device = connect()
+    with pytest.raises(KeyError):
+        with p.batch() as b:
+            future = b.set_int(0x1008, 4, 99)
+            raise KeyError
+    assert future.cancelled()
+    assert device.hub[0x1008:0x100c] == bytes(4)
+    with pytest.raises(RuntimeError):
+        b.run()
@@ -0,0 +1,55 @@
+# Tests for the persistent device cache.
+
+import os
+
+import pytest
+
+from peekpoke import AccessError, PeekPoke
+from peekpoke.cache import DeviceCache
+
+
+def test_matching_entry_is_kept(connect, tmp_path):
+    # The entry is trusted, so no getInfo is sent.
+    p, device = connect()
+    path = os.path.join(str(tmp_path), 'cache.json')
+    p = PeekPoke(p.serial_port_name, cache=path)
+    info = p.get_info()
+    p2 = PeekPoke(p.serial_port_name, cache=path)
+    start = device.command_count
+    assert str(p2.get_info()) == str(info)
+    assert device.command_count == start
+    p2.get_bytes(0, 4)
+    assert device.command_count == start + 1
+
+
+def test_rejected_command_refreshes_the_entry(connect, tmp_path):
+    p, device = connect()
+    path = os.path.join(str(tmp_path), 'cache.json')
+    p = PeekPoke(p.serial_port_name, cache=path)
+    p.get_info()
+    # A different program, with a smaller read range, is loaded on the Propeller.
+    device.layout_id = b'\x01\x02\x03\x04'
+    device.min_read_address = 0x2000
+    p2 = PeekPoke(p.serial_port_name, cache=path)
+    with pytest.raises(AccessError):
+        p2.get_bytes(0, 4)
+    start = device.command_count
+    info = p2.get_info()
+    assert device.command_count == start
+    assert bytes(info.layout_id) == b'\x01\x02\x03\x04'
+    assert info.min_read_address == 0x2000
+    entry = DeviceCache(path).lookup(p.serial_port_name, 1, 112)
+    assert entry['layout_id'] == '01020304'
+
+
+def test_uncached_get_info_replaces_the_entry(connect, tmp_path):
+    p, device = connect()
+    path = os.path.join(str(tmp_path), 'cache.json')
+    p = PeekPoke(p.serial_port_name, cache=path)
+    p.get_info()
+    device.layout_id = b'\x01\x02\x03\x04'
+    p2 = PeekPoke(p.serial_port_name, cache=path)
+    assert bytes(p2.get_info().layout_id) == bytes(p.get_info().layout_id)
+    assert bytes(p2.get_info(use_cached=False).layout_id) == b'\x01\x02\x03\x04'
+    entry = DeviceCache(path).lookup(p.serial_port_name, 1, 112)
+    assert entry['layout_id'] == '01020304'
@@ -0,0 +1,83 @@
+# Tests for write combining.
+
+import os
+import random
+
+
+def test_rewrites_inside_a_span_are_combined(connect):
+    # A control loop rewriting the same adjacent longs sends a single command.
+    p, device = connect()
+    p.get_info()
+    p.enable_write_combining(max_age=None)
+    start = device.command_count
+    for i in range(10):
+        for j in range(4):
+            p.set_int(0x1000 + 4*j, 4, i*4 + j)
+    assert device.command_count == start
+    p.flush()
+    assert device.command_count == start + 1
+    assert [int.from_bytes(device.hub[0x1000+4*j:0x1004+4*j], 'little') for j in range(4)] == [36, 37, 38, 39]
+
+
+def test_adjacent_writes_are_combined(connect):
+    p, device = connect()
+    p.get_info()
+    combiner = p.enable_write_combining(max_age=None)
+    start = device.command_count
+    for i in range(512):
+        p.set_int(0x1000 + 4*i, 4, i)
+    p.flush()
+    assert device.command_count - start <= 512//10
+    assert combiner.commands == device.command_count - start
+    assert p.get_ints(0x1000, 4, 512) == list(range(512))
+
+
+def test_reads_see_buffered_writes(connect):
+    p, device = connect()
+    reference = bytearray(os.urandom(2048))
+    p.set_bytes(0x1000, reference)
+    p.enable_write_combining(max_age=None)
+    rng = random.Random(1)
+    for _ in range(2000):
+        address = rng.randrange(2000)
+        if rng.random() < 0.6:
+            data = os.urandom(rng.randrange(1, 40))
+            p.set_bytes(0x1000 + address, data)
+            reference[address:address+len(data)] = data
+        else:
+            n = rng.randrange(1, 20)
+            assert p.get_bytes(0x1000 + address, n) == reference[address:address+n]
+    p.flush()
+    assert device.hub[0x1000:0x1800] == reference
+
+
+def test_unbuffered_write_keeps_order(connect):
+    p, device = connect()
+    p.enable_write_combining(max_age=None)
+    p.set_int(0x1200, 4, 1)
+    p.write_many([(0x1200, b'\x02\x00\x00\x00')])
+    p.flush()
+    assert device.hub[0x1200:0x1204] == b'\x02\x00\x00\x00'
+
+
+def test_location_change_discards_buffered_writes(connect):
+    p, device = connect()
+    combiner = p.enable_write_combining(max_age=None)
+    p.set_int(0x1300, 4, 5)
+    assert combiner.pending
+    p.port = p.port
+    assert not combiner.pending
+
+
+def test_empty_reads_with_pending_writes(connect):
+    p, device = connect()
+    p.enable_write_combining(max_age=None)
+    p.set_int(0x1000, 4, 5)
+    assert p.read_many([]) == []
+    assert p.read_many([(0x2000, 0)]) == [bytearray()]
+    with p.batch() as b:
+        future = b.get_bytes(0x2000, 0)
+    assert future.result() == bytearray()
+    assert device.hub[0x1000:0x1004] == bytes(4)
+    p.flush()
+    assert device.hub[0x1000:0x1004] == (5).to_bytes(4, 'little')
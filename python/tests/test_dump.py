@@ -0,0 +1,70 @@
+# Tests for hub memory dump files.
+
+import io
+import os
+
+import pytest
+
+from peekpoke.dump import DumpReader
+
+
+@pytest.mark.parametrize('compression', ['none', 'zlib', 'lzma'])
+def test_dump_and_restore(connect, compression):
+    p, device = connect()
+    info = p.get_info()
+    pattern = bytes(range(256))*4
+    p.set_bytes(0x4000, pattern)
+    file = io.BytesIO()
+    header = p.dump(file, compression=compression)
+    image = p.get_bytes(info.min_read_address, info.max_read_address + 1 - info.min_read_address)
+    file.seek(0)
+    with DumpReader(file) as reader:
+        assert reader.header.ranges == header.ranges
+        assert reader.header.layout_id == bytes(info.layout_id)
+        assert b''.join(data for _address, data in reader) == image
+    p.set_bytes(0x4000, bytes(1024))
+    file.seek(0)
+    p.restore(file)
+    assert device.hub[0x4000:0x4400] == pattern
+
+
+def test_dump_ranges_are_split_into_blocks(connect):
+    p, _device = connect()
+    file = io.BytesIO()
+    p.dump(file, [(0x4000, 100), (0x4100, 1100)], block_size=512)
+    file.seek(0)
+    blocks = [(address, len(data)) for address, data in DumpReader(file)]
+    assert blocks == [(0x4000, 100), (0x4100, 512), (0x4300, 512), (0x4500, 76)]
+
+
+def test_damaged_dump_is_rejected(connect):
+    p, device = connect()
+    device.hub[0x4000:0x4800] = os.urandom(2048)
+    file = io.BytesIO()
+    p.dump(file, [(0x4000, 2048)], block_size=512)
+    raw = bytearray(file.getvalue())
+    raw[200] ^= 0xff
+    with pytest.raises(ValueError):
+        list(DumpReader(io.BytesIO(bytes(raw))))
+    with pytest.raises(ValueError):
+        list(DumpReader(io.BytesIO(file.getvalue()[:-16])))
+
+
+def test_restore_checks_the_device(connect):
+    p, _device = connect(identifier=1)
+    q, _other = connect(identifier=2)
+    file = io.BytesIO()
+    p.dump(file, [(0x4000, 64)])
+    file.seek(0)
+    with pytest.raises(ValueError):
+        q.restore(file)
+    file.seek(0)
+    assert q.restore(file, check_device=False) == 64
+
+
+def test_dump_uses_the_fewest_commands(connect):
+    p, device = connect()
+    max_atomic_read = p.get_info().max_atomic_read
+    start = device.command_count
+    p.dump(io.BytesIO(), [(0, 0x8000)])
+    assert device.command_count - start == -(-0x8000//max_atomic_read)
@@ -0,0 +1,63 @@
+# Tests for the snapshot history store.
+
+import io
+
+from peekpoke.history import SnapshotStore
+
+
+def test_diff_with_misaligned_ranges(tmp_path):
+    store = SnapshotStore(str(tmp_path), block_size=256)
+    image = bytearray(0x400)
+    a = store.add(0x10, image[0x10:0x310])
+    image[0x20] = 1
+    b = store.add(0, image)
+    assert store.diff(a, b) == [(0x20, 1)]
+    assert store.diff(b, a) == [(0x20, 1)]
+    store.close()
+
+
+def test_diff_skips_unchanged_blocks(tmp_path):
+    store = SnapshotStore(str(tmp_path), block_size=64)
+    image = bytearray(range(256))*4
+    a = store.add(0, image)
+    image[0x3ff] ^= 0xff
+    image[0x100] ^= 0xff
+    image[0x102] ^= 0xff
+    b = store.add(0, image)
+    assert store.diff(a, b) == [(0x100, 1), (0x102, 1), (0x3ff, 1)]
+    assert store.diff(a, b, gap_threshold=1) == [(0x100, 3), (0x3ff, 1)]
+    store.close()
+
+
+def test_capture_read_and_export(connect, tmp_path):
+    p, device = connect()
+    store = SnapshotStore(str(tmp_path))
+    images = []
+    for k in range(3):
+        p.set_bytes(0x1000 + 37*k, bytes([k+1])*10)
+        store.capture(p, [(0, 0x8000)], timestamp=100.0 + k)
+        images.append(bytes(device.hub[0:0x8000]))
+    for k in range(3):
+        assert store.read(k, 0, 0x8000) == images[k]
+        assert store.read(k, 0x1010, 300) == images[k][0x1010:0x1010+300]
+    assert store.read_at(101.5, 0x1000, 200) == images[1][0x1000:0x1000+200]
+    assert store.diff(0, 1) == [(0x1025, 10)]
+    store.close()
+    store = SnapshotStore(str(tmp_path))
+    assert len(store.snapshots) == 3
+    file = io.BytesIO()
+    store.export(2, file)
+    file.seek(0)
+    snapshot = store.add_dump(file)
+    assert store.read(snapshot, 0, 0x8000) == images[2]
+    store.close()
+
+
+def test_capture_uses_the_fewest_commands(connect, tmp_path):
+    p, device = connect()
+    max_atomic_read = p.get_info().max_atomic_read
+    store = SnapshotStore(str(tmp_path))
+    start = device.command_count
+    store.capture(p, [(0, 0x8000), (0x9010, 1000)])
+    assert device.command_count - start == -(-0x8000//max_atomic_read) + -(-1000//max_atomic_read)
+    store.close()
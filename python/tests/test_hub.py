@@ -0,0 +1,18 @@
+# Tests for the basic hub memory methods.
+
+from peekpoke.structs import Field, StructLayout
+
+
+def test_empty_operations_send_nothing(connect):
+    # Zero-length operations send no commands, even outside the allowed ranges.
+    p, device = connect(read_range=(0x1000, 0x7fff), write_range=(0x1000, 0x7fff))
+    p.get_info()
+    count = device.command_count
+    for hub_address in (0x2000, 0x100):
+        assert p.get_bytes(hub_address, 0) == b''
+        assert p.get_bytes_into(hub_address, bytearray()) == 0
+        p.set_bytes(hub_address, b'')
+        assert p.get_ints(hub_address, 4, 0) == []
+        p.fill_bytes(hub_address, 0, b'ab')
+        assert p.get_structs(hub_address, StructLayout([Field('value', 'long')]), 0) == []
+    assert device.command_count == count
@@ -0,0 +1,96 @@
+# Tests for the paged HubMemory view.
+
+import os
+import time
+
+import pytest
+
+from peekpoke import AccessError
+
+
+def test_missing_pages_are_read_together(connect):
+    p, device = connect()
+    device.hub[:] = os.urandom(65536)
+    hub = p.hub_memory(page_size=64)
+    p.get_info()
+    start = device.command_count
+    assert hub[0x1000:0x1100] == device.hub[0x1000:0x1100]
+    # The four pages are read as one run, in as few commands as possible.
+    assert device.command_count - start == -(-256//p.get_info().max_atomic_read)
+    assert (hub.misses, hub.hits) == (4, 0)
+    start = device.command_count
+    assert hub[0x1010] == device.hub[0x1010]
+    assert hub.long[0x1020] == int.from_bytes(device.hub[0x1020:0x1024], 'little')
+    assert hub.word[0x1000:0x1008] == [int.from_bytes(device.hub[a:a+2], 'little') for a in range(0x1000, 0x1008, 2)]
+    assert device.command_count == start
+    assert hub.hits == 3
+
+
+def test_least_recently_used_page_is_evicted(connect):
+    p, device = connect()
+    hub = p.hub_memory(page_size=64, max_pages=2)
+    hub[0]
+    hub[64]
+    hub[0]
+    hub[128]
+    assert hub.cached_pages == 2
+    assert hub.evictions == 1
+    start = device.command_count
+    hub[0]
+    hub[128]
+    assert device.command_count == start
+    hub[64]
+    assert device.command_count == start + 1
+
+
+def test_writes_update_cached_pages(connect):
+    p, device = connect()
+    hub = p.hub_memory(page_size=64)
+    hub[0x200:0x240]
+    hub.long[0x23c] = 0x01020304
+    hub[0x240:0x244] = b'abcd'
+    assert device.hub[0x23c:0x244] == b'\x04\x03\x02\x01abcd'
+    start = device.command_count
+    assert hub[0x23c:0x244] == b'\x04\x03\x02\x01abcd'
+    assert device.command_count == start + 1
+    with pytest.raises(ValueError):
+        hub[0:4] = b'abc'
+    with pytest.raises(ValueError):
+        hub.long[2]
+
+
+def test_max_age(connect):
+    p, device = connect()
+    hub = p.hub_memory(page_size=64)
+    hub.set_max_age(0x100, 4, 0)
+    hub[0x100]
+    hub[0x140]
+    device.hub[0x100] = 1
+    device.hub[0x140] = 1
+    # The page holding 0x100 is always reread, and the other is never stale.
+    assert hub[0x100] == 1
+    assert hub[0x140] == 0
+    hub.set_max_age(0x140, 4, 0.1)
+    hub[0x140]
+    device.hub[0x140] = 2
+    assert hub[0x140] == 1
+    time.sleep(0.15)
+    assert hub[0x140] == 2
+    hub.clear_max_ages()
+    assert hub.cached_pages == 0
+
+
+def test_reads_outside_the_read_range(connect):
+    p, device = connect(read_range=(0x120, 0x7fff))
+    device.hub[:] = os.urandom(65536)
+    hub = p.hub_memory(page_size=64)
+    # Bytes outside the range are read uncached, so the device reports them.
+    with pytest.raises(AccessError):
+        hub[0x100:0x130]
+    assert hub.cached_pages == 0
+    # A page partly inside the range is cached from the start of the range.
+    assert hub[0x120:0x130] == device.hub[0x120:0x130]
+    assert hub.cached_pages == 1
+    start = device.command_count
+    assert hub[0x130:0x140] == device.hub[0x130:0x140]
+    assert device.command_count == start
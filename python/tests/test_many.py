@@ -0,0 +1,68 @@
+# Tests for read_many and write_many.
+
+import os
+import random
+
+import pytest
+
+from peekpoke import AccessError
+
+
+def test_read_many_matches_hub(connect):
+    p, device = connect(read_range=(0, 0x7fff))
+    device.hub[:] = os.urandom(65536)
+    rng = random.Random(11)
+    for max_gap in (None, 0, 100):
+        ranges = [(rng.randrange(0, 0x7000), rng.choice([0, 1, 4, 40, 300])) for _i in range(100)]
+        results = p.read_many(ranges, max_gap=max_gap)
+        assert results == [device.hub[a:a+n] for a, n in ranges]
+
+
+def test_read_many_merges_nearby_ranges(connect):
+    p, device = connect()
+    p.get_info()
+    ranges = [(0x1000 + 8*i, 4) for i in range(50)]
+    count = device.command_count
+    p.read_many(ranges)
+    assert device.command_count - count == 2
+    count = device.command_count
+    p.read_many(ranges, max_gap=0)
+    assert device.command_count - count == 50
+
+
+def test_read_many_outside_range(connect):
+    p, _device = connect(read_range=(0, 0x7fff))
+    with pytest.raises(AccessError):
+        p.read_many([(0x100, 4), (0x8000, 4)])
+
+
+def test_write_many_later_writes_win(connect):
+    p, device = connect()
+    rng = random.Random(12)
+    for _trial in range(20):
+        writes = [(rng.randrange(0x1000, 0x1800), os.urandom(rng.choice([0, 1, 4, 50, 300]))) for _i in range(40)]
+        expected = bytearray(device.hub)
+        for hub_address, data in writes:
+            expected[hub_address:hub_address+len(data)] = data
+        p.write_many(writes)
+        assert device.hub == expected
+
+
+def test_write_many_keeps_writes_whole(connect):
+    p, device = connect()
+    max_atomic_write = p.get_info().max_atomic_write
+    writes = [(0x2000 + 4*i, os.urandom(4)) for i in range(200)]
+    written = p.write_many(writes)
+    assert sum(n for _a, n in written) == 800
+    for hub_address, n in written:
+        assert n <= max_atomic_write
+        assert hub_address % 4 == 0 and n % 4 == 0
+    with pytest.raises(ValueError):
+        p.write_many(writes, atomic=True)
+
+
+def test_write_many_outside_range(connect):
+    p, device = connect(write_range=(0x1000, 0x7fff))
+    with pytest.raises(AccessError):
+        p.write_many([(0x1000, b'ab'), (0x100, b'cd')])
+    assert device.hub[0x1000:0x1002] == bytes(2)
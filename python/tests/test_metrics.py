@@ -0,0 +1,53 @@
+# Tests for per-command metrics.
+
+import pytest
+
+from peekpoke import AccessError
+
+
+def test_commands_are_counted(connect):
+    p, device = connect()
+    p.get_info()
+    metrics = p.enable_metrics()
+    assert p.enable_metrics() is metrics
+    start = device.command_count
+    p.get_bytes(0x1000, 1000)
+    p.set_bytes(0x1000, bytes(100))
+    p.get_token()
+    snapshot = metrics.snapshot()
+    commands = snapshot['commands']
+    read_hub = commands['read_hub']
+    assert read_hub['count'] == device.command_count - start - 2
+    assert read_hub['bytes_in'] >= 1000
+    assert read_hub['latency_mean'] > 0
+    assert sum(count for _bound, count in read_hub['latency_histogram']) == read_hub['count']
+    assert commands['write_hub']['count'] == 1
+    assert commands['write_hub']['bytes_out'] >= 100
+    assert commands['get_token']['count'] == 1
+    assert snapshot['baudrate'] == p.baudrate
+    metrics.reset()
+    assert metrics.snapshot()['commands'] == {}
+    p.disable_metrics()
+    p.get_token()
+    assert p.metrics is None
+    assert metrics.snapshot()['commands'] == {}
+
+
+def test_errors_are_counted(connect):
+    p, _device = connect(read_range=(0x100, 0x7fff))
+    metrics = p.enable_metrics()
+    with pytest.raises(AccessError):
+        p.get_bytes(0, 4)
+    read_hub = metrics.snapshot()['commands']['read_hub']
+    assert read_hub['count'] == 1
+    assert read_hub['access_errors'] == 1
+    assert read_hub['latency_mean'] is None
+
+
+def test_pipeline_retries_are_counted(connect):
+    p, _device = connect(command_buffer_count=1)
+    p.get_info()
+    metrics = p.enable_metrics()
+    p.pipeline_window = 4
+    p.get_bytes(0, 4096)
+    assert metrics.snapshot()['commands']['read_hub']['retries'] > 0
@@ -0,0 +1,11 @@
+# Tests for baudrate negotiation.
+
+
+def test_cached_base_baudrate_is_returned_at_once(connect):
+    # Nothing is faster than the starting baudrate, so the second negotiation
+    #  should return it without another ramp.
+    p, device = connect(max_reliable_baudrate=115200)
+    assert p.negotiate_baudrate(soak=0.05) == 115200
+    count = device.command_count
+    assert p.negotiate_baudrate(soak=0.05) == 115200
+    assert device.command_count == count
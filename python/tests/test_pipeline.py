@@ -0,0 +1,32 @@
+# Tests for pipelined hub memory commands.
+
+import os
+
+
+def test_window_reverts_when_device_cannot_buffer(connect):
+    # PeekPoke.spin has a single command buffer, so pipelined commands are lost
+    #  and must be resent one at a time.
+    p, device = connect(command_buffer_count=1)
+    device.hub[:] = os.urandom(65536)
+    p.pipeline_window = 4
+    assert p.get_bytes(0, 8192) == device.hub[0:8192]
+    assert p.pipeline_window == 1
+    assert device.dropped_count > 0
+
+
+def test_window_is_kept_when_device_can_buffer(connect):
+    p, device = connect(command_buffer_count=8)
+    device.hub[:] = os.urandom(65536)
+    p.pipeline_window = 4
+    assert p.get_bytes(0, 8192) == device.hub[0:8192]
+    assert p.pipeline_window == 4
+    assert device.dropped_count == 0
+
+
+def test_writes_survive_the_fallback(connect):
+    p, device = connect(command_buffer_count=1)
+    p.pipeline_window = 4
+    data = os.urandom(8192)
+    p.set_bytes(0x1000, data)
+    assert device.hub[0x1000:0x3000] == data
+    assert p.pipeline_window == 1
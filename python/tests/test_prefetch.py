@@ -0,0 +1,65 @@
+# Tests for sequential read-ahead.
+
+import os
+import time
+
+
+def test_sequential_reads_are_prefetched(connect):
+    p, device = connect()
+    device.hub[:] = os.urandom(65536)
+    p.get_info()
+    prefetcher = p.enable_prefetch(max_age=10)
+    start = device.command_count
+    values = [p.get_int(0x1000 + 4*i, 4) for i in range(200)]
+    assert values == [int.from_bytes(device.hub[0x1000+4*i:0x1004+4*i], 'little') for i in range(200)]
+    assert device.command_count - start < 10
+    assert prefetcher.hits > 180
+    assert prefetcher.wasted_bytes == 0
+
+
+def test_strided_reads_are_prefetched(connect):
+    p, device = connect()
+    device.hub[:] = os.urandom(65536)
+    p.get_info()
+    p.enable_prefetch(max_age=10)
+    start = device.command_count
+    values = [p.get_bytes(0x2000 + 24*i, 6) for i in range(50)]
+    assert values == [device.hub[0x2000+24*i:0x2006+24*i] for i in range(50)]
+    assert device.command_count - start < 15
+
+
+def test_writes_discard_the_window(connect):
+    p, device = connect()
+    p.enable_prefetch(max_age=10)
+    for i in range(4):
+        p.get_int(0x1000 + 4*i, 4)
+    p.set_int(0x1010, 4, 77)
+    assert p.get_int(0x1010, 4) == 77
+
+
+def test_window_expires(connect):
+    p, device = connect()
+    p.enable_prefetch(max_age=0.1)
+    for i in range(4):
+        p.get_int(0x1000 + 4*i, 4)
+    # A change made on the Propeller is not seen until the window expires.
+    device.hub[0x1010] = 5
+    assert p.get_int(0x1010, 4) == 0
+    time.sleep(0.15)
+    assert p.get_int(0x1014, 4) == 0
+    assert p.get_int(0x1010, 4) == 5
+
+
+def test_waste_disables_read_ahead(connect):
+    p, _device = connect()
+    prefetcher = p.enable_prefetch(max_age=10, max_wasted_bytes=0)
+    for i in range(4):
+        p.get_int(0x1000 + 4*i, 4)
+    assert prefetcher.windows == 1
+    p.get_int(0x4000, 4)
+    assert not prefetcher.enabled
+    for i in range(8):
+        p.get_int(0x5000 + 4*i, 4)
+    assert prefetcher.windows == 1
+    prefetcher.reset()
+    assert prefetcher.enabled
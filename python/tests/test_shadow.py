@@ -0,0 +1,40 @@
+# Tests for the hub memory shadow.
+
+
+def test_write_back_survives_page_reread(connect):
+    # A read elsewhere in a page holding buffered writes must not overwrite them.
+    p, device = connect()
+    p.enable_shadow(page_size=64, write_back=True)
+    p.set_bytes(0x100, b'ABCD')
+    assert device.hub[0x100:0x104] == bytes(4)
+    p.get_bytes(0x120, 4)
+    assert p.get_bytes(0x100, 4) == b'ABCD'
+    p.flush()
+    assert device.hub[0x100:0x104] == b'ABCD'
+
+
+def test_reads_are_served_from_the_shadow(connect):
+    p, device = connect()
+    p.enable_shadow(page_size=64)
+    device.hub[0x200:0x240] = bytes(range(64))
+    assert p.get_bytes(0x200, 64) == bytes(range(64))
+    count = device.command_count
+    assert p.get_bytes(0x210, 16) == bytes(range(16, 32))
+    assert device.command_count == count
+    p.set_bytes(0x220, b'xy')
+    assert device.hub[0x220:0x222] == b'xy'
+    assert p.get_bytes(0x21f, 4) == b'\x1fxy\x22'
+
+
+def test_write_back_is_sent_by_flush(connect):
+    p, device = connect()
+    p.enable_shadow(page_size=64, write_back=True)
+    p.get_info()
+    count = device.command_count
+    for i in range(16):
+        p.set_int(0x300 + 4*i, 4, i)
+    assert device.command_count == count
+    assert p.get_int(0x308, 4) == 2
+    p.flush()
+    assert device.command_count - count <= 2
+    assert device.hub[0x300:0x340] == b''.join(i.to_bytes(4, 'little') for i in range(16))
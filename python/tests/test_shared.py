@@ -0,0 +1,108 @@
+# Tests for the thread-safe SharedPeekPoke scheduler.
+
+import os
+import threading
+import time
+
+import pytest
+
+from peekpoke import PeekPoke
+from peekpoke.shared import SharedPeekPoke
+
+
+def _shared(connect, **kwargs):
+    p, device = connect()
+    device.hub[:] = os.urandom(65536)
+    shared = SharedPeekPoke(p.serial_port_name, **kwargs)
+    shared.get_info()
+    return shared, device
+
+
+def _waiting_count(shared):
+    with shared._lock:
+        return sum(len(queue) for callers in shared._waiting.values() for queue in callers.values())
+
+
+class _Holder():
+
+    # Holds the turn in a background thread until release is called, so that
+    #  jobs can be queued behind it.
+
+    def __init__(self, shared):
+        self._shared = shared
+        self._held = threading.Event()
+        self._release = threading.Event()
+        self._thread = threading.Thread(target=shared.submit, args=(self._hold,))
+        self._thread.start()
+        self._held.wait()
+
+    def _hold(self, peekpoke):
+        self._held.set()
+        self._release.wait()
+
+    def start(self, target, count):
+        # Starts a thread running target, and waits until count jobs are waiting.
+        thread = threading.Thread(target=target)
+        thread.start()
+        deadline = time.monotonic() + 5
+        while _waiting_count(self._shared) < count:
+            assert time.monotonic() < deadline
+            time.sleep(0.001)
+        return thread
+
+    def release(self):
+        self._release.set()
+        self._thread.join()
+
+
+def test_forwarded_methods(connect):
+    shared, device = _shared(connect)
+    shared.set_int(0x1000, 4, 1234)
+    assert shared.get_int(0x1000, 4, priority='high') == 1234
+    assert shared.get_bytes(0x2000, 5000) == device.hub[0x2000:0x2000+5000]
+    assert shared.submit(PeekPoke.get_int, 0x1000, 4) == 1234
+    with pytest.raises(AttributeError):
+        shared.batch
+    with pytest.raises(ValueError):
+        shared.get_token(priority='urgent')
+
+
+def test_large_jobs_are_split_into_turns(connect):
+    shared, device = _shared(connect, commands_per_turn=2)
+    max_atomic_read = shared.peekpoke.get_info().max_atomic_read
+    shared.metrics.reset()
+    data = os.urandom(4000)
+    shared.set_bytes(0x3000, data)
+    assert device.hub[0x3000:0x3000+4000] == data
+    assert shared.get_bytes(0x3000, 4000) == data
+    classes = shared.metrics.snapshot()['classes']
+    assert classes['normal']['jobs'] == 2
+    assert classes['normal']['turns'] >= 2*(-(-4000//(2*max_atomic_read)))
+
+
+def test_higher_priority_goes_first(connect):
+    shared, _device = _shared(connect)
+    order = []
+    holder = _Holder(shared)
+    low = holder.start(lambda: shared.submit(lambda pp: order.append('low'), priority='low'), 1)
+    normal = holder.start(lambda: shared.submit(lambda pp: order.append('normal')), 2)
+    high = holder.start(lambda: shared.submit(lambda pp: order.append('high'), priority='high'), 3)
+    holder.release()
+    for thread in (low, normal, high):
+        thread.join()
+    assert order == ['high', 'normal', 'low']
+
+
+def test_small_job_waits_for_one_piece(connect):
+    # A small job queued behind a long dump waits for one piece, not the dump.
+    shared, device = _shared(connect)
+    start = device.command_count
+    seen = []
+    holder = _Holder(shared)
+    reader = holder.start(lambda: shared.get_bytes(0, 8000, caller='dump'), 1)
+    other = holder.start(lambda: seen.append(shared.submit(lambda pp: device.command_count, caller='other')), 2)
+    holder.release()
+    reader.join()
+    other.join()
+    assert seen == [start + 1]
+    assert device.command_count - start > 20
@@ -0,0 +1,8 @@
+# Tests for the simulated device.
+
+
+def test_initial_timings_match_the_client(connect):
+    p, _device = connect(clkfreq=80000000, baudrate=115200, break_threshold_ms=150)
+    p._break_duration = 300
+    expected = p._timings_for_baudrate(115200, 80000000)
+    assert p._get_serial_timings().as_bytes() == expected.as_bytes()
@@ -0,0 +1,82 @@
+# Tests for struct layouts.
+
+import struct
+
+import pytest
+
+from peekpoke.structs import Field, StructLayout
+
+
+FIELDS = [
+    Field('state', 'long'),
+    Field('count', 'word', signed=True),
+    Field('flags', 'byte'),
+    Field('name', 'bytes', length=8),
+    Field('total', 'long'),
+]
+
+LAYOUT = StructLayout(FIELDS)
+
+
+def test_layout_offsets():
+    assert [(f.name, f.offset) for f in LAYOUT.fields] == [('state', 0), ('count', 4), ('flags', 6), ('name', 7), ('total', 16)]
+    assert LAYOUT.size == 20
+    assert LAYOUT.record_alignment == 4
+    packed = StructLayout(FIELDS, alignment='packed')
+    assert packed.field('total').offset == 15
+    assert packed.size == 19
+    with pytest.raises(ValueError):
+        StructLayout([Field('a', 'byte'), Field('a', 'word')])
+    with pytest.raises(ValueError):
+        Field('a', 'bytes')
+
+
+def test_overlapping_fields():
+    layout = StructLayout([Field('value', 'long'), Field('low', 'word', offset=0), Field('high', 'word', offset=2)])
+    data = struct.pack('<I', 0x12345678)
+    assert layout.unpack(data) == {'value': 0x12345678, 'low': 0x5678, 'high': 0x1234}
+    assert layout.pack({'high': 0xabcd}, data) == struct.pack('<I', 0xabcd5678)
+
+
+def test_get_struct_uses_one_command(connect):
+    p, device = connect()
+    device.hub[0x1000:0x1014] = struct.pack('<IhB8sxI', 7, -2, 3, b'abc', 99)
+    p.get_info()
+    start = device.command_count
+    record = p.get_struct(0x1000, LAYOUT)
+    assert device.command_count == start + 1
+    assert record.state == 7 and record['count'] == -2 and record.flags == 3
+    assert record.name == b'abc\0\0\0\0\0'
+    assert record.as_dict()['total'] == 99
+    assert record.hub_address == 0x1000
+    with pytest.raises(AttributeError):
+        record.missing
+    with pytest.raises(ValueError):
+        p.get_struct(0x1002, LAYOUT)
+    assert p.get_struct(0x1002, LAYOUT, alignment='byte').hub_address == 0x1002
+
+
+def test_get_structs(connect):
+    p, device = connect()
+    for i in range(50):
+        device.hub[0x2000+20*i:0x2014+20*i] = struct.pack('<IhB8sxI', i, -i, i%256, b'', 2*i)
+    max_atomic_read = p.get_info().max_atomic_read
+    records = p.get_structs(0x2000, LAYOUT, 50)
+    assert [(r.state, r.count, r.total, r.hub_address) for r in records] == [(i, -i, 2*i, 0x2000+20*i) for i in range(50)]
+    start = device.command_count
+    records = p.get_structs(0x2000, LAYOUT, 50, atomic=True)
+    per_command = max_atomic_read//20
+    assert device.command_count - start == -(-50//per_command)
+    assert [r.state for r in records] == list(range(50))
+
+
+def test_set_struct_writes_only_given_fields(connect):
+    p, device = connect()
+    device.hub[0x3000:0x3014] = bytes([0xff])*20
+    p.set_struct(0x3000, LAYOUT, {'count': -1, 'flags': 5, 'total': 1234})
+    record = p.get_struct(0x3000, LAYOUT)
+    assert record.state == 0xffffffff
+    assert (record.count, record.flags, record.total) == (-1, 5, 1234)
+    assert record.name == bytes([0xff])*8
+    with pytest.raises(KeyError):
+        p.set_struct(0x3000, LAYOUT, {'missing': 1})
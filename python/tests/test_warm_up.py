@@ -0,0 +1,34 @@
+# Tests for lazy opening and warm up.
+
+import pytest
+import serial
+from crow.errors import PortNotOpenError
+
+from peekpoke import PeekPoke
+
+
+def test_warm_up_fetches_info(connect):
+    p, device = connect()
+    name = p.serial_port_name
+    p = PeekPoke(name, warm_up=True)
+    p.get_info()
+    assert device.command_count == 1
+    p.get_bytes(0, 4)
+    assert device.command_count == 2
+
+
+def test_warm_up_open_error_is_raised():
+    p = PeekPoke('pytest-no-such-port', warm_up=True)
+    # The error from opening the port in the background is raised on first use.
+    with pytest.raises(serial.SerialException):
+        p.get_bytes(0, 4)
+
+
+def test_warm_up_info_error_is_logged(connect, caplog):
+    p, device = connect(address=3)
+    p = PeekPoke(p.serial_port_name, address=3, port=50, warm_up=True)
+    # Nothing is listening on port 50, so getInfo fails in the background (and
+    #  is logged) and then again when it is sent on demand.
+    with pytest.raises(PortNotOpenError):
+        p.get_info()
+    assert 'getInfo failed' in caplog.text
@@ -0,0 +1,62 @@
+# bench_ints.py
+# source: https://github.com/chris-siedell/PeekPoke
+# python: https://pypi.org/project/peekpoke/
+# homepage: http://siedell.com/projects/PeekPoke/
+
+
+# Microbenchmark for the integer list conversions used by get_ints and set_ints.
+#  It compares the current implementations with the original per item loops
+#  and checks that both produce the same results. No device is needed.
+
+
+import os
+import sys
+import timeit
+from peekpoke import PeekPoke
+
+
+LENGTHS = [1, 2, 4, 8]
+COUNTS = [1024, 4096, 16384]
+
+
+def loop_ints_from_bytes(data, length, count, byteorder, signed):
+    integers = []
+    index = 0
+    for _i in range(0, count):
+        integers.append(int.from_bytes(data[index:index+length], byteorder, signed=signed))
+        index += length
+    return integers
+
+def loop_ints_to_bytes(integers, length, byteorder, signed):
+    data = bytearray()
+    for i in integers:
+        data += i.to_bytes(length, byteorder, signed=signed)
+    return data
+
+def best_time(func, number):
+    return min(timeit.repeat(func, number=number, repeat=5)) / number
+
+
+number = 20
+if len(sys.argv) > 1:
+    number = int(sys.argv[1])
+
+print("length  count  byteorder  signed    from_bytes: loop     new  speedup    to_bytes: loop     new  speedup")
+
+for length in LENGTHS:
+    for count in COUNTS:
+        for byteorder, signed in [('little', False), ('big', True)]:
+            data = os.urandom(length*count)
+            integers = loop_ints_from_bytes(data, length, count, byteorder, signed)
+            if PeekPoke._ints_from_bytes(data, length, count, byteorder, signed) != integers:
+                sys.exit("_ints_from_bytes does not match the reference.")
+            if PeekPoke._ints_to_bytes(integers, length, byteorder, signed) != data:
+                sys.exit("_ints_to_bytes does not match the reference.")
+            old_from = best_time(lambda: loop_ints_from_bytes(data, length, count, byteorder, signed), number)
+            new_from = best_time(lambda: PeekPoke._ints_from_bytes(data, length, count, byteorder, signed), number)
+            old_to = best_time(lambda: loop_ints_to_bytes(integers, length, byteorder, signed), number)
+            new_to = best_time(lambda: PeekPoke._ints_to_bytes(integers, length, byteorder, signed), number)
+            print("{:6d} {:6d}  {:>9}  {:>6}    {:10.2f}ms {:6.2f}ms {:7.1f}x  {:10.2f}ms {:6.2f}ms {:7.1f}x".format(
+                length, count, byteorder, str(signed),
+                1000*old_from, 1000*new_from, old_from/new_from,
+                1000*old_to, 1000*new_to, old_to/new_to))